@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        # Register model signal handlers
+        from . import signals  # noqa: F401
+        # Register database connection tuning
+        from . import db  # noqa: F401
@@ -0,0 +1,132 @@
+# api/cache.py
+
+"""
+Per-user response cache for read-only viewset actions.
+
+Cached responses are grouped into scopes ('profile', 'discovery', ...) and
+keyed by scope, user and the request's path and query string (plus the
+version stamp of a conditional_action wrapping the cached one). Each key also
+embeds two version tokens: one for the scope as a whole and one for the
+(scope, user) pair. Invalidating replaces a token instead of deleting keys,
+so one set_many() drops a scope for any number of users; the orphaned
+entries simply expire. Model signals in api/signals.py do the invalidating.
+"""
+
+import functools
+import hashlib
+import time
+from collections import Counter
+from urllib.parse import urlencode
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from rest_framework.response import Response
+
+from .db_routers import replica_reads_enabled
+
+class ResponseCache:
+    """
+    Version tokens, entry keys and hit/miss counters for cached_action.
+    Counters are kept per process.
+    """
+
+    ALL_USERS = '*'
+    hits = Counter()
+    misses = Counter()
+
+    @staticmethod
+    def _version_key(scope, user_id):
+        return f'respcache_ver:{scope}:{user_id}'
+
+    @staticmethod
+    def timeout(scope):
+        timeouts = settings.RESPONSE_CACHE_TIMEOUTS
+        return timeouts.get(scope, timeouts['default'])
+
+    @staticmethod
+    def entry_key(scope, request):
+        user_id = request.user.id
+        version_keys = [
+            ResponseCache._version_key(scope, ResponseCache.ALL_USERS),
+            ResponseCache._version_key(scope, user_id),
+        ]
+        versions = cache.get_many(version_keys)
+        scope_version, user_version = (versions.get(key, 0) for key in version_keys)
+        params = urlencode(sorted(request.query_params.lists()), doseq=True)
+        # Invalidation runs on commit, so the scope tokens can trail the database;
+        # a conditional version stamp read from it can't
+        conditional_version = getattr(request, 'conditional_version', '')
+        digest = hashlib.md5(f'{request.path}?{params}#{conditional_version}'.encode()).hexdigest()
+        return f'respcache:{scope}:{user_id}:{scope_version}:{user_version}:{digest}'
+
+    @staticmethod
+    def invalidate(scopes, user_ids):
+        """
+        Drop cached responses in each of `scopes` for these users
+        (pass ResponseCache.ALL_USERS to drop a scope for everyone).
+        """
+        user_ids = set(user_ids)
+        if not user_ids:
+            return
+        token = time.time_ns()
+        # Outlive every entry keyed by the previous token
+        lifetime = max(settings.RESPONSE_CACHE_TIMEOUTS.values())
+        cache.set_many({
+            ResponseCache._version_key(scope, user_id): token
+            for scope in scopes for user_id in user_ids
+        }, lifetime)
+
+    @staticmethod
+    def invalidate_on_commit(scopes, user_ids):
+        """
+        invalidate() once the current transaction commits, so a concurrent
+        read can't cache the pre-commit state under the new token.
+        """
+        user_ids = set(user_ids)
+        transaction.on_commit(lambda: ResponseCache.invalidate(scopes, user_ids))
+
+    @staticmethod
+    def stats():
+        scopes = sorted(set(ResponseCache.hits) | set(ResponseCache.misses))
+        result = {}
+        for scope in scopes:
+            hits, misses = ResponseCache.hits[scope], ResponseCache.misses[scope]
+            result[scope] = {
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': round(hits / (hits + misses), 3) if hits + misses else None,
+            }
+        return result
+
+def cached_action(scope):
+    """
+    Cache a viewset action's successful GET responses per user under `scope`,
+    for RESPONSE_CACHE_TIMEOUTS[scope] seconds or until invalidated.
+    Other methods (e.g. PATCH on the same action) pass straight through.
+    Responses carry an X-Cache: HIT/MISS header.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, request, *args, **kwargs):
+            if request.method != 'GET' or not request.user.is_authenticated:
+                return func(self, request, *args, **kwargs)
+
+            key = ResponseCache.entry_key(scope, request)
+            data = cache.get(key)
+            if data is not None:
+                ResponseCache.hits[scope] += 1
+                return Response(data, headers={'X-Cache': 'HIT'})
+
+            ResponseCache.misses[scope] += 1
+            response = func(self, request, *args, **kwargs)
+            if response.status_code == 200 and response.data is not None:
+                timeout = ResponseCache.timeout(scope)
+                if replica_reads_enabled():
+                    # A lagging replica may have missed the write behind the last
+                    # invalidation; don't keep its answer longer than the lag window
+                    timeout = min(timeout, settings.DATABASE_REPLICA_PIN_SECONDS)
+                cache.set(key, response.data, timeout)
+            response['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,37 @@
+# api/channel_layers.py
+
+"""
+Channel layers that count their sends in api/metrics.py.
+Set CHANNEL_LAYERS BACKEND to one of these instead of the stock class.
+"""
+
+import re
+from channels.layers import InMemoryChannelLayer
+from channels_redis.core import RedisChannelLayer
+
+from .metrics import registry
+
+def target_label(name):
+    """
+    Metric label for a channel or group name: 'user_12' -> 'user'. Names of
+    individual consumers' channels ('specific.abc!def') all become 'channel'.
+    """
+    if '!' in name:
+        return 'channel'
+    return re.sub(r'[_.]?\d+', '', name) or name
+
+class ChannelLayerMetricsMixin:
+
+    async def send(self, channel, message):
+        registry.inc('jamii_channel_layer_messages_total', method='send', target=target_label(channel))
+        return await super().send(channel, message)
+
+    async def group_send(self, group, message):
+        registry.inc('jamii_channel_layer_messages_total', method='group_send', target=target_label(group))
+        return await super().group_send(group, message)
+
+class InstrumentedRedisChannelLayer(ChannelLayerMetricsMixin, RedisChannelLayer):
+    pass
+
+class InstrumentedInMemoryChannelLayer(ChannelLayerMetricsMixin, InMemoryChannelLayer):
+    pass
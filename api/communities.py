@@ -0,0 +1,105 @@
+# api/communities.py
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from rest_framework.generics import get_object_or_404
+
+from .models import Community, CommunityMembership, Conversation, ConversationParticipant
+from .cache import ResponseCache
+
+class CommunityMembershipService:
+    """
+    Set-based community membership changes. Each call is one transaction
+    that updates the membership rows, the community chat's participants
+    and Community.member_count together, whether it adds one user or a
+    whole import.
+    """
+
+    @staticmethod
+    def lock_community(community_id):
+        """
+        Lock the community row for the rest of the transaction, so concurrent
+        joins and leaves queue here instead of racing on member_count.
+        Raises Http404 if there is no such community.
+        """
+        return get_object_or_404(
+            Community.objects.select_for_update().only('id', 'member_count'),  # type: ignore
+            pk=community_id
+        )
+
+    @staticmethod
+    @transaction.atomic
+    def add_members(community_id, user_ids, role='member'):
+        """
+        Make the given users members of the community (with `role`) and
+        participants in its chat. Existing members and unknown user ids are
+        skipped. Returns (added_user_ids, member_count).
+        """
+        community = CommunityMembershipService.lock_community(community_id)
+
+        existing = set(CommunityMembership.objects.filter(  # type: ignore
+            community_id=community.id, user_id__in=user_ids
+        ).values_list('user_id', flat=True))
+        candidates = [user_id for user_id in dict.fromkeys(user_ids) if user_id not in existing]
+        valid = set(User.objects.filter(id__in=candidates).values_list('id', flat=True))
+        added = [user_id for user_id in candidates if user_id in valid]
+        if not added:
+            return [], community.member_count
+
+        CommunityMembership.objects.bulk_create([  # type: ignore
+            CommunityMembership(community_id=community.id, user_id=user_id, role=role)
+            for user_id in added
+        ], ignore_conflicts=True)
+        Community.objects.filter(pk=community.id).update(  # type: ignore
+            member_count=F('member_count') + len(added)
+        )
+
+        conversation_id = Conversation.objects.filter(  # type: ignore
+            community_id=community.id
+        ).values_list('id', flat=True).first()
+        if conversation_id is not None:
+            Conversation.objects.filter(pk=conversation_id).update(updated_at=timezone.now())  # type: ignore
+            Conversation.participants.through.objects.bulk_create([
+                Conversation.participants.through(conversation_id=conversation_id, user_id=user_id)
+                for user_id in added
+            ], ignore_conflicts=True)
+            ConversationParticipant.objects.bulk_create([  # type: ignore
+                ConversationParticipant(conversation_id=conversation_id, user_id=user_id, role=role)
+                for user_id in added
+            ], ignore_conflicts=True)
+
+        # bulk_create sends no signals
+        ResponseCache.invalidate_on_commit(['communities', 'conversations'], added)
+        return added, community.member_count + len(added)
+
+    @staticmethod
+    @transaction.atomic
+    def remove_member(community_id, user_id):
+        """
+        Remove a non-admin member from the community and its chat.
+        Returns (removed, member_count); `removed` is False if the user
+        wasn't a member or is an admin (admins can't leave).
+        """
+        community = CommunityMembershipService.lock_community(community_id)
+
+        removed, _ = CommunityMembership.objects.filter(  # type: ignore
+            community_id=community.id, user_id=user_id
+        ).exclude(role='admin').delete()
+        if not removed:
+            return False, community.member_count
+
+        Community.objects.filter(pk=community.id, member_count__gt=0).update(  # type: ignore
+            member_count=F('member_count') - 1
+        )
+        Conversation.objects.filter(community_id=community.id).update(updated_at=timezone.now())  # type: ignore
+        Conversation.participants.through.objects.filter(
+            conversation__community_id=community.id, user_id=user_id
+        ).delete()
+        ConversationParticipant.objects.filter(  # type: ignore
+            conversation__community_id=community.id, user_id=user_id
+        ).delete()
+
+        ResponseCache.invalidate_on_commit(['communities', 'conversations'], [user_id])
+        return True, max(community.member_count - 1, 0)
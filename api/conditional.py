@@ -0,0 +1,89 @@
+# api/conditional.py
+
+"""
+Conditional GET (ETag / Last-Modified) for endpoints that clients poll.
+
+Each endpoint supplies a cheap version stamp (one or two small queries on
+updated_at-style columns). When the client's If-None-Match or
+If-Modified-Since still matches it, the view answers 304 without running
+the action or serializing anything.
+"""
+
+import datetime
+import functools
+import hashlib
+from django.db.models import Count, Max
+from django.http import HttpResponseNotModified
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+from .models import Profile, Conversation, MessageReadStatus
+
+def conditional_action(version_func):
+    """
+    Add ETag/Last-Modified to a viewset action's GET responses and answer 304
+    when they haven't changed. `version_func(request)` returns
+    (version, last_modified datetime), or None to skip the check.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, request, *args, **kwargs):
+            if request.method != 'GET' or not request.user.is_authenticated:
+                return func(self, request, *args, **kwargs)
+
+            stamp = version_func(request)
+            if stamp is None:
+                return func(self, request, *args, **kwargs)
+            version, last_modified = stamp
+            # cached_action keys on the version too, so the body served under
+            # this ETag can't be a cached one from before the change
+            request.conditional_version = version
+
+            # Same URL for every user, so the user is part of the tag
+            digest = hashlib.md5(f'{request.user.id}:{request.get_full_path()}:{version}'.encode()).hexdigest()
+            etag = quote_etag(digest)
+            last_modified_ts = int(last_modified.timestamp())
+
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified_ts)
+            if response is None:
+                response = func(self, request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+            elif not isinstance(response, HttpResponseNotModified):
+                return response
+
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(last_modified_ts)
+            # Per-user data: browsers may keep it but must revalidate, proxies must not share it
+            response['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+    return decorator
+
+def profile_version(request):
+    """Version stamp for the current user's profile (profiles/me, my-status)."""
+    updated_at = Profile.objects.filter(  # type: ignore
+        user_id=request.user.id
+    ).values_list('updated_at', flat=True).first()
+    if updated_at is None:
+        return None
+    # days_in_current_location is derived from today's date
+    today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    return f'{updated_at.isoformat()}:{today.date()}', max(updated_at, today)
+
+def conversation_list_version(request):
+    """
+    Version stamp for the current user's conversation list: the conversations
+    themselves (count and newest updated_at; new and deleted messages bump it)
+    plus the user's latest read receipt, which drives the unread counts.
+    """
+    conversations = Conversation.objects.filter(participants=request.user).aggregate(  # type: ignore
+        count=Count('id'), latest=Max('updated_at')
+    )
+    last_read = MessageReadStatus.objects.filter(user=request.user).aggregate(  # type: ignore
+        latest=Max('read_at')
+    )['latest']
+    epoch = datetime.datetime.fromtimestamp(0, tz=datetime.timezone.utc)
+    latest = max(conversations['latest'] or epoch, last_read or epoch)
+    return f'{conversations["count"]}:{conversations["latest"]}:{last_read}', latest
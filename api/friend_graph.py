@@ -0,0 +1,102 @@
+# api/friend_graph.py
+
+from collections import Counter
+from django.conf import settings
+from django.core.cache import cache
+import logging
+
+from .db_routers import replica_reads_enabled
+from .models import Profile
+
+logger = logging.getLogger(__name__)
+
+class FriendGraph:
+    """
+    Cached adjacency sets for the friend graph, keyed by user id.
+    The source of truth stays the symmetrical Profile.friends relation; this
+    keeps each user's friend ids in the Django cache (in-process by default,
+    Redis when configured) so feeds, fan-outs and matching can answer
+    "who are my friends", "mutual friends" and "friends of friends" with
+    set operations instead of repeated M2M queries.
+    """
+
+    CACHE_PREFIX = 'friend_graph'
+
+    @staticmethod
+    def _key(user_id):
+        return f'{FriendGraph.CACHE_PREFIX}:{user_id}'
+
+    @staticmethod
+    def _load(user_ids):
+        """Read adjacency sets for `user_ids` from the database in one query."""
+        adjacency = {user_id: set() for user_id in user_ids}
+        through = Profile.friends.through
+        rows = through.objects.filter(
+            from_profile__user_id__in=user_ids
+        ).values_list('from_profile__user_id', 'to_profile__user_id')
+        for user_id, friend_id in rows:
+            adjacency[user_id].add(friend_id)
+        return {user_id: frozenset(friends) for user_id, friends in adjacency.items()}
+
+    @staticmethod
+    def friend_ids_many(user_ids):
+        """Return {user_id: frozenset(friend user ids)}, loading cache misses in one query."""
+        user_ids = set(user_ids)
+        if not user_ids:
+            return {}
+        keys = {FriendGraph._key(user_id): user_id for user_id in user_ids}
+        cached = cache.get_many(keys.keys())
+        adjacency = {keys[key]: friends for key, friends in cached.items()}
+
+        missing = user_ids - adjacency.keys()
+        if missing:
+            loaded = FriendGraph._load(missing)
+            timeout = settings.FRIEND_GRAPH_CACHE_TIMEOUT
+            if replica_reads_enabled():
+                # A lagging replica may not have the friendship whose accept just
+                # invalidated these keys; don't keep its answer past the lag window
+                timeout = min(timeout, settings.DATABASE_REPLICA_PIN_SECONDS)
+            cache.set_many(
+                {FriendGraph._key(user_id): friends for user_id, friends in loaded.items()},
+                timeout
+            )
+            adjacency.update(loaded)
+        return adjacency
+
+    @staticmethod
+    def friend_ids(user_id):
+        """Return the set of user ids that `user_id` is friends with."""
+        return FriendGraph.friend_ids_many([user_id])[user_id]
+
+    @staticmethod
+    def invalidate(*user_ids):
+        """Forget cached adjacency for these users; the next read reloads it."""
+        cache.delete_many([FriendGraph._key(user_id) for user_id in user_ids])
+
+    @staticmethod
+    def mutual_friend_ids(user_id, other_user_id):
+        adjacency = FriendGraph.friend_ids_many([user_id, other_user_id])
+        return adjacency[user_id] & adjacency[other_user_id]
+
+    @staticmethod
+    def mutual_friend_count(user_id, other_user_id):
+        return len(FriendGraph.mutual_friend_ids(user_id, other_user_id))
+
+    @staticmethod
+    def suggestions(user_id, limit=20):
+        """
+        Second-degree suggestions: friends of friends the user isn't connected
+        with yet, ranked by how many mutual friends they share.
+        Returns a list of (user_id, mutual_friend_count).
+        """
+        friends = FriendGraph.friend_ids(user_id)
+        if not friends:
+            return []
+
+        mutual_counts = Counter()
+        for friends_of_friend in FriendGraph.friend_ids_many(friends).values():
+            mutual_counts.update(friends_of_friend)
+
+        for excluded in friends | {user_id}:
+            mutual_counts.pop(excluded, None)
+        return mutual_counts.most_common(limit)
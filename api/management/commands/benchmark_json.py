@@ -0,0 +1,93 @@
+# api/management/commands/benchmark_json.py
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+import json
+import timeit
+
+from api import fastjson
+from api.renderers import FastJSONRenderer
+
+class Command(BaseCommand):
+    help = 'Compares JSON encode time of stdlib json / DRF against api.fastjson for typical payloads'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=50, help='Profiles / messages per payload')
+        parser.add_argument('--iterations', type=int, default=2000, help='Encodes per measurement')
+
+    def discovery_payload(self, count):
+        """Shaped like GET /api/discover/smart-matches/."""
+        now = timezone.now().isoformat()
+        matches = []
+        for i in range(count):
+            matches.append({
+                'user': {'id': i, 'username': f'traveler{i}', 'first_name': 'Amina', 'last_name': 'Otieno'},
+                'bio': 'Software engineer from Nairobi, exploring Berlin. Happy to help newcomers settle in.',
+                'avatar': f'/media/avatars/traveler{i}.jpg',
+                'home_country': 'Kenya', 'home_city': 'Nairobi',
+                'current_country': 'Germany', 'current_city': 'Berlin',
+                'interests': ['Hiking', 'Food', 'Tech', 'Music'],
+                'friends': list(range(i, i + 12)),
+                'completeness_score': 85,
+                'travel_status': 'resident', 'travel_status_display': 'Local Resident',
+                'is_traveling': False, 'travel_start_date': None, 'travel_end_date': None,
+                'is_available_to_help': True,
+                'languages_spoken': ['English', 'Swahili', 'German'],
+                'years_in_current_location': 3, 'is_local_expert': i % 3 == 0,
+                'expertise_areas': ['Housing', 'Visa'], 'helper_rating': '4.50',
+                'help_requests_fulfilled': 12, 'days_in_current_location': 1100,
+                'compatibility_score': 180 - i,
+                'match_reasons': ['From your home country', 'Speaks English, Swahili', 'Active recently'],
+                'last_seen': now,
+            })
+        return {
+            'message': f'Found {count} smart matches for you',
+            'matching_criteria': {'home_country': 'Kenya', 'current_location': 'Berlin, Germany', 'travel_status': 'traveling'},
+            'matches': matches,
+        }
+
+    def message_page_payload(self, count):
+        """Shaped like GET /api/conversations/{id}/messages/."""
+        now = timezone.now().isoformat()
+        messages = []
+        for i in range(count):
+            messages.append({
+                'id': 1000 + i, 'conversation': 7,
+                'sender': {'id': i % 4, 'username': f'member{i % 4}', 'first_name': '', 'last_name': ''},
+                'message_type': 'text',
+                'encrypted_content': 'U29tZSBlbmNyeXB0ZWQgbWVzc2FnZSBjb250ZW50IHRoYXQgaXMgYSBiaXQgbG9uZ2VyLg==' * 2,
+                'media_file': None, 'timestamp': now, 'edited_at': None,
+                'is_deleted': False, 'reply_to': 999 + i if i % 5 == 0 else None,
+                'read_by': [1, 2, 3],
+            })
+        return {'messages': messages, 'has_more': True}
+
+    def measure(self, func, iterations):
+        # Best of three runs, in microseconds per encode
+        return min(timeit.repeat(func, number=iterations, repeat=3)) / iterations * 1_000_000
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        payloads = {
+            'discovery': self.discovery_payload(options['items']),
+            'message_page': self.message_page_payload(options['items']),
+        }
+        drf_renderer = JSONRenderer()
+        fast_renderer = FastJSONRenderer()
+
+        self.stdout.write(f'api.fastjson backend: {fastjson.BACKEND}')
+        self.stdout.write(f'{options["items"]} items per payload, {iterations} encodes per measurement\n')
+        self.stdout.write(f'{"payload":<14}{"size":>9}{"json.dumps":>13}{"fastjson":>11}{"DRF":>11}{"FastJSON":>11}{"speedup":>10}')
+
+        for name, payload in payloads.items():
+            size = len(fastjson.dumps_bytes(payload))
+            stdlib_us = self.measure(lambda: json.dumps(payload), iterations)
+            fast_us = self.measure(lambda: fastjson.dumps(payload), iterations)
+            drf_us = self.measure(lambda: drf_renderer.render(payload), iterations)
+            fast_renderer_us = self.measure(lambda: fast_renderer.render(payload), iterations)
+            self.stdout.write(
+                f'{name:<14}{size:>8}B{stdlib_us:>11.1f}us{fast_us:>9.1f}us'
+                f'{drf_us:>9.1f}us{fast_renderer_us:>9.1f}us{drf_us / fast_renderer_us:>9.1f}x'
+            )
+
+        self.stdout.write(self.style.SUCCESS('\nspeedup = DRF JSONRenderer time / FastJSONRenderer time'))
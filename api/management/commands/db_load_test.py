@@ -0,0 +1,123 @@
+# api/management/commands/db_load_test.py
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from django.db import connection, connections, transaction, OperationalError
+from django.utils import timezone
+import threading
+import time
+
+from api.models import Conversation, ConversationParticipant, Message
+
+class Command(BaseCommand):
+    help = (
+        'Hammers the configured database with concurrent message writes (and reads) '
+        'and reports throughput and "database is locked" errors. '
+        'Run once normally and once with --baseline to compare against untuned SQLite, '
+        'or with --deferred to see what BEGIN IMMEDIATE adds on top of WAL.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=8, help='Concurrent writer threads')
+        parser.add_argument('--readers', type=int, default=4, help='Concurrent reader threads')
+        parser.add_argument('--messages', type=int, default=200, help='Messages written per writer')
+        parser.add_argument(
+            '--baseline', action='store_true',
+            help='SQLite only: use rollback journaling with no busy timeout, as before api/db.py'
+        )
+        parser.add_argument(
+            '--deferred', action='store_true',
+            help='SQLite only: begin transactions with a plain (deferred) BEGIN instead of BEGIN IMMEDIATE'
+        )
+
+    def handle(self, *args, **options):
+        if options['baseline'] or options['deferred']:
+            if connection.vendor != 'sqlite':
+                raise CommandError('--baseline and --deferred only apply to SQLite')
+            from django.conf import settings
+            settings.SQLITE_IMMEDIATE_TRANSACTIONS = False
+            if options['baseline']:
+                settings.SQLITE_PRAGMAS = {'journal_mode': 'delete'}
+                for alias in connections:
+                    connections[alias].settings_dict.setdefault('OPTIONS', {})['timeout'] = 0
+                connection.close()
+
+        sender = User.objects.create_user(username=f'loadtest_{int(time.time())}')
+        conversation = Conversation.objects.create(conversation_type='group', name='db load test')
+        conversation.participants.add(sender)
+        ConversationParticipant.objects.create(  # type: ignore
+            conversation=conversation, user=sender, encrypted_conversation_key='load test key'
+        )
+
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute('PRAGMA journal_mode')
+                self.stdout.write(f'SQLite journal_mode: {cursor.fetchone()[0]}')
+
+        stats = {'written': 0, 'write_errors': 0, 'reads': 0, 'read_errors': 0}
+        lock = threading.Lock()
+        writers_done = threading.Event()
+
+        def write_messages():
+            try:
+                for i in range(options['messages']):
+                    try:
+                        # Same pattern as MessageService.create_message (minus encryption and
+                        # notifications): reads, then writes, in one transaction
+                        with transaction.atomic():
+                            if not conversation.participants.filter(id=sender.id).exists():
+                                raise CommandError('Load test sender left the conversation')
+                            ConversationParticipant.objects.get(conversation=conversation, user=sender)  # type: ignore
+                            Message.objects.create(
+                                conversation=conversation, sender=sender,
+                                message_type='text', encrypted_content=f'load test message {i}'
+                            )
+                            Conversation.objects.filter(pk=conversation.pk).update(updated_at=timezone.now())
+                        with lock:
+                            stats['written'] += 1
+                    except OperationalError as e:
+                        with lock:
+                            stats['write_errors'] += 1
+                        if 'locked' not in str(e):
+                            raise
+            finally:
+                connection.close()
+
+        def read_messages():
+            try:
+                while not writers_done.is_set():
+                    try:
+                        list(conversation.messages.order_by('-timestamp')[:50])
+                        with lock:
+                            stats['reads'] += 1
+                    except OperationalError:
+                        with lock:
+                            stats['read_errors'] += 1
+            finally:
+                connection.close()
+
+        writers = [threading.Thread(target=write_messages) for _ in range(options['writers'])]
+        readers = [threading.Thread(target=read_messages) for _ in range(options['readers'])]
+
+        started = time.perf_counter()
+        for thread in writers + readers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        writers_done.set()
+        for thread in readers:
+            thread.join()
+
+        attempted = options['writers'] * options['messages']
+        self.stdout.write(f'Writers: {options["writers"]} x {options["messages"]} messages, readers: {options["readers"]}')
+        self.stdout.write(f'Elapsed: {elapsed:.2f}s')
+        self.stdout.write(f'Messages written: {stats["written"]}/{attempted} ({stats["written"] / elapsed:.0f}/s)')
+        self.stdout.write(f'Reads completed: {stats["reads"]}')
+        style = self.style.SUCCESS if not (stats['write_errors'] or stats['read_errors']) else self.style.ERROR
+        self.stdout.write(style(
+            f'"database is locked" errors: {stats["write_errors"]} writes, {stats["read_errors"]} reads'
+        ))
+
+        # Clean up the load test data
+        conversation.delete()
+        sender.delete()
@@ -0,0 +1,48 @@
+# api/management/commands/expire_story_uploads.py
+import os
+import time
+import uuid
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.models import StoryUpload
+
+class Command(BaseCommand):
+    help = (
+        'Expires resumable story uploads that have been idle for STORY_UPLOAD_EXPIRY_HOURS '
+        'and deletes leftover partial files. Run it periodically, e.g. hourly from cron'
+    )
+
+    def handle(self, *args, **options):
+        expired = StoryUpload.expire_abandoned()
+
+        # Partial files whose session is gone or no longer uploading (e.g. after a crash)
+        temp_dir = settings.STORY_UPLOAD_TEMP_DIR
+        cutoff = time.time() - settings.STORY_UPLOAD_EXPIRY_HOURS * 3600
+        names = os.listdir(temp_dir) if os.path.isdir(temp_dir) else []
+        candidates = {
+            name[:-len('.part')]: os.path.join(temp_dir, name) for name in names
+            if name.endswith('.part') and os.path.getmtime(os.path.join(temp_dir, name)) < cutoff
+        }
+        active = {
+            str(upload_id) for upload_id in StoryUpload.objects.filter(  # type: ignore
+                status='uploading', id__in=[name for name in candidates if self.is_uuid(name)]
+            ).values_list('id', flat=True)
+        }
+        removed = 0
+        for upload_id, path in candidates.items():
+            if upload_id not in active:
+                os.remove(path)
+                removed += 1
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Expired {expired} abandoned uploads and removed {removed} orphaned partial files'
+        ))
+
+    @staticmethod
+    def is_uuid(value):
+        try:
+            uuid.UUID(value)
+            return True
+        except ValueError:
+            return False
@@ -0,0 +1,30 @@
+# api/management/commands/repair_member_counts.py
+from django.core.management.base import BaseCommand
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from api.models import Community, CommunityMembership
+
+class Command(BaseCommand):
+    help = 'Recomputes Community.member_count from CommunityMembership rows for every community that has drifted'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report drifted communities without fixing them')
+
+    def handle(self, *args, **options):
+        counts = CommunityMembership.objects.filter(  # type: ignore
+            community=OuterRef('pk')
+        ).values('community').annotate(total=Count('pk')).values('total')
+        actual = Coalesce(Subquery(counts), 0)
+
+        drifted = Community.objects.annotate(actual=actual).exclude(member_count=F('actual'))  # type: ignore
+        for community in drifted.only('id', 'name', 'member_count'):
+            self.stdout.write(f'{community.name} (#{community.id}): {community.member_count} -> {community.actual}')
+
+        if options['dry_run']:
+            self.stdout.write(f'{drifted.count()} communities need repair (dry run, nothing changed)')
+            return
+
+        # One UPDATE for all drifted rows
+        repaired = Community.objects.filter(pk__in=drifted.values('pk')).update(member_count=actual)  # type: ignore
+        self.stdout.write(self.style.SUCCESS(f'Repaired member_count on {repaired} communities'))
@@ -1,12 +1,13 @@
 # api/matching.py
 
-from django.db.models import Q, Count
+from django.db.models import Q, Count, prefetch_related_objects
 from django.contrib.auth.models import User
 from django.utils import timezone
 from datetime import timedelta
 import logging
 
 from .models import Profile
+from .friend_graph import FriendGraph
 
 logger = logging.getLogger(__name__)
 
@@ -89,10 +90,19 @@ class TravelerMatcher:
         base_matches = TravelerMatcher.find_countrymates_nearby(user_profile)
         
         scored_matches = []
+        candidates = list(base_matches.prefetch_related('interests', 'friends')[:50])  # Limit for performance
+        prefetch_related_objects([user_profile], 'interests')
         
-        for match_profile in base_matches[:50]:  # Limit for performance
+        # Load every candidate's friend set in one go for the mutual-friends signal
+        adjacency = FriendGraph.friend_ids_many(
+            [user_profile.user_id] + [match_profile.user_id for match_profile in candidates]
+        )
+        user_friends = adjacency[user_profile.user_id]
+        
+        for match_profile in candidates:
             score, reasons = TravelerMatcher.calculate_compatibility_score(
-                user_profile, match_profile
+                user_profile, match_profile,
+                mutual_friend_count=len(user_friends & adjacency[match_profile.user_id])
             )
             
             if score > 0:  # Only include matches with positive scores
@@ -103,9 +113,10 @@ class TravelerMatcher:
         return scored_matches[:limit]
     
     @staticmethod
-    def calculate_compatibility_score(profile1, profile2):
+    def calculate_compatibility_score(profile1, profile2, mutual_friend_count=None):
         """
         Calculate compatibility score between two profiles.
+        Pass mutual_friend_count when it is already known to skip the friend graph lookup.
         Returns (score, reasons_list)
         """
         score = 0
@@ -124,8 +135,9 @@ class TravelerMatcher:
             reasons.append(travel_reason)
         
         # Common interests (+15 points each)
-        profile1_interests = set(profile1.interests.values_list('id', flat=True))
-        profile2_interests = set(profile2.interests.values_list('id', flat=True))
+        # .all() so interests prefetched by get_smart_matches are reused
+        profile1_interests = {interest.id for interest in profile1.interests.all()}
+        profile2_interests = {interest.id for interest in profile2.interests.all()}
         common_interests = profile1_interests & profile2_interests
         
         if common_interests:
@@ -140,6 +152,13 @@ class TravelerMatcher:
             score += language_score
             reasons.append(f"Speaks {', '.join(common_languages)}")
         
+        # Mutual friends (+10 points each, up to +30)
+        if mutual_friend_count is None:
+            mutual_friend_count = FriendGraph.mutual_friend_count(profile1.user_id, profile2.user_id)
+        if mutual_friend_count:
+            score += min(mutual_friend_count, 3) * 10
+            reasons.append(f"{mutual_friend_count} mutual friend{'s' if mutual_friend_count != 1 else ''}")
+        
         # Local expertise bonus (+40 points)
         if profile2.is_local_expert and profile2.is_available_to_help:
             score += 40
@@ -233,7 +252,9 @@ class TravelerMatcher:
             user__is_active=True
         ).exclude(
             user=user_profile.user
-        ).select_related('user').order_by('-helper_rating', '-help_requests_fulfilled')
+        ).select_related('user').prefetch_related(
+            'interests', 'friends'
+        ).order_by('-helper_rating', '-help_requests_fulfilled')
         
         return emergency_contacts[:10]  # Top 10 potential helpers
 
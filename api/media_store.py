@@ -0,0 +1,151 @@
+# api/media_store.py
+
+import hashlib
+import os
+import shutil
+import logging
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from .models import MediaBlob
+
+logger = logging.getLogger(__name__)
+
+class MediaStore:
+    """
+    Content-addressed storage for uploaded story and message media.
+    Every upload is hashed with a streaming SHA-256; identical content is
+    stored once as a MediaBlob and shared by reference count, so a file
+    forwarded to many chats or reposted as a story costs one copy on disk.
+    """
+
+    HASH_CHUNK_SIZE = 64 * 1024
+
+    @staticmethod
+    def hash_file(file_obj):
+        """Hash an uploaded file chunk by chunk. Returns (hexdigest, size)."""
+        digest = hashlib.sha256()
+        size = 0
+        for chunk in file_obj.chunks(MediaStore.HASH_CHUNK_SIZE):
+            digest.update(chunk)
+            size += len(chunk)
+        file_obj.seek(0)
+        return digest.hexdigest(), size
+
+    @staticmethod
+    def hash_path(path):
+        """Hash a file on disk without reading it into memory. Returns (hexdigest, size)."""
+        digest = hashlib.sha256()
+        size = 0
+        with open(path, 'rb') as source:
+            for chunk in iter(lambda: source.read(MediaStore.HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+                size += len(chunk)
+        return digest.hexdigest(), size
+
+    @staticmethod
+    def blob_name(sha256, original_name):
+        """Storage name for a blob, fanned out by hash prefix to keep directories small."""
+        ext = os.path.splitext(original_name)[1].lower()
+        return os.path.join('media_blobs', sha256[:2], sha256[2:4], f'{sha256}{ext}')
+
+    @staticmethod
+    def store_upload(uploaded_file):
+        """
+        Store an uploaded file (e.g. request.FILES) and return its MediaBlob.
+        The file is only written if this content has never been seen before.
+        """
+        sha256, size = MediaStore.hash_file(uploaded_file)
+
+        def write(name):
+            return default_storage.save(name, uploaded_file)
+
+        return MediaStore._acquire(sha256, size, uploaded_file.name, write)
+
+    @staticmethod
+    def store_path(path, original_name):
+        """
+        Store a file that is already on disk (e.g. an assembled chunked upload)
+        and return its MediaBlob. The source file is moved or removed.
+        """
+        sha256, size = MediaStore.hash_path(path)
+
+        def write(name):
+            name = default_storage.get_available_name(name)
+            destination = default_storage.path(name)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            shutil.move(path, destination)
+            return name
+
+        blob = MediaStore._acquire(sha256, size, original_name, write)
+        if os.path.exists(path):
+            # Content was already stored, the new copy isn't needed
+            os.remove(path)
+        return blob
+
+    @staticmethod
+    def _acquire(sha256, size, original_name, write):
+        """Take a reference on the blob for `sha256`, creating it with `write` if needed."""
+        for _ in range(2):
+            name = None
+            try:
+                with transaction.atomic():
+                    blob = MediaBlob.objects.select_for_update().filter(sha256=sha256).first()  # type: ignore
+                    if blob:
+                        MediaBlob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1)  # type: ignore
+                        blob.refresh_from_db()
+                        logger.info(f"Reusing media blob {sha256[:12]} ({blob.ref_count} refs)")
+                        return blob
+
+                    name = write(MediaStore.blob_name(sha256, original_name))
+                    blob = MediaBlob.objects.create(sha256=sha256, file=name, size=size, ref_count=1)  # type: ignore
+                    logger.info(f"Stored new media blob {sha256[:12]} ({size} bytes)")
+                    return blob
+            except IntegrityError:
+                # Someone stored the same content concurrently; drop our copy and
+                # take a reference on theirs
+                logger.info(f"Media blob {sha256[:12]} was created concurrently, retrying")
+                if name:
+                    default_storage.delete(name)
+        raise RuntimeError(f"Could not store media blob {sha256}")
+
+    @staticmethod
+    def release(blob_id):
+        """Drop one reference. The blob and its renditions are deleted with the last one."""
+        if not blob_id:
+            return
+        with transaction.atomic():
+            blob = MediaBlob.objects.select_for_update().filter(pk=blob_id).first()  # type: ignore
+            if not blob:
+                return
+            if blob.ref_count > 1:
+                MediaBlob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') - 1)  # type: ignore
+                return
+
+            names = [f.name for f in (blob.file, blob.processed_file, blob.thumbnail) if f]
+            blob.delete()
+
+        for name in set(names):
+            try:
+                default_storage.delete(name)
+            except Exception as e:
+                logger.error(f"Failed to delete media blob file {name}: {e}")
+        logger.info(f"Deleted media blob {blob.sha256[:12]}")
+
+    @staticmethod
+    def owned_files(instance, *field_names):
+        """
+        Names of files on `instance` that belong to it alone, i.e. are not one
+        of its blob's shared files (such as a trimmed rendition of a video).
+        """
+        blob = instance.blob
+        shared = set()
+        if blob:
+            shared = {f.name for f in (blob.file, blob.processed_file, blob.thumbnail) if f}
+        owned = []
+        for field_name in field_names:
+            field_file = getattr(instance, field_name)
+            if field_file and field_file.name not in shared:
+                owned.append(field_file.name)
+        return owned
@@ -0,0 +1,208 @@
+# api/messaging.py
+
+import base64
+import logging
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import models, transaction
+from django.utils import timezone
+from rest_framework import serializers
+from rest_framework.exceptions import PermissionDenied
+
+from .models import Conversation, Message, MessageReadStatus, ConversationParticipant, CommunityMembership
+from .encryption import MessageEncryption
+from .media_store import MediaStore
+
+logger = logging.getLogger(__name__)
+
+class MessageService:
+    """
+    Messaging operations shared by the REST views (api/messaging_views.py)
+    and the WebSocket commands in NotificationConsumer.
+    """
+
+    @staticmethod
+    def participant_ids(conversation_id, user):
+        """
+        Ids of everyone in the conversation, or None if `user` isn't one of them.
+        """
+        participant_ids = list(
+            Conversation.participants.through.objects.filter(
+                conversation_id=conversation_id
+            ).values_list('user_id', flat=True)
+        )
+        if user.id not in participant_ids:
+            return None
+        return participant_ids
+
+    @staticmethod
+    def get_readable_message(user, message_id):
+        """The message if `user` takes part in its conversation, else None."""
+        return Message.objects.filter(  # type: ignore
+            id=message_id, conversation__participants=user, is_deleted=False
+        ).first()
+
+    @staticmethod
+    def with_read_state(queryset, user):
+        """
+        Messages with their senders joined and is_read (by `user`) and
+        read_count annotated, so MessageSerializer runs no per-message queries.
+        """
+        return queryset.select_related('sender', 'reply_to__sender').annotate(
+            is_read=models.Exists(MessageReadStatus.objects.filter(
+                message=models.OuterRef('pk'), user=user
+            )),
+            read_count=models.Count('read_by')
+        )
+
+    @staticmethod
+    def mark_read(user, message):
+        """
+        Mark `message`, and every earlier message from others in the same
+        conversation, as read by `user`. Returns True if `message` wasn't
+        already read.
+        """
+        read_status, created = MessageReadStatus.objects.get_or_create(
+            user=user,
+            message=message
+        )
+
+        if created:
+            # Also mark all previous messages in conversation as read, in one insert
+            previous_message_ids = Message.objects.filter(  # type: ignore
+                conversation_id=message.conversation_id,
+                timestamp__lte=message.timestamp,
+                is_deleted=False
+            ).exclude(sender=user).values_list('id', flat=True)
+
+            MessageReadStatus.objects.bulk_create([
+                MessageReadStatus(user=user, message_id=message_id)
+                for message_id in previous_message_ids
+            ], ignore_conflicts=True)
+
+        return created
+
+    @staticmethod
+    def check_can_send(user, conversation):
+        """
+        Raise PermissionDenied unless `user` may post in `conversation`:
+        they must be a participant, and only admins and moderators post in channels.
+        """
+        if not conversation.participants.filter(id=user.id).exists():
+            raise PermissionDenied("You are not a participant in this conversation")
+        MessageService.check_channel_role(user, conversation)
+
+    @staticmethod
+    def check_channel_role(user, conversation):
+        if conversation.conversation_type == 'community' and conversation.community:
+            if conversation.community.is_channel:
+                is_admin_or_mod = CommunityMembership.objects.filter(
+                    user=user,
+                    community=conversation.community,
+                    role__in=['admin', 'moderator']
+                ).exists()
+                if not is_admin_or_mod:
+                    raise PermissionDenied(
+                        "Only admins and moderators can send messages in channels"
+                    )
+
+    @staticmethod
+    @transaction.atomic
+    def create_message(user, serializer):
+        """
+        Create and encrypt a new message from a validated CreateMessageSerializer.
+        Participants are notified once the transaction commits.
+        Raises PermissionDenied or ValidationError.
+        """
+        validated_data = serializer.validated_data
+        conversation = validated_data['conversation']
+        content = validated_data.get('content', '')
+        message_type = validated_data.get('message_type', 'text')
+        
+        # Check if user can send messages (additional check)
+        MessageService.check_channel_role(user, conversation)
+        
+        message = None
+        if message_type == 'text' and content:
+            # Encrypt the message content
+            try:
+                if conversation.conversation_type == 'private':
+                    # Get public keys for both participants
+                    participants = conversation.participants.all()
+                    sender_key = user.encryption_key.public_key
+                    receiver_key = participants.exclude(id=user.id).first().encryption_key.public_key
+                    
+                    encrypted_data = MessageEncryption.encrypt_private_message(
+                        content, sender_key, receiver_key
+                    )
+                else:
+                    # Group/community message - use shared key
+                    participant_detail = ConversationParticipant.objects.get(
+                        conversation=conversation,
+                        user=user
+                    )
+                    
+                    if not participant_detail.encrypted_conversation_key:
+                        raise Exception("No conversation key available")
+                    
+                    # Decrypt conversation key with user's private key (this would be done client-side)
+                    # For now, we'll store a placeholder
+                    encrypted_data = {
+                        'encrypted_content': base64.b64encode(content.encode()).decode(),
+                        'encrypted_keys': ''
+                    }
+                
+                # Create the message
+                message = serializer.save(
+                    sender=user,
+                    encrypted_content=encrypted_data['encrypted_content']
+                )
+                
+            except Exception as e:
+                logger.error(f"Message encryption failed: {e}")
+                raise serializers.ValidationError("Failed to encrypt message")
+        else:
+            # Non-text message or system message
+            media_file = validated_data.get('media_file')
+            if media_file:
+                # Forwarded/re-sent media is stored once and shared by reference
+                blob = MediaStore.store_upload(media_file)
+                message = serializer.save(sender=user, media_file=blob.file.name, blob=blob)
+            else:
+                message = serializer.save(sender=user)
+        
+        # Update conversation's updated_at timestamp
+        Conversation.objects.filter(pk=conversation.pk).update(updated_at=timezone.now())
+        
+        # Send real-time notification to all participants
+        transaction.on_commit(lambda: MessageService.notify_participants(message, conversation))
+        return message
+
+    @staticmethod
+    def notify_participants(message, conversation):
+        """Send real-time message notification to all conversation participants"""
+        try:
+            channel_layer = get_channel_layer()
+            event = {
+                'type': 'send_message',
+                'message': {
+                    'id': message.id,
+                    'conversation_id': conversation.id,
+                    'sender': message.sender.username,
+                    'message_type': message.message_type,
+                    'timestamp': message.timestamp.isoformat(),
+                    'encrypted_content': message.encrypted_content,
+                }
+            }
+            recipient_ids = list(conversation.participants.exclude(
+                id=message.sender_id
+            ).values_list('id', flat=True))
+            
+            async def send_all():
+                # Send to all participants except sender
+                for participant_id in recipient_ids:
+                    await channel_layer.group_send(f"user_{participant_id}", event)
+            
+            async_to_sync(send_all)()
+        except Exception as e:
+            logger.error(f"Failed to send message notification: {e}")
@@ -1,10 +1,8 @@
 # api/messaging_views.py
 
-import base64
 import logging
 from django.contrib.auth.models import User
 from django.db import transaction
-from django.db.models import Q, Max, Count
 from django.utils import timezone
 from rest_framework import viewsets, permissions, status, generics
 from rest_framework.decorators import action
@@ -13,8 +11,8 @@ from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 
 from .models import (
-    Conversation, Message, MessageReadStatus, UserEncryptionKey, 
-    ConversationParticipant, Community, CommunityMembership
+    Conversation, Message, UserEncryptionKey, 
+    ConversationParticipant, CommunityMembership
 )
 from .serializers import (
     ConversationSerializer, CreateConversationSerializer, MessageSerializer,
@@ -23,7 +21,11 @@ from .serializers import (
 from .permissions import (
     IsConversationParticipant, CanSendMessageInConversation, IsMessageSender
 )
-from .encryption import EncryptionManager, MessageEncryption
+from .encryption import EncryptionManager
+from .messaging import MessageService
+from .db_routers import ReplicaReadMixin
+from .cache import ResponseCache, cached_action
+from .conditional import conditional_action, conversation_list_version
 
 logger = logging.getLogger(__name__)
 
@@ -56,12 +58,14 @@ class UserEncryptionKeyViewSet(viewsets.ModelViewSet):
         else:
             serializer.save(user=self.request.user)
 
-class ConversationViewSet(viewsets.ModelViewSet):
+class ConversationViewSet(ReplicaReadMixin, viewsets.ModelViewSet):
     """
     ViewSet for managing conversations.
     """
     serializer_class = ConversationSerializer
     permission_classes = [permissions.IsAuthenticated, IsConversationParticipant]
+    # The conversation list is served from read replicas
+    replica_actions = {'list'}
     
     def get_queryset(self):
         """Return conversations where user is a participant"""
@@ -69,6 +73,15 @@ class ConversationViewSet(viewsets.ModelViewSet):
             participants=self.request.user
         ).prefetch_related('participants', 'messages', 'participant_details')
     
+    @conditional_action(conversation_list_version)
+    @cached_action('conversations')
+    def list(self, request, *args, **kwargs):
+        """
+        List the current user's conversations.
+        GET /api/conversations/
+        """
+        return super().list(request, *args, **kwargs)
+    
     def get_serializer_class(self):
         if self.action == 'create':
             return CreateConversationSerializer
@@ -170,30 +183,30 @@ class ConversationViewSet(viewsets.ModelViewSet):
             )
         
         user_ids = request.data.get('user_ids', [])
-        added_users = []
         
         with transaction.atomic():
-            for user_id in user_ids:
-                try:
-                    user = User.objects.get(id=user_id)
-                    if not conversation.participants.filter(id=user_id).exists():
-                        conversation.participants.add(user)
-                        ConversationParticipant.objects.create(
-                            conversation=conversation,
-                            user=user,
-                            role='member'
-                        )
-                        added_users.append(user.username)
-                        
-                        # Send system message
-                        Message.objects.create(
-                            conversation=conversation,
-                            sender=request.user,
-                            message_type='system',
-                            encrypted_content=f'{user.username} was added to the group'
-                        )
-                except User.DoesNotExist:
-                    continue
+            existing_ids = set(conversation.participants.values_list('id', flat=True))
+            new_users = list(
+                User.objects.filter(id__in=user_ids).exclude(id__in=existing_ids).order_by('id')
+            )
+            if new_users:
+                conversation.participants.add(*new_users)
+                ConversationParticipant.objects.bulk_create([
+                    ConversationParticipant(conversation=conversation, user=user, role='member')
+                    for user in new_users
+                ])
+                # Send system messages; bulk_create skips message_saved, so invalidate here
+                Message.objects.bulk_create([
+                    Message(
+                        conversation=conversation,
+                        sender=request.user,
+                        message_type='system',
+                        encrypted_content=f'{user.username} was added to the group'
+                    )
+                    for user in new_users
+                ])
+                ResponseCache.invalidate_on_commit(['conversations'], existing_ids)
+        added_users = [user.username for user in new_users]
         
         return Response({
             'message': f'Added {len(added_users)} participants',
@@ -245,7 +258,7 @@ class ConversationViewSet(viewsets.ModelViewSet):
             except Message.DoesNotExist:
                 pass
         
-        messages = messages_qs[:page_size]
+        messages = MessageService.with_read_state(messages_qs, request.user)[:page_size]
         serializer = MessageSerializer(messages, many=True, context={'request': request})
         
         return Response({
@@ -267,139 +280,26 @@ class MessageViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         """Return messages from conversations where user is a participant"""
         user_conversations = Conversation.objects.filter(participants=self.request.user)
-        return Message.objects.filter(
+        queryset = Message.objects.filter(
             conversation__in=user_conversations,
             is_deleted=False
-        ).select_related('sender', 'conversation', 'reply_to')
+        ).select_related('conversation')
+        return MessageService.with_read_state(queryset, self.request.user)
     
     def get_serializer_class(self):
         if self.action == 'create':
             return CreateMessageSerializer
         return MessageSerializer
     
-    @transaction.atomic
     def perform_create(self, serializer):
         """Create and encrypt a new message"""
-        validated_data = serializer.validated_data
-        conversation = validated_data['conversation']
-        content = validated_data.get('content', '')
-        message_type = validated_data.get('message_type', 'text')
-        
-        # Check if user can send messages (additional check)
-        if conversation.conversation_type == 'community' and conversation.community:
-            if conversation.community.is_channel:
-                is_admin_or_mod = CommunityMembership.objects.filter(
-                    user=self.request.user,
-                    community=conversation.community,
-                    role__in=['admin', 'moderator']
-                ).exists()
-                if not is_admin_or_mod:
-                    raise permissions.PermissionDenied(
-                        "Only admins and moderators can send messages in channels"
-                    )
-        
-        message = None
-        if message_type == 'text' and content:
-            # Encrypt the message content
-            try:
-                if conversation.conversation_type == 'private':
-                    # Get public keys for both participants
-                    participants = conversation.participants.all()
-                    sender_key = self.request.user.encryption_key.public_key
-                    receiver_key = participants.exclude(id=self.request.user.id).first().encryption_key.public_key
-                    
-                    encrypted_data = MessageEncryption.encrypt_private_message(
-                        content, sender_key, receiver_key
-                    )
-                else:
-                    # Group/community message - use shared key
-                    participant_detail = ConversationParticipant.objects.get(
-                        conversation=conversation,
-                        user=self.request.user
-                    )
-                    
-                    if not participant_detail.encrypted_conversation_key:
-                        raise Exception("No conversation key available")
-                    
-                    # Decrypt conversation key with user's private key (this would be done client-side)
-                    # For now, we'll store a placeholder
-                    encrypted_data = {
-                        'encrypted_content': base64.b64encode(content.encode()).decode(),
-                        'encrypted_keys': ''
-                    }
-                
-                # Create the message
-                message = serializer.save(
-                    sender=self.request.user,
-                    encrypted_content=encrypted_data['encrypted_content']
-                )
-                
-            except Exception as e:
-                logger.error(f"Message encryption failed: {e}")
-                from rest_framework import serializers
-                raise serializers.ValidationError("Failed to encrypt message")
-        else:
-            # Non-text message or system message
-            message = serializer.save(sender=self.request.user)
-        
-        # Update conversation's updated_at timestamp
-        conversation.updated_at = timezone.now()
-        conversation.save()
-        
-        # Send real-time notification to all participants
-        self.send_message_notification(message, conversation)
-    
-    def send_message_notification(self, message, conversation):
-        """Send real-time message notification to all conversation participants"""
-        try:
-            channel_layer = get_channel_layer()
-            
-            # Send to all participants except sender
-            for participant in conversation.participants.exclude(id=message.sender.id):
-                user_group = f"user_{participant.id}"
-                
-                async_to_sync(channel_layer.group_send)(
-                    user_group,
-                    {
-                        'type': 'send_message',
-                        'message': {
-                            'id': message.id,
-                            'conversation_id': conversation.id,
-                            'sender': message.sender.username,
-                            'message_type': message.message_type,
-                            'timestamp': message.timestamp.isoformat(),
-                            'encrypted_content': message.encrypted_content,
-                        }
-                    }
-                )
-        except Exception as e:
-            logger.error(f"Failed to send message notification: {e}")
+        MessageService.create_message(self.request.user, serializer)
     
     @action(detail=True, methods=['post'])
     def mark_read(self, request, pk=None):
         """Mark a message as read"""
         message = self.get_object()
-        
-        # Create read status if it doesn't exist
-        read_status, created = MessageReadStatus.objects.get_or_create(
-            user=request.user,
-            message=message
-        )
-        
-        if created:
-            # Also mark all previous messages in conversation as read
-            previous_messages = Message.objects.filter(
-                conversation=message.conversation,
-                timestamp__lte=message.timestamp,
-                is_deleted=False
-            ).exclude(sender=request.user)
-            
-            for prev_message in previous_messages:
-                MessageReadStatus.objects.get_or_create(
-                    user=request.user,
-                    message=prev_message
-                )
-        
+        MessageService.mark_read(request.user, message)
         return Response({'message': 'Marked as read'})
     
     @action(detail=True, methods=['post'], permission_classes=[permissions.IsAuthenticated, IsMessageSender])
@@ -410,6 +310,8 @@ class MessageViewSet(viewsets.ModelViewSet):
         message.is_deleted = True
         message.deleted_at = timezone.now()
         message.save()
+        # Changes the conversation's last message
+        Conversation.objects.filter(pk=message.conversation_id).update(updated_at=timezone.now())
         
         # Send deletion notification
         try:
@@ -0,0 +1,129 @@
+# api/metrics.py
+
+"""
+In-process metrics in the Prometheus text exposition format.
+
+Filled by MetricsMiddleware (HTTP), WebSocketMetricsMiddleware (Channels)
+and the instrumented channel layers in api/channel_layers.py, and served
+at /metrics. Values are per worker process; Prometheus scrapes each
+worker and sums them.
+"""
+
+import bisect
+import threading
+from collections import defaultdict
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+
+from .cache import ResponseCache
+
+# Seconds; also used for query time per request
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+HELP = {
+    'jamii_http_requests_total': ('counter', 'HTTP requests by route, method and status.'),
+    'jamii_http_request_duration_seconds': ('histogram', 'HTTP request latency by route.'),
+    'jamii_http_db_queries': ('histogram', 'Database queries per HTTP request by route.'),
+    'jamii_http_db_query_duration_seconds': ('histogram', 'Time spent in database queries per HTTP request by route.'),
+    'jamii_http_query_budget_exceeded_total': ('counter', 'HTTP requests that ran more queries than their QUERY_BUDGETS entry.'),
+    'jamii_response_cache_requests_total': ('counter', 'Response cache lookups by scope and result.'),
+    'jamii_websocket_connections_total': ('counter', 'WebSocket connections accepted by the ASGI app.'),
+    'jamii_websocket_open_connections': ('gauge', 'WebSocket connections currently open.'),
+    'jamii_websocket_frames_total': ('counter', 'WebSocket frames by direction.'),
+    'jamii_channel_layer_messages_total': ('counter', 'Channel layer sends by method and target.'),
+}
+
+class Registry:
+    """Thread-safe counters, gauges and histograms keyed by metric name and labels."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = defaultdict(float)
+        # (name, labels) -> [bucket counts..., +Inf count], sum
+        self.histograms = {}
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.values[(name, self._labels(labels))] += value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, self._labels(labels))] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, self._labels(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': buckets, 'counts': [0] * (len(buckets) + 1), 'sum': 0.0}
+            histogram['counts'][bisect.bisect_left(buckets, value)] += 1
+            histogram['sum'] += value
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+            self.histograms.clear()
+
+    def render(self):
+        """The registry (plus response cache counters) as Prometheus text."""
+        with self.lock:
+            values = dict(self.values)
+            histograms = {key: {**h, 'counts': list(h['counts'])} for key, h in self.histograms.items()}
+        for scope, counts in ResponseCache.stats().items():
+            values[('jamii_response_cache_requests_total', (('result', 'hit'), ('scope', scope)))] = counts['hits']
+            values[('jamii_response_cache_requests_total', (('result', 'miss'), ('scope', scope)))] = counts['misses']
+
+        by_name = defaultdict(list)
+        for (name, labels), value in values.items():
+            by_name[name].append(('', labels, value))
+        for (name, labels), histogram in histograms.items():
+            cumulative = 0
+            for bound, count in zip(histogram['buckets'] + (float('inf'),), histogram['counts']):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                by_name[name].append(('_bucket', labels + (('le', le),), cumulative))
+            by_name[name].append(('_sum', labels, histogram['sum']))
+            by_name[name].append(('_count', labels, cumulative))
+
+        lines = []
+        for name in sorted(by_name):
+            kind, help_text = HELP.get(name, ('untyped', ''))
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for suffix, labels, value in by_name[name]:
+                label_text = ','.join(f'{key}="{_escape(val)}"' for key, val in labels)
+                lines.append(f'{name}{suffix}{{{label_text}}} {_number(value)}' if label_text else f'{name}{suffix} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def _number(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+registry = Registry()
+
+def query_budget(method, route):
+    """
+    QUERY_BUDGETS entry for a request: 'METHOD route' if there is one (writes
+    usually cost more than reads of the same URL), else 'route', else 'default'.
+    """
+    budgets = settings.QUERY_BUDGETS
+    return budgets.get(f'{method} {route}', budgets.get(route, budgets['default']))
+
+def metrics_view(request):
+    """
+    Prometheus scrape endpoint.
+    GET /metrics  (Authorization: Bearer <METRICS_TOKEN> when METRICS_TOKEN is set)
+    """
+    if settings.METRICS_TOKEN:
+        supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+        if not constant_time_compare(supplied, settings.METRICS_TOKEN):
+            return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
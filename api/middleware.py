@@ -1,26 +1,83 @@
 # api/middleware.py
 
+import hashlib
 import logging
+import random
+import time
+from contextlib import ExitStack
 from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.db import connections
+from rest_framework.permissions import SAFE_METHODS
 from rest_framework_simplejwt.tokens import AccessToken
 from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
 from urllib.parse import parse_qs
 
+from .db_routers import pin_to_primary
+from .metrics import registry, query_budget, QUERY_COUNT_BUCKETS
+
 logger = logging.getLogger(__name__)
 
+def log_sampled(message):
+    """
+    Debug-log a per-connection event (auth, connect, disconnect) for a sample
+    of connections only, so a reconnect storm doesn't flood the log pipeline.
+    """
+    if logger.isEnabledFor(logging.DEBUG) and random.random() < settings.WS_AUTH_LOG_SAMPLE_RATE:
+        logger.debug(message)
+
 @database_sync_to_async
 def get_user(user_id):
-    # Import User model inside the function 
-    from django.contrib.auth.models import User 
+    # Import User model inside the function
+    from django.contrib.auth.models import User
     try:
-        user = User.objects.get(id=user_id)
-        logger.info(f"Found authenticated user: {user.username} (ID: {user.id})")
-        return user
+        return User.objects.get(id=user_id)
     except User.DoesNotExist:
+        return None
+
+def invalid_token_key(token):
+    # Tokens are never used as cache keys (or logged) directly
+    return f"ws_auth_invalid:{hashlib.sha256(token.encode()).hexdigest()}"
+
+async def resolve_user(token):
+    """
+    Turn an access token into a User, or AnonymousUser if it isn't valid.
+    Valid tokens are cached per user id + jti for WS_AUTH_USER_CACHE_TIMEOUT
+    seconds, so reconnects with the same token skip the database.
+    Tokens that failed once are remembered for WS_AUTH_INVALID_TOKEN_CACHE_TIMEOUT
+    seconds and rejected without decoding them again.
+    """
+    invalid_key = invalid_token_key(token)
+    if await cache.aget(invalid_key):
+        log_sampled("Rejected previously invalid token")
+        return AnonymousUser()
+
+    try:
+        access_token = AccessToken(token)
+        user_id = access_token['user_id']
+    except (InvalidToken, TokenError, KeyError) as e:
+        log_sampled(f"Token validation failed: {e}")
+        await cache.aset(invalid_key, True, settings.WS_AUTH_INVALID_TOKEN_CACHE_TIMEOUT)
+        return AnonymousUser()
+
+    user_key = f"ws_auth_user:{user_id}:{access_token.get('jti', '')}"
+    user = await cache.aget(user_key)
+    if user is not None:
+        log_sampled(f"Authenticated user {user_id} from cache")
+        return user
+
+    user = await get_user(user_id)
+    if user is None:
         logger.warning(f"User with ID {user_id} not found")
+        await cache.aset(invalid_key, True, settings.WS_AUTH_INVALID_TOKEN_CACHE_TIMEOUT)
         return AnonymousUser()
 
+    await cache.aset(user_key, user, settings.WS_AUTH_USER_CACHE_TIMEOUT)
+    log_sampled(f"Authenticated user {user_id}")
+    return user
+
 class JwtAuthMiddleware:
     """
     Custom middleware to authenticate users for WebSocket connections
@@ -33,28 +90,117 @@ class JwtAuthMiddleware:
         query_string = scope.get('query_string', b'').decode()
         query_params = parse_qs(query_string)
         token = query_params.get('token', [None])[0]
-        
-        logger.info(f"WebSocket connection attempt with query string: {query_string}")
 
         if token:
             # Remove angle brackets if present
             token = token.strip('<>')
-            logger.info(f"Processing token: {token[:50]}...")
-            
+
             try:
-                access_token = AccessToken(token)
-                user_id = access_token['user_id']
-                logger.info(f"Token is valid for user_id: {user_id}")
-                scope['user'] = await get_user(user_id)
-            except (InvalidToken, TokenError) as e:
-                logger.error(f"Token validation failed: {e}")
-                scope['user'] = AnonymousUser()
+                scope['user'] = await resolve_user(token)
             except Exception as e:
                 logger.error(f"Unexpected error during token validation: {e}")
                 scope['user'] = AnonymousUser()
         else:
-            logger.info("No token provided in query parameters")
+            log_sampled("No token provided in query parameters")
             scope['user'] = AnonymousUser()
-        
-        logger.info(f"Final user in scope: {scope['user']}")
-        return await self.app(scope, receive, send)
\ No newline at end of file
+
+        return await self.app(scope, receive, send)
+
+class PrimaryPinMiddleware:
+    """
+    Pins a user's reads to the primary database for a few seconds after
+    any successful write they make (see api/db_routers.py), so replica lag
+    never hides their own changes from them.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if request.method not in SAFE_METHODS and response.status_code < 400:
+            # DRF copies the authenticated user onto the underlying request
+            user = getattr(request, 'user', None)
+            if user is not None and user.is_authenticated:
+                pin_to_primary(user.id)
+        return response
+
+class MetricsMiddleware:
+    """
+    Records per-route latency, status codes and database query count/time for
+    every HTTP request (api/metrics.py), and logs a warning when a route runs
+    more queries than its QUERY_BUDGETS entry allows.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = {'count': 0, 'seconds': 0.0}
+
+        def count_query(execute, sql, params, many, context):
+            started = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                queries['count'] += 1
+                queries['seconds'] += time.perf_counter() - started
+
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            # Every alias, so replica reads are counted too
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(count_query))
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+
+        # URL names ('story-list', 'discover-smart-matches') keep label cardinality bounded
+        match = request.resolver_match
+        route = match.view_name if match else 'unmatched'
+        registry.inc('jamii_http_requests_total', route=route, method=request.method, status=str(response.status_code))
+        registry.observe('jamii_http_request_duration_seconds', elapsed, route=route, method=request.method)
+        registry.observe('jamii_http_db_queries', queries['count'], QUERY_COUNT_BUCKETS, route=route)
+        registry.observe('jamii_http_db_query_duration_seconds', queries['seconds'], route=route)
+
+        budget = query_budget(request.method, route)
+        if queries['count'] > budget:
+            registry.inc('jamii_http_query_budget_exceeded_total', route=route)
+            logger.warning(
+                f"{request.method} {route} ran {queries['count']} queries "
+                f"({queries['seconds'] * 1000:.1f}ms), over its budget of {budget}"
+            )
+        return response
+
+class WebSocketMetricsMiddleware:
+    """
+    Channels middleware counting WebSocket connections, open connections
+    and frames in each direction (api/metrics.py).
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'websocket':
+            return await self.app(scope, receive, send)
+
+        accepted = False
+
+        async def counting_receive():
+            message = await receive()
+            if message['type'] == 'websocket.receive':
+                registry.inc('jamii_websocket_frames_total', direction='in')
+            return message
+
+        async def counting_send(message):
+            nonlocal accepted
+            if message['type'] == 'websocket.accept':
+                accepted = True
+                registry.inc('jamii_websocket_connections_total')
+                registry.inc('jamii_websocket_open_connections')
+            elif message['type'] == 'websocket.send':
+                registry.inc('jamii_websocket_frames_total', direction='out')
+            await send(message)
+
+        try:
+            return await self.app(scope, counting_receive, counting_send)
+        finally:
+            if accepted:
+                registry.inc('jamii_websocket_open_connections', -1)
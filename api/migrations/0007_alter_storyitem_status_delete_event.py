@@ -1,8 +1,4 @@
-<<<<<<< HEAD
-# Generated by Django 4.2.23 on 2025-09-18 13:31
-=======
 # Generated by Django 4.2.23 on 2025-09-22 11:08
->>>>>>> fb8be1c487c40f3b76bb40e8403faf9146d682fb
 
 from django.db import migrations, models
 
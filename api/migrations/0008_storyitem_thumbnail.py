@@ -0,0 +1,43 @@
+# Generated by Django 4.2.23 on 2026-10-19 06:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_alter_storyitem_status_delete_event'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storyitem',
+            name='thumbnail',
+            field=models.ImageField(blank=True, null=True, upload_to='story_thumbnails/'),
+        ),
+        migrations.AlterField(
+            model_name='profile',
+            name='bio',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AlterField(
+            model_name='profile',
+            name='current_city',
+            field=models.CharField(default='', max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='profile',
+            name='current_country',
+            field=models.CharField(default='', max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='profile',
+            name='home_city',
+            field=models.CharField(default='', max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='profile',
+            name='home_country',
+            field=models.CharField(default='', max_length=100),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.23 on 2026-10-19 06:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_storyupload'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('file', models.FileField(upload_to='media_blobs/')),
+                ('size', models.PositiveBigIntegerField()),
+                ('ref_count', models.PositiveIntegerField(default=0)),
+                ('processed_file', models.FileField(blank=True, null=True, upload_to='media_blobs/')),
+                ('processed_duration', models.DecimalField(blank=True, decimal_places=2, max_digits=5, null=True)),
+                ('thumbnail', models.ImageField(blank=True, null=True, upload_to='story_thumbnails/')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='messages', to='api.mediablob'),
+        ),
+        migrations.AddField(
+            model_name='storyitem',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='story_items', to='api.mediablob'),
+        ),
+    ]
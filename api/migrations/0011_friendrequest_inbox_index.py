@@ -0,0 +1,17 @@
+# Generated by Django 4.2.23 on 2026-10-19 07:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_mediablob'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='friendrequest',
+            index=models.Index(fields=['to_user', 'status', '-created_at'], name='friendreq_inbox_idx'),
+        ),
+    ]
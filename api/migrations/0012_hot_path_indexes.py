@@ -0,0 +1,29 @@
+# Generated by Django 4.2.23 on 2026-10-19 07:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_friendrequest_inbox_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('is_deleted', False)), fields=['conversation', '-timestamp'], name='message_conv_live_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='profile',
+            index=models.Index(fields=['home_country', 'current_country', 'current_city'], name='profile_countrymates_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='profile',
+            index=models.Index(condition=models.Q(('is_available_to_help', True), ('is_local_expert', True)), fields=['current_country', 'current_city', '-helper_rating'], name='profile_local_experts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='storypost',
+            index=models.Index(fields=['sender', '-created_at'], name='storypost_sender_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.23 on 2026-10-19 07:21
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_member_counts(apps, schema_editor):
+    Community = apps.get_model('api', 'Community')
+    CommunityMembership = apps.get_model('api', 'CommunityMembership')
+    counts = CommunityMembership.objects.filter(
+        community=OuterRef('pk')
+    ).values('community').annotate(total=Count('pk')).values('total')
+    Community.objects.update(member_count=Coalesce(Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='community',
+            name='member_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_member_counts, migrations.RunPython.noop),
+    ]
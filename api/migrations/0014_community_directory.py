@@ -0,0 +1,50 @@
+# Generated by Django 4.2.23 on 2026-10-19 07:22
+
+from django.db import migrations, models
+
+
+def backfill_search_names(apps, schema_editor):
+    Community = apps.get_model('api', 'Community')
+    communities = list(Community.objects.only('id', 'name'))
+    for community in communities:
+        # Same lower-casing as Community.save()
+        community.search_name = community.name.lower()
+    Community.objects.bulk_update(communities, ['search_name'], batch_size=1000)
+
+
+def create_trigram_index(apps, schema_editor):
+    # Substring search on PostgreSQL: LIKE '%ber%' can use a GIN trigram index
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS community_search_name_trgm_idx '
+        'ON api_community USING gin (search_name gin_trgm_ops)'
+    )
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS community_search_name_trgm_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_community_member_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='community',
+            name='search_name',
+            field=models.CharField(default='', editable=False, max_length=150),
+        ),
+        migrations.RunPython(backfill_search_names, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='community',
+            index=models.Index(fields=['search_name', 'id'], name='community_search_name_idx'),
+        ),
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.23 on 2026-10-19 08:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_profile_updated_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='storyupload',
+            name='status',
+            field=models.CharField(choices=[('uploading', 'Uploading'), ('complete', 'Complete'), ('aborted', 'Aborted'), ('failed', 'Failed'), ('expired', 'Expired')], default='uploading', max_length=20),
+        ),
+    ]
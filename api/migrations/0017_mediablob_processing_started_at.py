@@ -0,0 +1,18 @@
+# Generated by Django 4.2.23 on 2026-10-19 08:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0016_story_upload_failed_expired'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mediablob',
+            name='processing_started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -1,3 +1,7 @@
+import os
+import uuid
+from datetime import timedelta
+from django.conf import settings
 from django.db import models
 from django.contrib.auth.models import User
 from django.utils import timezone
@@ -53,6 +57,22 @@ class Profile(models.Model):
     expertise_areas = models.JSONField(default=list)  # ['transportation', 'food', 'culture']
     helper_rating = models.DecimalField(max_digits=3, decimal_places=2, default=0.0)
     help_requests_fulfilled = models.PositiveIntegerField(default=0)  # type: ignore
+    # Version stamp for conditional GETs (api/conditional.py); also bumped when friends change
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # Countrymates, travel buddies and the emergency network all filter on
+            # home_country + current_country (+ current_city); home_country alone
+            # is the global network size.
+            models.Index(fields=['home_country', 'current_country', 'current_city'], name='profile_countrymates_idx'),
+            # Local experts: only available experts are ever searched, best rated first
+            models.Index(
+                fields=['current_country', 'current_city', '-helper_rating'],
+                name='profile_local_experts_idx',
+                condition=models.Q(is_local_expert=True, is_available_to_help=True),
+            ),
+        ]
 
     def __str__(self) -> str:
         return str(self.user.username)  # type: ignore
@@ -76,10 +96,38 @@ class FriendRequest(models.Model):
     
     class Meta:
         unique_together = ('from_user', 'to_user')
+        indexes = [
+            # Serves the pending inbox: WHERE to_user = ? AND status = 'pending' ORDER BY created_at DESC
+            models.Index(fields=['to_user', 'status', '-created_at'], name='friendreq_inbox_idx'),
+        ]
     
     def __str__(self) -> str:
         return f"{self.from_user.username} -> {self.to_user.username} ({self.status})"  # type: ignore
 
+# Media Blob Model: Content-addressed storage for uploaded media.
+# Identical uploads share one file on disk, reference-counted by the
+# StoryItems and Messages pointing at it (see api/media_store.py).
+class MediaBlob(models.Model):
+    # Add explicit type annotation for the objects manager to help type checkers
+    from django.db.models import Manager
+    objects: Manager = models.Manager()
+    
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.FileField(upload_to='media_blobs/')
+    size = models.PositiveBigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)  # type: ignore
+    # Untrimmed story rendition, reused instead of transcoding the same upload again
+    processed_file = models.FileField(upload_to='media_blobs/', null=True, blank=True)
+    processed_duration = models.DecimalField(max_digits=5, decimal_places=2, null=True, blank=True)
+    thumbnail = models.ImageField(upload_to='story_thumbnails/', null=True, blank=True)
+    # Set while a media task is producing processed_file, so concurrent uploads
+    # of the same content wait for it instead of transcoding in parallel
+    processing_started_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    def __str__(self) -> str:
+        return f'Blob {self.sha256[:12]} ({self.size} bytes, {self.ref_count} refs)'
+
 # Story Post Model
 class StoryPost(models.Model):
     # Add explicit type annotation for the objects manager to help type checkers
@@ -92,6 +140,10 @@ class StoryPost(models.Model):
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Story feed: WHERE sender_id IN (friends) ORDER BY created_at DESC
+            models.Index(fields=['sender', '-created_at'], name='storypost_sender_idx'),
+        ]
     
     def __str__(self) -> str:
         return f"Story by {self.sender.username} at {self.created_at}"  # type: ignore
@@ -112,10 +164,73 @@ class StoryItem(models.Model):
     media_type = models.CharField(max_length=10, choices=MEDIA_TYPE_CHOICES)
     duration_seconds = models.DecimalField(max_digits=5, decimal_places=2, default=5.0)
     status = models.CharField(max_length=20, default='pending_upload')
-    
+    # Small JPEG preview (image thumbnail or video poster frame) for trays and feeds
+    thumbnail = models.ImageField(upload_to='story_thumbnails/', null=True, blank=True)
+    # Deduplicated source upload this item was created from
+    blob = models.ForeignKey(MediaBlob, on_delete=models.SET_NULL, null=True, blank=True, related_name='story_items')  # type: ignore
+
     def __str__(self) -> str:
         return f"{self.media_type} for {self.post}"
 
+# Story Upload Model: Tracks a resumable, chunked upload of story media.
+# Chunks are appended to a temporary file until the upload is completed,
+# at which point the file becomes a regular StoryItem.
+class StoryUpload(models.Model):
+    # Add explicit type annotation for the objects manager to help type checkers
+    from django.db.models import Manager
+    objects: Manager = models.Manager()
+    
+    STATUS_CHOICES = (
+        ('uploading', 'Uploading'),
+        ('complete', 'Complete'),
+        ('aborted', 'Aborted'),
+        ('failed', 'Failed'),
+        ('expired', 'Expired'),
+    )
+    
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='story_uploads')  # type: ignore
+    filename = models.CharField(max_length=255)
+    media_type = models.CharField(max_length=10, choices=StoryItem.MEDIA_TYPE_CHOICES)
+    total_size = models.PositiveBigIntegerField()
+    received_bytes = models.PositiveBigIntegerField(default=0)  # type: ignore
+    # Optional video trimming, applied once the upload is handed to processing
+    start_time = models.FloatField(null=True, blank=True)
+    end_time = models.FloatField(null=True, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='uploading')
+    story_post = models.ForeignKey(StoryPost, on_delete=models.SET_NULL, null=True, blank=True, related_name='uploads')  # type: ignore
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    @property
+    def temp_path(self) -> str:
+        """Location of the partially uploaded file on disk."""
+        return os.path.join(settings.STORY_UPLOAD_TEMP_DIR, f'{self.id}.part')
+    
+    @classmethod
+    def expire_abandoned(cls, queryset=None):
+        """
+        Expire uploads that have not received a chunk for STORY_UPLOAD_EXPIRY_HOURS
+        and delete their partial files. Returns the number of expired uploads.
+        """
+        cutoff = timezone.now() - timedelta(hours=settings.STORY_UPLOAD_EXPIRY_HOURS)
+        stale = (queryset if queryset is not None else cls.objects.all()).filter(
+            status='uploading', updated_at__lt=cutoff
+        )
+        expired = 0
+        for upload in stale.only('id'):
+            # Re-check per row so an upload that just received a chunk is left alone
+            if cls.objects.filter(pk=upload.pk, status='uploading', updated_at__lt=cutoff).update(  # type: ignore
+                status='expired', updated_at=timezone.now()
+            ):
+                expired += 1
+                if os.path.exists(upload.temp_path):
+                    os.remove(upload.temp_path)
+        return expired
+    
+    def __str__(self) -> str:
+        return f'Upload {self.id} by {self.user.username} ({self.received_bytes}/{self.total_size} bytes)'  # type: ignore
+
 # Community Model: The main group or community.
 class Community(models.Model):
     # Add explicit type annotation for the objects manager to help type checkers
@@ -130,6 +245,26 @@ class Community(models.Model):
     # This links Users to the community VIA the CommunityMembership model.
     members = models.ManyToManyField(User, through='CommunityMembership', related_name='communities')
     is_channel = models.BooleanField(default=False)  # type: ignore # True = only admins/mods can post
+    # Denormalized count of CommunityMembership rows, kept up to date by CommunityViewSet.
+    # Recompute with `python manage.py repair_member_counts` if it ever drifts.
+    member_count = models.PositiveIntegerField(default=0)  # type: ignore
+    # Lower-cased name for the directory's prefix search; set in save()
+    search_name = models.CharField(max_length=150, default='', editable=False)
+
+    class Meta:
+        indexes = [
+            # Directory: ORDER BY search_name, and prefix search as a range scan
+            # (search_name >= 'ken' AND search_name < 'ken\uffff'). On PostgreSQL,
+            # migration 0014 also adds a trigram index for substring search.
+            models.Index(fields=['search_name', 'id'], name='community_search_name_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.search_name = str(self.name).lower()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'name' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'search_name'}
+        super().save(*args, **kwargs)
 
     def __str__(self) -> str:
         return str(self.name)
@@ -222,6 +357,7 @@ class Message(models.Model):
     
     # For media messages
     media_file = models.FileField(upload_to='message_media/', null=True, blank=True)
+    blob = models.ForeignKey(MediaBlob, on_delete=models.SET_NULL, null=True, blank=True, related_name='messages')  # type: ignore
     
     # Message metadata
     timestamp = models.DateTimeField(auto_now_add=True)
@@ -238,6 +374,15 @@ class Message(models.Model):
 
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            # Message history and mark-read only look at messages that aren't deleted:
+            # WHERE conversation_id = ? AND NOT is_deleted ORDER BY timestamp DESC
+            models.Index(
+                fields=['conversation', '-timestamp'],
+                name='message_conv_live_idx',
+                condition=models.Q(is_deleted=False),
+            ),
+        ]
 
     def __str__(self) -> str:
         return f'From {self.sender.username} in {self.conversation} at {self.timestamp:%Y-%m-%d %H:%M}'  # type: ignore
@@ -0,0 +1,116 @@
+# api/notifications.py
+
+import json
+import threading
+from collections import deque
+from functools import lru_cache
+from django.conf import settings
+import logging
+
+logger = logging.getLogger(__name__)
+
+class RedisLogBackend:
+    """
+    Per user: a counter `notification_seq:<user_id>` handing out sequence
+    numbers and a capped list `notification_log:<user_id>` of the newest
+    events, oldest first. The counter never expires so sequence numbers keep
+    increasing even after the log itself has aged out.
+    """
+
+    def __init__(self, url):
+        import redis
+        self.client = redis.Redis.from_url(url)
+
+    def append_many(self, user_ids, event, max_size, ttl):
+        pipe = self.client.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.incr(f'notification_seq:{user_id}')
+        seqs = dict(zip(user_ids, pipe.execute()))
+
+        for user_id, seq in seqs.items():
+            key = f'notification_log:{user_id}'
+            pipe.rpush(key, json.dumps({**event, 'seq': seq}))
+            pipe.ltrim(key, -max_size, -1)
+            pipe.expire(key, ttl)
+        pipe.execute()
+        return seqs
+
+    def since(self, user_id, last_seq):
+        pipe = self.client.pipeline(transaction=True)
+        pipe.lrange(f'notification_log:{user_id}', 0, -1)
+        pipe.get(f'notification_seq:{user_id}')
+        entries, current_seq = pipe.execute()
+        events = [json.loads(entry) for entry in entries]
+        return [event for event in events if event['seq'] > last_seq], int(current_seq or 0)
+
+    def current_seq(self, user_id):
+        return int(self.client.get(f'notification_seq:{user_id}') or 0)
+
+class MemoryLogBackend:
+    """In-process stand-in for development and tests (no expiry)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seqs = {}  # user_id -> last sequence number handed out
+        self.logs = {}  # user_id -> deque of events
+
+    def append_many(self, user_ids, event, max_size, ttl):
+        seqs = {}
+        with self.lock:
+            for user_id in user_ids:
+                seq = self.seqs[user_id] = self.seqs.get(user_id, 0) + 1
+                self.logs.setdefault(user_id, deque(maxlen=max_size)).append({**event, 'seq': seq})
+                seqs[user_id] = seq
+        return seqs
+
+    def since(self, user_id, last_seq):
+        with self.lock:
+            events = [event for event in self.logs.get(user_id, ()) if event['seq'] > last_seq]
+            return events, self.seqs.get(user_id, 0)
+
+    def current_seq(self, user_id):
+        with self.lock:
+            return self.seqs.get(user_id, 0)
+
+@lru_cache(maxsize=None)
+def get_backend():
+    if settings.REALTIME_BACKEND == 'memory':
+        return MemoryLogBackend()
+    return RedisLogBackend(settings.REALTIME_REDIS_URL)
+
+class NotificationLog:
+    """
+    Bounded per-user log of `send_notification` events, each stamped with a
+    per-user sequence number. Every notification is appended before it is
+    sent, and clients remember the last `seq` they saw. On reconnect,
+    NotificationConsumer replays everything after it, so a client that was
+    offline (or dropped frames) catches up without refetching over REST.
+    Only the newest NOTIFICATION_LOG_MAX_SIZE events per user are kept.
+    """
+
+    @staticmethod
+    def append(user_ids, event):
+        """Log `event` for every user in `user_ids`; returns {user_id: seq}."""
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        return get_backend().append_many(
+            user_ids, event, settings.NOTIFICATION_LOG_MAX_SIZE, settings.NOTIFICATION_LOG_TTL
+        )
+
+    @staticmethod
+    def since(user_id, last_seq):
+        """
+        Return (events after `last_seq`, oldest first, and the user's current seq).
+        A `last_seq` ahead of the current seq means the counter was reset,
+        so the whole retained log is returned.
+        """
+        events, current_seq = get_backend().since(user_id, last_seq)
+        if last_seq > current_seq:
+            events, current_seq = get_backend().since(user_id, 0)
+        return events, current_seq
+
+    @staticmethod
+    def current_seq(user_id):
+        """The seq of the user's newest notification (0 if they never had one)."""
+        return get_backend().current_seq(user_id)
@@ -0,0 +1,26 @@
+# api/pagination.py
+
+from rest_framework.pagination import CursorPagination
+
+
+class FriendRequestInboxPagination(CursorPagination):
+    """
+    Keyset pagination for the pending friend request inbox.
+    Newest first; the cursor encodes the last created_at seen, so deep pages
+    cost the same as the first one and new requests never shift the pages.
+    """
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = ('-created_at', '-id')
+
+
+class CommunityDirectoryPagination(CursorPagination):
+    """
+    Keyset pagination for the community directory, alphabetical by name.
+    Walks community_search_name_idx, so page 500 is as cheap as page 1.
+    """
+    page_size = 25
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = ('search_name', 'id')
@@ -0,0 +1,112 @@
+# api/presence.py
+
+import threading
+import time
+from functools import lru_cache
+from django.conf import settings
+import logging
+
+logger = logging.getLogger(__name__)
+
+class RedisPresenceBackend:
+    """
+    One sorted set per user, `presence:<user_id>`, holding that user's open
+    connections (channel names) scored by the time their last heartbeat
+    expires. A user is online while any score is still in the future, so a
+    connection whose worker dies without disconnecting ages out after PRESENCE_TTL.
+    """
+
+    def __init__(self, url):
+        import redis
+        self.client = redis.Redis.from_url(url)
+
+    @staticmethod
+    def _key(user_id):
+        return f'presence:{user_id}'
+
+    def touch(self, user_id, channel_name, ttl):
+        now = time.time()
+        key = self._key(user_id)
+        pipe = self.client.pipeline(transaction=False)
+        pipe.zadd(key, {channel_name: now + ttl})
+        pipe.zremrangebyscore(key, '-inf', now)
+        pipe.expire(key, int(ttl))
+        pipe.execute()
+
+    def remove(self, user_id, channel_name):
+        self.client.zrem(self._key(user_id), channel_name)
+
+    def online_user_ids(self, user_ids):
+        now = time.time()
+        pipe = self.client.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.zcount(self._key(user_id), now, '+inf')
+        return {user_id for user_id, live in zip(user_ids, pipe.execute()) if live}
+
+class MemoryPresenceBackend:
+    """
+    In-process stand-in for development and tests. Only correct when the
+    consumers and the code asking about presence share one process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = {}  # user_id -> {channel_name: expires_at}
+
+    def touch(self, user_id, channel_name, ttl):
+        with self.lock:
+            self.connections.setdefault(user_id, {})[channel_name] = time.time() + ttl
+
+    def remove(self, user_id, channel_name):
+        with self.lock:
+            channels = self.connections.get(user_id, {})
+            channels.pop(channel_name, None)
+            if not channels:
+                self.connections.pop(user_id, None)
+
+    def online_user_ids(self, user_ids):
+        now = time.time()
+        with self.lock:
+            return {
+                user_id for user_id in user_ids
+                if any(expires_at > now for expires_at in self.connections.get(user_id, {}).values())
+            }
+
+@lru_cache(maxsize=None)
+def get_backend():
+    if settings.REALTIME_BACKEND == 'memory':
+        return MemoryPresenceBackend()
+    return RedisPresenceBackend(settings.REALTIME_REDIS_URL)
+
+class PresenceRegistry:
+    """
+    Who currently has a NotificationConsumer connection open.
+    NotificationConsumer registers each connection on connect, refreshes it
+    every PRESENCE_HEARTBEAT_INTERVAL while the socket is open (and on client
+    heartbeats) and drops it on disconnect. Senders ask
+    online_user_ids() for a whole batch of recipients at once.
+    """
+
+    @staticmethod
+    def connect(user_id, channel_name):
+        get_backend().touch(user_id, channel_name, settings.PRESENCE_TTL)
+
+    @staticmethod
+    def heartbeat(user_id, channel_name):
+        get_backend().touch(user_id, channel_name, settings.PRESENCE_TTL)
+
+    @staticmethod
+    def disconnect(user_id, channel_name):
+        get_backend().remove(user_id, channel_name)
+
+    @staticmethod
+    def online_user_ids(user_ids):
+        """Return the subset of `user_ids` with at least one live connection."""
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+        return get_backend().online_user_ids(user_ids)
+
+    @staticmethod
+    def is_online(user_id):
+        return user_id in PresenceRegistry.online_user_ids([user_id])
@@ -1,8 +1,8 @@
 from django.contrib.auth.models import User
 from rest_framework import serializers
 from .models import (
-    Profile, Interest, FriendRequest, Community, CommunityMembership, 
-    StoryItem, StoryPost, Conversation, Message, MessageReadStatus, 
+    Profile, FriendRequest, Community, 
+    StoryItem, StoryPost, StoryUpload, Conversation, Message, 
     UserEncryptionKey, ConversationParticipant
 )
 
@@ -118,11 +118,25 @@ class FriendRequestSerializer(serializers.ModelSerializer):
         fields = ['id', 'from_user', 'to_user', 'status', 'created_at']
         read_only_fields = ['from_user', 'status', 'created_at']
 
+class FriendRequestInboxSerializer(serializers.ModelSerializer):
+    # The inbox shows who sent each request, so the sender is nested with their avatar
+    from_user = UserSerializer(read_only=True)
+    from_user_avatar = serializers.ImageField(source='from_user.profile.avatar', read_only=True)
+
+    class Meta:
+        model = FriendRequest
+        fields = ['id', 'from_user', 'from_user_avatar', 'status', 'created_at']
+        read_only_fields = fields
+
+class FriendRequestBulkActionSerializer(serializers.Serializer):
+    # Ids of the friend requests to accept or reject in one call
+    ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1), allow_empty=False, max_length=100
+    )
+
 class CommunitySerializer(serializers.ModelSerializer):
     # We add a read-only field to show the creator's username
     created_by = serializers.StringRelatedField(read_only=True)
-    # We also add a simple member count for display on the frontend
-    member_count = serializers.SerializerMethodField(read_only=True)
 
     class Meta:
         model = Community
@@ -130,17 +144,29 @@ class CommunitySerializer(serializers.ModelSerializer):
             'id', 'name', 'profile_image', 'description', 'created_by', 
             'created_at', 'is_channel', 'member_count'
         ]
+        # Maintained by CommunityViewSet, never set by clients
+        read_only_fields = ['member_count']
 
-    def get_member_count(self, obj):
-        """Returns the number of members in the community."""
-        return obj.members.count()
+class CommunityBulkJoinSerializer(serializers.Serializer):
+    # Users to import into the community, and the role they all get
+    user_ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1), allow_empty=False, max_length=1000
+    )
+    role = serializers.ChoiceField(choices=['member', 'moderator'], default='member')
+
+class CommunityDirectorySerializer(CommunitySerializer):
+    # Annotated by CommunityViewSet.directory, so no per-row membership lookup
+    is_member = serializers.BooleanField(read_only=True)
+
+    class Meta(CommunitySerializer.Meta):
+        fields = CommunitySerializer.Meta.fields + ['is_member']
     
 class StoryItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = StoryItem
         # Make status read-only, as it's controlled by the server process
-        fields = ['id', 'media_file', 'media_type', 'duration_seconds', 'status']
-        read_only_fields = ['status', 'duration_seconds']
+        fields = ['id', 'media_file', 'media_type', 'duration_seconds', 'status', 'thumbnail']
+        read_only_fields = ['status', 'duration_seconds', 'thumbnail']
 
 
 class StoryPostSerializer(serializers.ModelSerializer):
@@ -153,6 +179,47 @@ class StoryPostSerializer(serializers.ModelSerializer):
         model = StoryPost
         fields = ['id', 'sender', 'created_at', 'items', 'viewers']
 
+# Resumable Story Upload Serializer (init / status of a chunked upload)
+class StoryUploadSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = StoryUpload
+        fields = [
+            'id', 'filename', 'media_type', 'total_size', 'received_bytes',
+            'start_time', 'end_time', 'status', 'story_post', 'created_at', 'updated_at'
+        ]
+        read_only_fields = ['id', 'received_bytes', 'status', 'story_post', 'created_at', 'updated_at']
+    
+    def validate_filename(self, value):
+        """Keep only a safe base name; the path on disk is chosen by the server."""
+        import os
+        from django.core.exceptions import SuspiciousFileOperation
+        from django.utils.text import get_valid_filename
+        try:
+            return get_valid_filename(os.path.basename(value))
+        except SuspiciousFileOperation:
+            raise serializers.ValidationError("Invalid file name.")
+    
+    def validate_total_size(self, value):
+        """Reject empty files and anything larger than the configured limit."""
+        from django.conf import settings
+        if value <= 0:
+            raise serializers.ValidationError("total_size must be greater than zero.")
+        if value > settings.STORY_UPLOAD_MAX_BYTES:
+            raise serializers.ValidationError(
+                f"total_size cannot exceed {settings.STORY_UPLOAD_MAX_BYTES} bytes."
+            )
+        return value
+    
+    def validate(self, attrs):
+        """Apply the same trimming rules as a single-request story upload."""
+        start_time = attrs.get('start_time')
+        end_time = attrs.get('end_time')
+        if attrs.get('media_type') != 'video' or start_time is None or end_time is None:
+            attrs['start_time'], attrs['end_time'] = None, None
+        elif (end_time - start_time) > 30.5:
+            raise serializers.ValidationError("Duration cannot exceed 30 seconds.")
+        return attrs
+
 # User Encryption Key Serializer
 class UserEncryptionKeySerializer(serializers.ModelSerializer):
     user = serializers.StringRelatedField(read_only=True)
@@ -207,6 +274,8 @@ class MessageSerializer(serializers.ModelSerializer):
     
     def get_is_read(self, obj):
         """Check if current user has read this message"""
+        if hasattr(obj, 'is_read'):  # Annotated by MessageService.with_read_state
+            return obj.is_read
         request = self.context.get('request')
         if request and request.user.is_authenticated:
             return obj.read_by.filter(id=request.user.id).exists()
@@ -214,6 +283,8 @@ class MessageSerializer(serializers.ModelSerializer):
     
     def get_read_count(self, obj):
         """Get count of users who have read this message"""
+        if hasattr(obj, 'read_count'):
+            return obj.read_count
         return obj.read_by.count()
 
 # Create Message Serializer (for sending new messages)
@@ -242,6 +313,11 @@ class CreateMessageSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError(f"Media file is required for {message_type} messages")
         
         return attrs
+    
+    def create(self, validated_data):
+        # Plain text only exists to be encrypted; it is never stored on the model
+        validated_data.pop('content', None)
+        return super().create(validated_data)
 
 # Conversation Serializer
 class ConversationSerializer(serializers.ModelSerializer):
@@ -0,0 +1,124 @@
+# api/signals.py
+
+import logging
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import (
+    Profile, FriendRequest, StoryPost, StoryItem, Conversation, Message,
+    MessageReadStatus, CommunityMembership
+)
+from .media_store import MediaStore
+from .cache import ResponseCache
+from .friend_graph import FriendGraph
+
+logger = logging.getLogger(__name__)
+
+def _delete_owned_media(instance, *field_names):
+    """Delete files that belong only to `instance`, then release its shared blob."""
+    for name in MediaStore.owned_files(instance, *field_names):
+        try:
+            default_storage.delete(name)
+        except Exception as e:
+            logger.error(f"Failed to delete media file {name}: {e}")
+    MediaStore.release(instance.blob_id)
+
+@receiver(post_delete, sender=StoryItem)
+def release_story_item_media(sender, instance, **kwargs):
+    """Drop the story item's reference on its media blob."""
+    _delete_owned_media(instance, 'media_file', 'thumbnail')
+
+@receiver(post_delete, sender=Message)
+def release_message_media(sender, instance, **kwargs):
+    """Drop the message's reference on its media blob."""
+    _delete_owned_media(instance, 'media_file')
+
+# --- Response cache invalidation (api/cache.py) ---
+# Writes that bypass these signals (queryset updates, bulk_create) call
+# ResponseCache.invalidate_on_commit themselves.
+
+invalidate_responses = ResponseCache.invalidate_on_commit
+
+def invalidate_story_feeds(sender_id):
+    """A user's stories appear in their own feed and in every friend's."""
+    if sender_id is not None:
+        invalidate_responses(['stories'], FriendGraph.friend_ids(sender_id) | {sender_id})
+
+@receiver([post_save, post_delete], sender=Profile)
+def profile_changed(sender, instance, **kwargs):
+    invalidate_responses(['profile', 'discovery'], [instance.user_id])
+
+@receiver([post_save, post_delete], sender=FriendRequest)
+def friend_request_changed(sender, instance, **kwargs):
+    invalidate_responses(['friend_requests', 'discovery'], [instance.from_user_id, instance.to_user_id])
+
+@receiver([post_save, post_delete], sender=StoryPost)
+def story_post_changed(sender, instance, **kwargs):
+    invalidate_story_feeds(instance.sender_id)
+
+@receiver(post_save, sender=StoryItem)
+def story_item_changed(sender, instance, created, **kwargs):
+    # Processing updates the item's status and media in the feed
+    if not created:
+        invalidate_story_feeds(StoryPost.objects.filter(pk=instance.post_id).values_list('sender_id', flat=True).first())
+
+@receiver(post_save, sender=Message)
+def message_saved(sender, instance, **kwargs):
+    # New, edited and (soft) deleted messages change every participant's conversation list
+    invalidate_responses(['conversations'], Conversation.participants.through.objects.filter(
+        conversation_id=instance.conversation_id
+    ).values_list('user_id', flat=True))
+
+@receiver(post_save, sender=MessageReadStatus)
+def message_read(sender, instance, created, **kwargs):
+    # Unread counts in the reader's conversation list
+    if created:
+        invalidate_responses(['conversations'], [instance.user_id])
+
+@receiver(m2m_changed, sender=Conversation.participants.through)
+def conversation_participants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove') and not reverse and pk_set:
+        # Other participants' conversation lists show the new member list
+        Conversation.objects.filter(pk=instance.pk).update(updated_at=timezone.now())
+        invalidate_responses(['conversations'], pk_set)
+
+@receiver([post_save, post_delete], sender=CommunityMembership)
+def community_membership_changed(sender, instance, **kwargs):
+    invalidate_responses(['communities', 'conversations'], [instance.user_id])
+
+# --- Friend graph invalidation (api/friend_graph.py) ---
+# views.create_friendships bulk-inserts friendships and invalidates on its own;
+# these cover every other change to Profile.friends (admin, shell, unfriending,
+# deleting a profile or its user).
+
+def friends_changed(user_ids):
+    """Drop cached friend sets, and the responses built from them, once the write commits."""
+    user_ids = set(user_ids)
+    transaction.on_commit(lambda: FriendGraph.invalidate(*user_ids))
+    invalidate_responses(['profile', 'discovery', 'stories'], user_ids)
+
+@receiver(m2m_changed, sender=Profile.friends.through)
+def profile_friends_changed(sender, instance, action, pk_set, **kwargs):
+    if action == 'pre_clear':
+        # The relation is symmetrical, so every former friend changes too
+        instance._cleared_friend_ids = set(instance.friends.values_list('pk', flat=True))
+        return
+    if action == 'post_clear':
+        pk_set = instance.__dict__.pop('_cleared_friend_ids', set())
+    elif action not in ('post_add', 'post_remove'):
+        return
+    if not pk_set:
+        return
+    profiles = Profile.objects.filter(pk__in=set(pk_set) | {instance.pk})  # type: ignore
+    # The friends list is part of the profile's version stamp
+    profiles.update(updated_at=timezone.now())
+    friends_changed(profiles.values_list('user_id', flat=True))
+
+@receiver(pre_delete, sender=Profile)
+def profile_deleting(sender, instance, **kwargs):
+    # The delete cascades to the friendship rows without sending m2m_changed,
+    # and they are gone by post_delete
+    friends_changed(set(instance.friends.values_list('user_id', flat=True)) | {instance.user_id})
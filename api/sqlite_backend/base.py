@@ -0,0 +1,19 @@
+# api/sqlite_backend/base.py
+
+from django.conf import settings
+from django.db.backends.sqlite3 import base
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    SQLite backend whose transactions take the write lock when they begin
+    (BEGIN IMMEDIATE, Django 5.1's transaction_mode='IMMEDIATE'). A deferred
+    transaction that reads and then writes can't wait for the lock under WAL:
+    if another writer committed in between, SQLite fails the upgrade with
+    "database is locked" at once instead of honouring the busy timeout.
+    """
+
+    def _start_transaction_under_autocommit(self):
+        if getattr(settings, 'SQLITE_IMMEDIATE_TRANSACTIONS', True):
+            self.cursor().execute('BEGIN IMMEDIATE')
+        else:
+            super()._start_transaction_under_autocommit()
@@ -1,16 +1,51 @@
 # api/tasks.py
 
 from celery import shared_task
+from celery.exceptions import Retry, SoftTimeLimitExceeded
 import ffmpeg
+import io
 import os
+from PIL import Image, ImageOps
 from django.conf import settings
 import logging
+from datetime import timedelta
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
+from django.db import transaction
 from django.utils import timezone
 
+from .friend_graph import FriendGraph
+from .presence import PresenceRegistry
+from .notifications import NotificationLog
+
 logger = logging.getLogger(__name__)
 
+def log_notification(user_ids, event_payload):
+    """
+    Append the event to every recipient's notification log and return
+    {user_id: event stamped with that user's seq} for the recipients that are
+    online. Offline users get it replayed from the log when they reconnect.
+    If presence can't be checked, everyone is treated as online.
+    """
+    # Keep the original send time so replayed notifications sort correctly
+    event_payload = {**event_payload, 'timestamp': timezone.now().isoformat()}
+    try:
+        seqs = NotificationLog.append(user_ids, event_payload)
+    except Exception as e:
+        logger.error(f"Failed to log {event_payload.get('notification_type')} for {len(user_ids)} users: {e}")
+        seqs = {}
+    
+    try:
+        online_ids = PresenceRegistry.online_user_ids(user_ids)
+    except Exception as e:
+        logger.error(f"Presence lookup failed, sending to all {len(user_ids)} recipients: {e}")
+        online_ids = set(user_ids)
+    
+    return {
+        user_id: {**event_payload, 'seq': seqs.get(user_id)}
+        for user_id in user_ids if user_id in online_ids
+    }
+
 # This helper function is perfect.
 def send_websocket_notification(user_id, notification_type, message, data=None):
     try:
@@ -24,95 +59,243 @@ def send_websocket_notification(user_id, notification_type, message, data=None):
             'data': data or {},
         }
 
-        async_to_sync(channel_layer.group_send)(user_group, event_payload)
+        online_events = log_notification([user_id], event_payload)
+        if user_id not in online_events:
+            logger.info(f"User {user_id} is offline, {notification_type} notification kept for replay")
+            return
+
+        async_to_sync(channel_layer.group_send)(user_group, online_events[user_id])
         logger.info(f"WebSocket notification sent to user {user_id}: {notification_type}")
     except Exception as e:
         logger.error(f"Failed to send WebSocket notification to user {user_id}: {e}")
 
+def generate_story_thumbnail(source_path, media_type, duration=None):
+    """
+    Render a small JPEG preview for a story item so trays and feeds don't
+    have to download the full media file.
+    Videos get a poster frame grabbed with ffmpeg, images are downscaled directly.
+    Returns the file name relative to MEDIA_ROOT, or None if generation failed.
+    """
+    filename = os.path.splitext(os.path.basename(source_path))[0]
+    thumbnail_name = os.path.join('story_thumbnails', f"{filename}_thumb.jpg")
+    thumbnail_path = os.path.join(settings.MEDIA_ROOT, thumbnail_name)
+
+    try:
+        if media_type == 'video':
+            # Grab the poster frame early in the clip, but never past its midpoint
+            seek = settings.STORY_POSTER_FRAME_SECONDS
+            if duration:
+                seek = min(seek, duration / 2)
+            frame, _ = (
+                ffmpeg.input(source_path, ss=seek)
+                .output('pipe:', vframes=1, format='image2', vcodec='png')
+                .run(capture_stdout=True, capture_stderr=True)
+            )
+            image = Image.open(io.BytesIO(frame))
+        else:
+            image = Image.open(source_path)
+            # Respect camera orientation before we throw the EXIF data away
+            image = ImageOps.exif_transpose(image)
+
+        image.thumbnail(settings.STORY_THUMBNAIL_MAX_SIZE)
+        os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+        image.convert('RGB').save(
+            thumbnail_path, 'JPEG', quality=settings.STORY_THUMBNAIL_QUALITY, optimize=True
+        )
+        logger.info(f"[StoryProcess] Thumbnail written to {thumbnail_path}")
+        return thumbnail_name
+    except Exception as e:
+        # A missing preview should never fail the story itself
+        logger.error(f"[StoryProcess] Failed to generate thumbnail for {source_path}: {e}")
+        return None
+
 def notify_friends_new_story(story_post):
     """
-    Notify all friends when a user posts a new story
+    Notify all friends when a user posts a new story.
+    The payload is built once and the recipients are delivered in chunks by
+    fan_out_notification, so the queries here don't grow with the friend count.
     """
     try:
-        from .models import Profile
+        sender = story_post.sender
+        sender_profile = sender.profile
+        recipient_ids = list(FriendGraph.friend_ids(sender.id))
         
-        sender_profile = story_post.sender.profile
-        friends = sender_profile.friends.all()
+        if not recipient_ids:
+            logger.info(f"No friends to notify about story {story_post.id}")
+            return
         
         # Get the first story item for preview
         first_item = story_post.items.first()
         
-        logger.info(f"Notifying {friends.count()} friends about new story from {story_post.sender.username}")
+        message = f'{sender.username} posted a new story'
+        data = {
+            'story_id': story_post.id,
+            'sender_id': sender.id,
+            'sender_username': sender.username,
+            'sender_avatar': sender_profile.avatar.url if sender_profile.avatar else None,
+            'media_type': first_item.media_type if first_item else 'unknown',
+            'thumbnail': first_item.thumbnail.url if first_item and first_item.thumbnail else None,
+            'created_at': story_post.created_at.isoformat(),
+            'expires_at': (story_post.created_at + timezone.timedelta(hours=24)).isoformat() if story_post.created_at else None
+        }
         
-        for friend_profile in friends:
-            try:
-                # Send notification to each friend
-                send_websocket_notification(
-                    user_id=friend_profile.user.id,
-                    notification_type='friend_new_story',
-                    message=f'{story_post.sender.username} posted a new story',
-                    data={
-                        'story_id': story_post.id,
-                        'sender_id': story_post.sender.id,
-                        'sender_username': story_post.sender.username,
-                        'sender_avatar': story_post.sender.profile.avatar.url if story_post.sender.profile.avatar else None,
-                        'media_type': first_item.media_type if first_item else 'unknown',
-                        'created_at': story_post.created_at.isoformat(),
-                        'expires_at': (story_post.created_at + timezone.timedelta(hours=24)).isoformat() if story_post.created_at else None
-                    }
-                )
-            except Exception as e:
-                logger.error(f"Failed to notify friend {friend_profile.user.username} about story: {e}")
+        chunk_size = settings.NOTIFICATION_FANOUT_CHUNK_SIZE
+        for start in range(0, len(recipient_ids), chunk_size):
+            fan_out_notification.delay(
+                recipient_ids[start:start + chunk_size], 'friend_new_story', message, data
+            )
                 
-        logger.info(f"Story notifications sent successfully for story {story_post.id}")
+        logger.info(f"Queued story notifications for {len(recipient_ids)} friends of {sender.username} (story {story_post.id})")
     except Exception as e:
         logger.error(f"Failed to notify friends about new story {story_post.id}: {e}")
 
 @shared_task
+def fan_out_notification(user_ids, notification_type, message, data=None):
+    """
+    Deliver one prebuilt notification to a chunk of users.
+    Every recipient gets it in their notification log; the group sends to the
+    ones online share a single event loop round trip.
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    
+    event_payload = {
+        'type': 'send_notification',
+        'notification_type': notification_type,
+        'message': message,
+        'data': data or {},
+    }
+    online_events = log_notification(user_ids, event_payload)
+    
+    async def send_all():
+        delivered = 0
+        for user_id, event in online_events.items():
+            try:
+                await channel_layer.group_send(f"user_{user_id}", event)
+                delivered += 1
+            except Exception as e:
+                logger.error(f"Failed to send {notification_type} notification to user {user_id}: {e}")
+        return delivered
+    
+    delivered = async_to_sync(send_all)()
+    logger.info(
+        f"Fan-out of {notification_type} delivered to {delivered}/{len(user_ids)} users, "
+        f"{len(user_ids) - len(online_events)} offline"
+    )
+
+def claim_blob_rendition(blob):
+    """
+    Claim the job of producing `blob`'s untrimmed rendition. Returns the
+    up-to-date blob (with processed_file set if the rendition already exists),
+    or None while another task's claim is still live.
+    """
+    from .models import MediaBlob
+    with transaction.atomic():
+        blob = MediaBlob.objects.select_for_update().get(pk=blob.pk)  # type: ignore
+        if blob.processed_file:
+            return blob
+        # A claim older than the hard time limit belongs to a killed worker
+        live_after = timezone.now() - timedelta(seconds=settings.MEDIA_TASK_TIME_LIMIT)
+        if blob.processing_started_at and blob.processing_started_at > live_after:
+            return None
+        blob.processing_started_at = timezone.now()
+        blob.save(update_fields=['processing_started_at'])
+        return blob
+
+@shared_task(
+    soft_time_limit=settings.MEDIA_TASK_SOFT_TIME_LIMIT,
+    time_limit=settings.MEDIA_TASK_TIME_LIMIT,
+    acks_late=True,
+)
 def process_story_media(story_item_id, user_id, start_time=None, end_time=None):
-    from .models import StoryItem
+    from .models import MediaBlob, StoryItem
     story_item = None
+    claimed_blob = None
     
     try:
-        story_item = StoryItem.objects.get(id=story_item_id)
+        story_item = StoryItem.objects.select_related('blob').get(id=story_item_id)
         logger.info(f"[StoryProcess] Loaded StoryItem {story_item.id} for user {user_id}")
 
-        input_path = story_item.media_file.path
-        input_dir = os.path.dirname(input_path)
-        filename, ext = os.path.splitext(os.path.basename(input_path))
-        output_filename = f"{filename}_processed{ext}"
-        output_path = os.path.join(input_dir, output_filename)
-        final_duration = 5.0 
+        # Blob-backed sources are shared by every upload of the same content,
+        # so they are never renamed or deleted here.
+        blob = story_item.blob
+        shared_input = blob is not None
+        untrimmed = start_time is None and end_time is None
+        input_path = None
+
+        if shared_input and untrimmed:
+            blob = claim_blob_rendition(blob)
+            if blob is None:
+                logger.info(f"[StoryProcess] Blob of story item {story_item.id} is being processed, retrying later")
+                raise process_story_media.retry(countdown=settings.MEDIA_RENDITION_RETRY_SECONDS, max_retries=None)
+            if not blob.processed_file:
+                claimed_blob = blob
+
+        if shared_input and untrimmed and blob.processed_file:
+            # Same content was processed before: reuse that rendition instead of transcoding
+            logger.info(f"[StoryProcess] Reusing processed rendition of blob {blob.sha256[:12]}")
+            story_item.media_file.name = blob.processed_file.name
+            story_item.thumbnail.name = blob.thumbnail.name if blob.thumbnail else None
+            final_duration = blob.processed_duration or 5.0
+        else:
+            input_path = story_item.media_file.path
+            input_dir = os.path.dirname(input_path)
+            filename, ext = os.path.splitext(os.path.basename(input_path))
+            if shared_input and not untrimmed:
+                # Trimmed renditions belong to this story item alone
+                filename = f"{filename}_{story_item.id}"
+            output_filename = f"{filename}_processed{ext}"
+            output_path = os.path.join(input_dir, output_filename)
+            final_duration = 5.0 
+
+            logger.info(f"[StoryProcess] Processing {story_item.media_type}: {input_path}")
+
+            if story_item.media_type == 'video':
+                stream = ffmpeg.input(input_path)
+                
+                if start_time is not None and end_time is not None:
+                    stream = ffmpeg.trim(stream, start=start_time, end=end_time)
+                else:
+                    probe = ffmpeg.probe(input_path)
+                    duration = float(probe['format']['duration'])
+                    if duration > 30.0:
+                        stream = ffmpeg.trim(stream, start=0, end=30)
+                
+                stream = ffmpeg.output(stream, output_path).overwrite_output()
+                # We add a capture_stderr=True to see ffmpeg's internal errors if any occur
+                stdout, stderr = ffmpeg.run(stream, capture_stdout=True, capture_stderr=True)
+                logger.info(f"FFmpeg stdout: {stdout.decode()}")
+                logger.error(f"FFmpeg stderr: {stderr.decode()}")
 
-        logger.info(f"[StoryProcess] Processing {story_item.media_type}: {input_path}")
 
-        if story_item.media_type == 'video':
-            stream = ffmpeg.input(input_path)
+                final_probe = ffmpeg.probe(output_path)
+                final_duration = float(final_probe['format']['duration'])
             
-            if start_time is not None and end_time is not None:
-                stream = ffmpeg.trim(stream, start=start_time, end=end_time)
-            else:
-                probe = ffmpeg.probe(input_path)
-                duration = float(probe['format']['duration'])
-                if duration > 30.0:
-                    stream = ffmpeg.trim(stream, start=0, end=30)
+            elif story_item.media_type == 'image':
+                if shared_input:
+                    # Images aren't transformed, so the stored upload is the rendition
+                    output_path, output_filename = input_path, os.path.basename(input_path)
+                else:
+                    os.rename(input_path, output_path)
             
-            stream = ffmpeg.output(stream, output_path).overwrite_output()
-            # We add a capture_stderr=True to see ffmpeg's internal errors if any occur
-            stdout, stderr = ffmpeg.run(stream, capture_stdout=True, capture_stderr=True)
-            logger.info(f"FFmpeg stdout: {stdout.decode()}")
-            logger.error(f"FFmpeg stderr: {stderr.decode()}")
+            thumbnail_name = generate_story_thumbnail(output_path, story_item.media_type, final_duration)
 
+            new_model_path = os.path.join(os.path.dirname(story_item.media_file.name), output_filename)
+            story_item.media_file.name = new_model_path
+            if thumbnail_name:
+                story_item.thumbnail.name = thumbnail_name
+
+            if shared_input and untrimmed:
+                # Remember the rendition so the next upload of this content skips the work
+                blob.processed_file.name = new_model_path
+                blob.thumbnail.name = thumbnail_name
+                blob.processed_duration = final_duration
+                blob.processing_started_at = None
+                blob.save(update_fields=['processed_file', 'thumbnail', 'processed_duration', 'processing_started_at'])
+                claimed_blob = None
 
-            final_probe = ffmpeg.probe(output_path)
-            final_duration = float(final_probe['format']['duration'])
-        
-        elif story_item.media_type == 'image':
-            os.rename(input_path, output_path)
-        
         logger.info("[StoryProcess] Media processing complete. Updating database.")
-        new_model_path = os.path.join(os.path.dirname(story_item.media_file.name), output_filename)
-        story_item.media_file.name = new_model_path
         story_item.status = 'complete'
         story_item.duration_seconds = final_duration
         story_item.save()
@@ -122,19 +305,30 @@ def process_story_media(story_item_id, user_id, start_time=None, end_time=None):
             user_id=user_id,
             notification_type='story_processing_complete',
             message=f'Your {story_item.media_type} story is ready!',
-            data={ 'story_id': story_item.post.id, 'status': 'complete' }
+            data={
+                'story_id': story_item.post.id,
+                'status': 'complete',
+                'thumbnail': story_item.thumbnail.url if story_item.thumbnail else None
+            }
         )
         
         # Notify friends about the new story
         notify_friends_new_story(story_item.post)
 
-        if os.path.exists(input_path):
+        if not shared_input and input_path and os.path.exists(input_path):
              os.remove(input_path)
 
+    except Retry:
+        raise
     # ============================================
     # ===== CRITICAL ERROR LOGGING (START) =======
     # ============================================
     except Exception as e:
+        if isinstance(e, SoftTimeLimitExceeded):
+            logger.error(
+                f"[StoryProcess] Story item {story_item_id} exceeded the "
+                f"{settings.MEDIA_TASK_SOFT_TIME_LIMIT}s media time limit"
+            )
         # We will now log the FULL traceback of the error
         logger.exception(f"FATAL ERROR processing story item {story_item_id}:")
         # ============================================
@@ -144,6 +338,9 @@ def process_story_media(story_item_id, user_id, start_time=None, end_time=None):
         if story_item:
             story_item.status = 'error'
             story_item.save()
+        if claimed_blob:
+            # Let the next upload of this content try again
+            MediaBlob.objects.filter(pk=claimed_blob.pk).update(processing_started_at=None)  # type: ignore
 
         send_websocket_notification(
             user_id=user_id,
@@ -0,0 +1,30 @@
+# api/test_runner.py
+
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+from . import notifications, presence
+
+
+class TestRunner(DiscoverRunner):
+    """
+    Runs the whole suite against the in-process realtime backends, so no test
+    needs Redis for presence, the notification log or the channel layer.
+    """
+
+    realtime_settings = {
+        'REALTIME_BACKEND': 'memory',
+        'CHANNEL_LAYERS': {'default': {'BACKEND': 'api.channel_layers.InstrumentedInMemoryChannelLayer'}},
+    }
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.realtime_override = override_settings(**self.realtime_settings)
+        self.realtime_override.enable()
+        # Presence and the notification log pick their backend once per process
+        for get_backend in (presence.get_backend, notifications.get_backend):
+            get_backend.cache_clear()
+
+    def teardown_test_environment(self, **kwargs):
+        self.realtime_override.disable()
+        super().teardown_test_environment(**kwargs)
@@ -1,3 +1,1156 @@
-from django.test import TestCase
+import io
+import json
+import os
+import tempfile
+import time
+import uuid
+import warnings
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock, skipUnless
+from asgiref.sync import sync_to_async
+from celery.exceptions import Retry
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
 
-# Create your tests here.
+from jamii.celery import app as celery_app
+
+from . import fastjson, notifications, presence, tasks
+from .consumers import NotificationConsumer
+from .db_routers import ReplicaRouter, is_pinned_to_primary, pin_to_primary
+from .encryption import EncryptionManager
+from .friend_graph import FriendGraph
+from .metrics import query_budget
+from .renderers import FastJSONRenderer
+from .matching import TravelerMatcher
+from .models import (
+    Community, CommunityMembership, Conversation, ConversationParticipant, FriendRequest,
+    MediaBlob, Message, MessageReadStatus, Profile, StoryItem, StoryPost, StoryUpload, UserEncryptionKey
+)
+from .urls import router
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTests(TransactionTestCase):
+    """
+    Read-replica routing. In tests the 'replica' alias is a mirror of the
+    test database (TEST['MIRROR']), i.e. a second connection to the same data.
+    """
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='amina', password='pass12345')
+        Profile.objects.create(user=self.user, home_country='Kenya', current_country='Germany', current_city='Berlin')
+        self.client = APIClient()
+
+    def queries_by_alias(self, method, path, data=None):
+        # A fresh user per request, as JWT authentication would load it
+        self.client.force_authenticate(User.objects.get(pk=self.user.pk))
+        with CaptureQueriesContext(connections['default']) as default_queries, \
+                CaptureQueriesContext(connections['replica']) as replica_queries:
+            response = getattr(self.client, method)(path, data, format='json')
+        return response, len(default_queries), len(replica_queries)
+
+    def test_router_defaults_to_primary_outside_replica_views(self):
+        router = ReplicaRouter()
+        self.assertIsNone(router.db_for_read(Profile))
+        self.assertEqual(router.db_for_write(Profile), 'default')
+        self.assertFalse(router.allow_migrate('replica', 'api'))
+        self.assertTrue(router.allow_migrate('default', 'api'))
+
+    def test_discovery_reads_from_replica(self):
+        response, default_count, replica_count = self.queries_by_alias('get', '/api/discover/smart-matches/')
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(replica_count, 0)
+        self.assertEqual(default_count, 0)
+
+    def test_my_status_reads_from_replica(self):
+        response, default_count, replica_count = self.queries_by_alias('get', '/api/travel-status/my-status/')
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(replica_count, 0)
+        self.assertEqual(default_count, 0)
+
+    def test_story_feed_and_conversation_list_read_from_replica(self):
+        for path in ('/api/stories/', '/api/conversations/'):
+            response, default_count, replica_count = self.queries_by_alias('get', path)
+            self.assertEqual(response.status_code, 200, path)
+            self.assertGreater(replica_count, 0, path)
+            self.assertEqual(default_count, 0, path)
+
+    def test_friend_graph_loaded_from_replica_is_cached_briefly(self):
+        # Timeout 0: not cached at all, where the hour-long FRIEND_GRAPH_CACHE_TIMEOUT would apply otherwise
+        with override_settings(DATABASE_REPLICA_PIN_SECONDS=0):
+            response, _, replica_count = self.queries_by_alias('get', '/api/stories/')
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(replica_count, 0)
+        self.assertIsNone(cache.get(FriendGraph._key(self.user.id)))
+
+        FriendGraph.friend_ids(self.user.id)
+        self.assertIsNotNone(cache.get(FriendGraph._key(self.user.id)))
+
+    def test_writes_go_to_primary_and_pin_the_writer(self):
+        response, default_count, replica_count = self.queries_by_alias(
+            'post', '/api/travel-status/update-preferences/', {'years_in_current_location': 4}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(default_count, 0)
+        self.assertEqual(replica_count, 0)
+
+        # Read-your-writes: the follow-up read stays on the primary
+        response, default_count, replica_count = self.queries_by_alias('get', '/api/travel-status/my-status/')
+        self.assertEqual(response.data['stats']['years_in_current_location'], 4)
+        self.assertGreater(default_count, 0)
+        self.assertEqual(replica_count, 0)
+
+    def test_pin_is_per_user(self):
+        other = User.objects.create_user(username='otieno', password='pass12345')
+        pin_to_primary(other.id)
+        response, default_count, replica_count = self.queries_by_alias('get', '/api/travel-status/my-status/')
+        self.assertGreater(replica_count, 0)
+        self.assertEqual(default_count, 0)
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_no_replicas_configured(self):
+        response, default_count, replica_count = self.queries_by_alias('get', '/api/discover/smart-matches/')
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(default_count, 0)
+        self.assertEqual(replica_count, 0)
+
+class HotPathIndexTests(TestCase):
+    """
+    EXPLAIN the hot lookups and check the planner picks the index meant for each.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='amina', password='pass12345')
+        cls.profile = Profile.objects.create(
+            user=cls.user, home_country='Kenya', current_country='Germany', current_city='Berlin'
+        )
+        cls.conversation = Conversation.objects.create(conversation_type='private')
+
+    def setUp(self):
+        if connection.vendor == 'postgresql':
+            # The test tables are tiny; make the planner show which index it would use
+            with connection.cursor() as cursor:
+                cursor.execute('SET enable_seqscan = off')
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(index_name, plan, f'{index_name} not used:\n{plan}')
+
+    def test_message_history(self):
+        queryset = self.conversation.messages.filter(is_deleted=False).order_by('-timestamp')[:50]
+        self.assertUsesIndex(queryset, 'message_conv_live_idx')
+
+    def test_story_feed(self):
+        queryset = StoryPost.objects.filter(sender_id__in=[self.user.id, 2, 3]).order_by('-created_at')
+        self.assertUsesIndex(queryset, 'storypost_sender_idx')
+
+    def test_countrymates_nearby(self):
+        self.assertUsesIndex(TravelerMatcher.find_countrymates_nearby(self.profile), 'profile_countrymates_idx')
+
+    def test_local_experts(self):
+        self.assertUsesIndex(TravelerMatcher.find_local_experts(self.profile), 'profile_local_experts_idx')
+
+    def test_pending_friend_requests(self):
+        queryset = FriendRequest.objects.filter(to_user=self.user, status='pending').order_by('-created_at', '-id')
+        self.assertUsesIndex(queryset, 'friendreq_inbox_idx')
+
+class ConditionalCacheTests(TestCase):
+    """ETags from conditional_action must describe the body cached_action serves."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='amina', password='pass12345')
+        Profile.objects.create(user=cls.user, home_country='Kenya', current_country='Germany', current_city='Berlin')
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def get_me(self, **headers):
+        # A fresh user per request, as JWT authentication would load it
+        self.client.force_authenticate(User.objects.get(pk=self.user.pk))
+        return self.client.get('/api/profiles/me/', **headers)
+
+    def test_new_version_is_not_served_a_stale_cached_body(self):
+        first = self.get_me()
+        self.assertEqual(first['X-Cache'], 'MISS')
+        self.assertEqual(self.get_me()['X-Cache'], 'HIT')
+
+        # A write whose cache invalidation hasn't run yet (it waits for on_commit)
+        Profile.objects.filter(user=self.user).update(  # type: ignore
+            current_city='Munich', updated_at=timezone.now() + timedelta(seconds=1)
+        )
+        second = self.get_me(HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(second.status_code, 200)
+        self.assertNotEqual(second['ETag'], first['ETag'])
+        self.assertEqual((second['X-Cache'], second.data['current_city']), ('MISS', 'Munich'))
+
+        self.assertEqual(self.get_me(HTTP_IF_NONE_MATCH=second['ETag']).status_code, 304)
+
+class FastJSONRendererTests(SimpleTestCase):
+    """FastJSONRenderer keeps DRF's wire format."""
+
+    def test_matches_drf_renderer(self):
+        now = timezone.now()
+        data = {
+            'utc': now,
+            'midnight': now.replace(hour=0, minute=0, second=0, microsecond=0),
+            'nairobi': now.astimezone(timezone.get_fixed_timezone(180)),
+            'naive': now.replace(tzinfo=None),
+            'date': now.date(),
+            'duration': timedelta(minutes=90),
+            'amount': Decimal('4.50'),
+            'id': uuid.uuid4(),
+            'name': 'Zürich',
+            7: 'non-string key',
+        }
+        rendered = FastJSONRenderer().render(data)
+        self.assertEqual(rendered, JSONRenderer().render(data))
+        self.assertTrue(json.loads(rendered)['utc'].endswith('Z'))
+
+    @skipUnless(fastjson.BACKEND == 'orjson', 'orjson not installed')
+    def test_nan_renders_as_null(self):
+        # DRF's strict JSON raises on NaN and infinities; orjson writes null
+        with self.assertRaises(ValueError):
+            JSONRenderer().render({'rating': float('nan')})
+        self.assertEqual(FastJSONRenderer().render({'rating': float('nan'), 'max': float('inf')}), b'{"rating":null,"max":null}')
+
+class MediaWorkerProfileTests(SimpleTestCase):
+    """The media@ worker profile, checked on real workers as the CLI builds them."""
+
+    def setUp(self):
+        # The profile writes to the shared app config
+        saved = {key: celery_app.conf[key] for key in (
+            'worker_prefetch_multiplier', 'worker_concurrency', 'task_acks_late'
+        )}
+        self.addCleanup(celery_app.conf.update, saved)
+
+    def build_worker(self, hostname, prefetch_multiplier):
+        # The worker CLI always passes --prefetch-multiplier, defaulting to the conf value
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')  # SecurityWarning when the suite runs as root
+            return celery_app.Worker(
+                hostname=hostname, queues=['media'], pool_cls='solo', quiet=True,
+                redirect_stdouts=False, prefetch_multiplier=prefetch_multiplier,
+            )
+
+    def test_documented_media_command_takes_one_task_per_process(self):
+        worker = self.build_worker('media@test', prefetch_multiplier=1)
+        self.assertEqual(worker.prefetch_multiplier, 1)
+        self.assertEqual(worker.concurrency, settings.MEDIA_WORKER_CONCURRENCY)
+        self.assertTrue(celery_app.conf.task_acks_late)
+
+    def test_media_worker_without_prefetch_flag_warns(self):
+        with self.assertLogs('jamii.celery', 'WARNING') as logs:
+            worker = self.build_worker('media@test', prefetch_multiplier=4)
+        self.assertEqual(worker.prefetch_multiplier, 4)
+        self.assertIn('--prefetch-multiplier=1', logs.output[0])
+
+class TravelStatusNotificationTests(TestCase):
+    """Countrymates hear about travel status changes through queued fan-out chunks."""
+
+    @classmethod
+    def setUpTestData(cls):
+        users = [User.objects.create_user(username=f'traveler{i}', password='pass12345') for i in range(6)]
+        for user in users:
+            Profile.objects.create(user=user, home_country='Kenya', current_country='Germany', current_city='Berlin')
+        cls.user, cls.countrymates = users[0], users[1:]
+
+    @override_settings(NOTIFICATION_FANOUT_CHUNK_SIZE=2)
+    @mock.patch.object(tasks.fan_out_notification, 'delay')
+    def test_fan_out_is_queued_in_chunks(self, delay):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.post('/api/discover/update-travel-status/', {'travel_status': 'traveling'}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+        chunks = [call.args[0] for call in delay.call_args_list]
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+        self.assertEqual(sorted(sum(chunks, [])), sorted(user.id for user in self.countrymates))
+        self.assertEqual({call.args[1] for call in delay.call_args_list}, {'countrymate_traveling_nearby'})
+
+class ConversationMessagesTests(TestCase):
+    """Read state annotated onto message pages, and batched participant adds."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.amina, cls.baraka, cls.chausiku, cls.dalia = [
+            User.objects.create_user(username=name, password='pass12345')
+            for name in ('amina', 'baraka', 'chausiku', 'dalia')
+        ]
+        cls.group = Conversation.objects.create(conversation_type='group', name='Berlin')  # type: ignore
+        cls.group.participants.add(cls.amina, cls.baraka)
+        ConversationParticipant.objects.create(conversation=cls.group, user=cls.amina, role='admin')  # type: ignore
+        ConversationParticipant.objects.create(conversation=cls.group, user=cls.baraka, role='member')  # type: ignore
+        cls.first = Message.objects.create(conversation=cls.group, sender=cls.baraka, encrypted_content='a')  # type: ignore
+        cls.second = Message.objects.create(  # type: ignore
+            conversation=cls.group, sender=cls.baraka, encrypted_content='b', reply_to=cls.first
+        )
+        MessageReadStatus.objects.create(user=cls.amina, message=cls.first)
+        MessageReadStatus.objects.create(user=cls.baraka, message=cls.first)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.get(pk=self.amina.pk))
+
+    def test_message_page_read_state(self):
+        response = self.client.get(f'/api/conversations/{self.group.id}/messages/')
+        self.assertEqual(response.status_code, 200)
+        messages = {message['id']: message for message in response.json()['messages']}
+        self.assertEqual((messages[self.first.id]['is_read'], messages[self.first.id]['read_count']), (True, 2))
+        self.assertEqual((messages[self.second.id]['is_read'], messages[self.second.id]['read_count']), (False, 0))
+        self.assertEqual(messages[self.second.id]['reply_to_message']['sender'], 'baraka')
+
+    def test_add_participants_skips_existing_members(self):
+        response = self.client.post(
+            f'/api/conversations/{self.group.id}/add_participants/',
+            {'user_ids': [self.baraka.id, self.chausiku.id, self.dalia.id, 999999]}, format='json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['added_users'], ['chausiku', 'dalia'])
+        self.assertEqual(
+            set(self.group.participants.values_list('username', flat=True)), {'amina', 'baraka', 'chausiku', 'dalia'}
+        )
+        self.assertEqual(ConversationParticipant.objects.filter(conversation=self.group).count(), 4)  # type: ignore
+        self.assertEqual(Message.objects.filter(conversation=self.group, message_type='system').count(), 2)  # type: ignore
+
+class FriendGraphTests(TestCase):
+    """
+    Mutual friends and suggestions from the cached friend graph, and its
+    invalidation when Profile.friends changes outside the friend request API.
+    Friendships: amina-baraka, amina-chausiku, baraka-dalia, chausiku-dalia;
+    everyone is Kenyan in Berlin, so they are also each other's smart matches.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = {}
+        for name in ('amina', 'baraka', 'chausiku', 'dalia', 'ekene'):
+            user = User.objects.create_user(username=name, password='pass12345')
+            Profile.objects.create(user=user, home_country='Kenya', current_country='Germany', current_city='Berlin')
+            cls.users[name] = user
+        for left, right in (('amina', 'baraka'), ('amina', 'chausiku'), ('baraka', 'dalia'), ('chausiku', 'dalia')):
+            cls.profile(left).friends.add(cls.profile(right))
+
+    @classmethod
+    def profile(cls, name):
+        return Profile.objects.get(user=cls.users[name])  # type: ignore
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.users['amina'])
+
+    def friend_ids(self, name):
+        return FriendGraph.friend_ids(self.users[name].id)
+
+    def ids(self, *names):
+        return {self.users[name].id for name in names}
+
+    def test_mutual_friends_and_suggestions(self):
+        amina, dalia = self.users['amina'], self.users['dalia']
+        self.assertEqual(FriendGraph.mutual_friend_ids(amina.id, dalia.id), self.ids('baraka', 'chausiku'))
+        self.assertEqual(FriendGraph.mutual_friend_count(amina.id, self.users['ekene'].id), 0)
+        self.assertEqual(FriendGraph.suggestions(amina.id), [(dalia.id, 2)])
+
+        suggestions = self.client.get('/api/discover/friend-suggestions/').data['suggestions']
+        self.assertEqual([(s['user']['id'], s['mutual_friend_count']) for s in suggestions], [(dalia.id, 2)])
+
+    def test_smart_matches_count_mutual_friends(self):
+        matches = self.client.get('/api/discover/smart-matches/').data['matches']
+        reasons = {match['user']['id']: match['match_reasons'] for match in matches}
+        self.assertIn('2 mutual friends', reasons[self.users['dalia'].id])
+        for name in ('baraka', 'ekene'):
+            self.assertFalse([reason for reason in reasons[self.users[name].id] if 'mutual' in reason])
+
+    def test_friend_changes_outside_the_api_invalidate_the_graph(self):
+        # Warm the graph and the cached suggestions
+        self.assertEqual(self.friend_ids('amina'), self.ids('baraka', 'chausiku'))
+        self.assertEqual(len(self.client.get('/api/discover/friend-suggestions/').data['suggestions']), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.profile('amina').friends.add(self.profile('dalia'))
+        self.assertEqual(self.friend_ids('amina'), self.ids('baraka', 'chausiku', 'dalia'))
+        self.assertIn(self.users['amina'].id, self.friend_ids('dalia'))
+        self.assertEqual(self.client.get('/api/discover/friend-suggestions/').data['suggestions'], [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.profile('amina').friends.remove(self.profile('baraka'))
+        self.assertNotIn(self.users['amina'].id, self.friend_ids('baraka'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.profile('amina').friends.clear()
+        self.assertEqual(self.friend_ids('amina'), set())
+        self.assertEqual(self.friend_ids('chausiku'), self.ids('dalia'))
+
+    def test_deleting_a_user_invalidates_their_friends(self):
+        self.assertIn(self.users['amina'].id, self.friend_ids('baraka'))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.users['amina'].delete()
+        self.assertEqual(self.friend_ids('baraka'), self.ids('dalia'))
+        self.assertEqual(FriendGraph.suggestions(self.users['baraka'].id), [(self.users['chausiku'].id, 1)])
+
+# Multiplies the seeded data volumes, e.g. JAMII_BUDGET_SCALE=10 for a heavier run
+BUDGET_SCALE = int(os.environ.get('JAMII_BUDGET_SCALE', '1'))
+
+# Known N+1s: requests whose query count still grows with the seeded data,
+# keyed 'METHOD route'. Each budget is today's cost at the seeded sizes, so
+# it holds at any JAMII_BUDGET_SCALE and the route can't get worse. Delete an
+# entry once its route is fixed; settings.QUERY_BUDGETS then applies.
+SCALING_BUDGETS = {
+    'GET profile-list': lambda t: 2 + 3 * t.CITY_PROFILES,
+    'GET friend-request-list': lambda t: 2 + t.PENDING_REQUESTS,
+    'GET story-list': lambda t: 6 + 2 * t.FRIENDS,
+    'GET story-active-users': lambda t: 5 + 2 * t.FRIENDS,
+    'GET conversation-list': lambda t: 17 + 3 * t.CONVERSATIONS,
+    'GET discover-countrymates-nearby': lambda t: 9 + 3 * t.COUNTRYMATES,
+    'GET discover-travel-buddies': lambda t: 3 + t.COUNTRYMATES,
+    # Not per row, but per batch: SQLite splits the read-receipt bulk_create,
+    # and the delete cascade collects memberships 100 at a time
+    'POST message-mark-read': lambda t: 11 + t.CONVERSATION_MESSAGES // 600,
+    'DELETE community-detail': lambda t: 10 + t.COMMUNITY_MEMBERS // 100,
+}
+
+# Milliseconds per request. Generous: these catch gross regressions on a busy
+# CI machine; the query budgets are the tight ones.
+LATENCY_BUDGETS_MS = {
+    'default': 1000,
+    # Known N+1s that serialize every seeded row
+    'profile-list': 12000 * BUDGET_SCALE,
+    'discover-countrymates-nearby': 6000 * BUDGET_SCALE,
+    'discover-travel-buddies': 1000 * BUDGET_SCALE,
+    # Unpaginated: serializes every message in the user's conversations
+    'message-list': 2000 * BUDGET_SCALE,
+}
+
+# (route, method) pairs the harness doesn't call, and why
+UNBUDGETED_ROUTES = {
+    ('profile-list', 'post'): 'ProfileViewSet.create never sets the user (profiles come from profiles/me)',
+    ('conversation-list', 'post'): 'CreateConversationSerializer passes participant_ids on to Conversation()',
+}
+
+def router_routes():
+    """Every (URL name, HTTP method) pair served by the API router."""
+    # DRF adds 'head' to a viewset's actions once it has served a GET; it
+    # mirrors the GET handler, so it isn't budgeted separately
+    return {
+        (url.name, method)
+        for url in router.urls
+        for method in getattr(url.callback, 'actions', {})
+        if method != 'head'
+    }
+
+class TemporaryMediaMixin:
+    """Send uploads and stored media to a throwaway directory for the test class."""
+
+    @classmethod
+    def setUpClass(cls):
+        media_root = tempfile.TemporaryDirectory()
+        cls.addClassCleanup(media_root.cleanup)
+        media_settings = override_settings(
+            MEDIA_ROOT=media_root.name,
+            STORY_UPLOAD_TEMP_DIR=os.path.join(media_root.name, 'story_uploads'),
+        )
+        media_settings.enable()
+        cls.addClassCleanup(media_settings.disable)
+        super().setUpClass()
+
+class QueryBudgetTests(TemporaryMediaMixin, TestCase):
+    """
+    Calls every router endpoint against a seeded dataset (thousands of
+    profiles in one city, a large community, a long conversation) and checks
+    each request's query count against settings.QUERY_BUDGETS and its latency
+    against LATENCY_BUDGETS_MS. Counts must not grow with the data, so a new
+    N+1 shows up here as a blown budget; the ones that already exist are held
+    to their current per-row cost by SCALING_BUDGETS. Run with a larger
+    JAMII_BUDGET_SCALE to check a fix.
+
+    Set QUERY_BUDGET_RESULTS to a file path to write the measurements as JSON;
+    diff it against a previous run's file to spot regressions.
+    """
+
+    CITY_PROFILES = 2000 * BUDGET_SCALE
+    # Every other seeded profile shares the user's home country
+    COUNTRYMATES = CITY_PROFILES // 2
+    FRIENDS = 50 * BUDGET_SCALE
+    COMMUNITY_MEMBERS = 1000 * BUDGET_SCALE
+    COMMUNITIES = 200 * BUDGET_SCALE
+    CONVERSATION_MESSAGES = 2000 * BUDGET_SCALE
+    CONVERSATIONS = 20 * BUDGET_SCALE
+    PENDING_REQUESTS = 30 * BUDGET_SCALE
+
+    @classmethod
+    def setUpTestData(cls):
+        # bulk_create skips signals and hashing, so seeding stays fast
+        User.objects.bulk_create([
+            User(username=f'traveler{i}', password='!') for i in range(cls.CITY_PROFILES)
+        ])
+        users = list(User.objects.order_by('id'))
+        cls.user = users[0]
+        Profile.objects.bulk_create([  # type: ignore
+            Profile(
+                user=user,
+                home_country='Kenya' if i % 2 == 0 else 'Nigeria',
+                home_city='Nairobi' if i % 2 == 0 else 'Lagos',
+                current_country='Germany',
+                current_city='Berlin',
+                travel_status=('traveling', 'resident', 'expat')[i % 3],
+                is_local_expert=i % 10 == 0,
+                helper_rating=(i % 50) / 10,
+                languages_spoken=['English', 'Swahili'] if i % 2 == 0 else ['English'],
+                expertise_areas=['food', 'transportation'],
+            )
+            for i, user in enumerate(users)
+        ])
+        profiles = {profile.user_id: profile for profile in Profile.objects.all()}  # type: ignore
+        cls.profile = profiles[cls.user.id]
+
+        friends = users[1:cls.FRIENDS + 1]
+        cls.friend = friends[0]
+        through = Profile.friends.through
+        through.objects.bulk_create([
+            through(from_profile_id=a.id, to_profile_id=b.id)
+            for friend in friends
+            for a, b in ((cls.profile, profiles[friend.id]), (profiles[friend.id], cls.profile))
+        ])
+        # One real key pair shared by everyone, so messages can be encrypted
+        public_key = EncryptionManager.generate_rsa_key_pair()['public_key']
+        UserEncryptionKey.objects.bulk_create([  # type: ignore
+            UserEncryptionKey(user=user, public_key=public_key)
+            for user in [cls.user, *friends]
+        ])
+
+        # A story with two ready items from each friend
+        StoryPost.objects.bulk_create([StoryPost(sender=friend) for friend in friends])  # type: ignore
+        cls.story = StoryPost.objects.filter(sender=cls.friend).first()  # type: ignore
+        StoryItem.objects.bulk_create([  # type: ignore
+            StoryItem(post=post, media_file=f'story_media/{post.id}_{n}.jpg', media_type='image',
+                      status='complete', thumbnail=f'story_thumbnails/{post.id}_{n}.jpg')
+            for post in StoryPost.objects.all() for n in range(2)  # type: ignore
+        ])
+        cls.own_story = StoryPost.objects.create(sender=cls.user)  # type: ignore
+        StoryItem.objects.create(  # type: ignore
+            post=cls.own_story, media_file='story_media/own.jpg', media_type='image', status='complete'
+        )
+
+        # One upload waiting for its first chunk, one with every byte received
+        os.makedirs(settings.STORY_UPLOAD_TEMP_DIR, exist_ok=True)
+        cls.upload = StoryUpload.objects.create(  # type: ignore
+            user=cls.user, filename='clip.mp4', media_type='video', total_size=1024
+        )
+        cls.received_upload = StoryUpload.objects.create(  # type: ignore
+            user=cls.user, filename='photo.jpg', media_type='image', total_size=1024, received_bytes=1024
+        )
+        open(cls.upload.temp_path, 'wb').close()
+        with open(cls.received_upload.temp_path, 'wb') as partial_file:
+            partial_file.write(os.urandom(1024))
+
+        strangers = users[cls.FRIENDS + 1:]
+        # Not a friend, no pending request, no encryption key
+        cls.stranger = strangers[-1]
+        FriendRequest.objects.bulk_create([  # type: ignore
+            FriendRequest(from_user=sender, to_user=cls.user)
+            for sender in strangers[:cls.PENDING_REQUESTS]
+        ])
+        cls.pending = list(FriendRequest.objects.filter(to_user=cls.user).order_by('id'))  # type: ignore
+
+        # One big community the user runs, plus a long tail for the directory
+        cls.community = Community.objects.create(  # type: ignore
+            name='Kenyans in Berlin', description='Habari!', created_by=cls.user,
+            member_count=cls.COMMUNITY_MEMBERS
+        )
+        CommunityMembership.objects.bulk_create([  # type: ignore
+            CommunityMembership(community=cls.community, user=user, role='admin' if user == cls.user else 'member')
+            for user in users[:cls.COMMUNITY_MEMBERS]
+        ])
+        community_chat = Conversation.objects.create(conversation_type='community', community=cls.community)  # type: ignore
+        community_chat.participants.add(*users[:cls.COMMUNITY_MEMBERS])
+        for i in range(cls.COMMUNITIES):
+            Community(name=f'Community {i:05d}', description='', created_by=users[i % len(users)]).save()
+        cls.other_community = Community.objects.get(name='Community 00000')  # type: ignore
+        CommunityMembership.objects.create(community=cls.other_community, user=cls.friend)  # type: ignore
+        Community.objects.filter(pk=cls.other_community.pk).update(member_count=1)  # type: ignore
+
+        # A long private conversation, a group the user administers and a
+        # handful of other chats for the conversation list
+        cls.conversation = Conversation.objects.create(conversation_type='private')  # type: ignore
+        cls.conversation.participants.add(cls.user, cls.friend)
+        Message.objects.bulk_create([  # type: ignore
+            Message(conversation=cls.conversation, sender=(cls.user, cls.friend)[i % 2], encrypted_content=f'message {i}')
+            for i in range(cls.CONVERSATION_MESSAGES)
+        ])
+        cls.message = Message.objects.filter(conversation=cls.conversation, sender=cls.friend).last()  # type: ignore
+        cls.own_message = Message.objects.filter(conversation=cls.conversation, sender=cls.user).last()  # type: ignore
+        cls.group = Conversation.objects.create(conversation_type='group', name='Berlin trip')  # type: ignore
+        cls.group.participants.add(cls.user, *friends[:5])
+        ConversationParticipant.objects.bulk_create([  # type: ignore
+            ConversationParticipant(conversation=cls.group, user=user, role='admin' if user == cls.user else 'member')
+            for user in [cls.user, *friends[:5]]
+        ])
+        for friend in friends[1:cls.CONVERSATIONS]:
+            chat = Conversation.objects.create(conversation_type='private')  # type: ignore
+            chat.participants.add(cls.user, friend)
+            Message.objects.create(conversation=chat, sender=friend, encrypted_content='hi')  # type: ignore
+
+    def routes(self):
+        """
+        (route name, method, URL kwargs, request body[, options]) for every
+        pair in router_routes(). Options: 'format' for the request body, 'user'
+        to send it as someone else, 'headers' for extra request headers.
+        """
+        friend_ids = sorted(FriendGraph.friend_ids(self.user.id))
+        non_members = list(User.objects.filter(communitymembership__isnull=True).values_list('id', flat=True)[:100])
+        message_body = {'conversation': self.conversation.id, 'message_type': 'text', 'content': 'Habari!'}
+        return [
+            ('profile-list', 'get', {}, None),
+            ('profile-me', 'get', {}, None),
+            ('profile-me', 'put', {}, {'bio': 'Karibu Berlin', 'current_city': 'Berlin'}),
+            ('profile-me', 'patch', {}, {'bio': 'Karibu Berlin'}),
+            ('profile-detail', 'get', {'pk': self.profile.id}, None),
+            ('profile-detail', 'put', {'pk': self.profile.id}, {'bio': 'Karibu Berlin', 'current_city': 'Berlin'}),
+            ('profile-detail', 'patch', {'pk': self.profile.id}, {'bio': 'Karibu Berlin'}),
+            ('profile-detail', 'delete', {'pk': self.profile.id}, None),
+
+            ('friend-request-list', 'get', {}, None),
+            ('friend-request-list', 'post', {}, {'to_user': self.stranger.id}),
+            ('friend-request-pending', 'get', {}, None),
+            ('friend-request-detail', 'get', {'pk': self.pending[0].id}, None),
+            ('friend-request-detail', 'put', {'pk': self.pending[0].id}, {'to_user': self.user.id}),
+            ('friend-request-detail', 'patch', {'pk': self.pending[0].id}, {'to_user': self.user.id}),
+            ('friend-request-detail', 'delete', {'pk': self.pending[0].id}, None),
+            ('friend-request-accept', 'post', {'pk': self.pending[0].id}, None),
+            ('friend-request-reject', 'post', {'pk': self.pending[1].id}, None),
+            ('friend-request-bulk-accept', 'post', {}, {'ids': [r.id for r in self.pending[2:12]]}),
+            ('friend-request-bulk-reject', 'post', {}, {'ids': [r.id for r in self.pending[12:22]]}),
+
+            ('community-list', 'get', {}, None),
+            ('community-list', 'post', {}, {'name': 'Nigerians in Berlin', 'description': 'Welcome'}),
+            ('community-directory', 'get', {}, None),
+            ('community-detail', 'get', {'pk': self.community.id}, None),
+            ('community-detail', 'put', {'pk': self.community.id}, {'name': 'Kenyans in Berlin', 'description': 'Karibu'}),
+            ('community-detail', 'patch', {'pk': self.community.id}, {'description': 'Karibu'}),
+            ('community-detail', 'delete', {'pk': self.community.id}, None),
+            ('community-join', 'post', {'pk': self.other_community.id}, None),
+            ('community-leave', 'post', {'pk': self.other_community.id}, None, {'user': self.friend}),
+            ('community-bulk-join', 'post', {'pk': self.community.id}, {'user_ids': non_members}),
+
+            ('story-list', 'get', {}, None),
+            ('story-list', 'post', {}, {
+                'media_file': SimpleUploadedFile('photo.jpg', os.urandom(2048), content_type='image/jpeg'),
+                'media_type': 'image',
+            }, {'format': 'multipart'}),
+            ('story-me', 'get', {}, None),
+            ('story-active-users', 'get', {}, None),
+            ('story-detail', 'get', {'pk': self.story.id}, None),
+            ('story-detail', 'put', {'pk': self.own_story.id}, {}),
+            ('story-detail', 'patch', {'pk': self.own_story.id}, {}),
+            ('story-detail', 'delete', {'pk': self.own_story.id}, None),
+            ('story-upload-list', 'post', {}, {'filename': 'clip.mp4', 'media_type': 'video', 'total_size': 4096}),
+            ('story-upload-detail', 'get', {'pk': self.upload.id}, None),
+            ('story-upload-chunk', 'put', {'pk': self.upload.id}, os.urandom(1024),
+             {'format': None, 'headers': {'HTTP_CONTENT_RANGE': 'bytes 0-1023/1024', 'content_type': 'application/octet-stream'}}),
+            ('story-upload-complete', 'post', {'pk': self.received_upload.id}, None),
+            ('story-upload-detail', 'delete', {'pk': self.upload.id}, None),
+
+            ('conversation-list', 'get', {}, None),
+            ('conversation-detail', 'get', {'pk': self.conversation.id}, None),
+            ('conversation-detail', 'put', {'pk': self.group.id}, {'conversation_type': 'group', 'name': 'Berlin trip', 'description': 'Summer'}),
+            ('conversation-detail', 'patch', {'pk': self.group.id}, {'description': 'Summer'}),
+            ('conversation-detail', 'delete', {'pk': self.group.id}, None),
+            ('conversation-messages', 'get', {'pk': self.conversation.id}, None),
+            ('conversation-add-participants', 'post', {'pk': self.group.id}, {'user_ids': friend_ids[5:10]}),
+            ('conversation-leave', 'post', {'pk': self.group.id}, None),
+
+            ('message-list', 'get', {}, None),
+            ('message-list', 'post', {}, message_body),
+            ('message-detail', 'get', {'pk': self.message.id}, None),
+            ('message-detail', 'put', {'pk': self.own_message.id}, message_body),
+            ('message-detail', 'patch', {'pk': self.own_message.id}, {'conversation': self.conversation.id}),
+            ('message-detail', 'delete', {'pk': self.own_message.id}, None),
+            ('message-mark-read', 'post', {'pk': self.message.id}, {'conversation': self.conversation.id}),
+            ('message-delete-message', 'post', {'pk': self.own_message.id}, None),
+
+            ('encryption-key-list', 'get', {}, None),
+            ('encryption-key-list', 'post', {}, {'public_key': self.user.encryption_key.public_key}, {'user': self.stranger}),
+            ('encryption-key-detail', 'get', {'pk': self.user.encryption_key.id}, None),
+            ('encryption-key-detail', 'put', {'pk': self.user.encryption_key.id}, {'user': self.user.id, 'public_key': self.user.encryption_key.public_key}),
+            ('encryption-key-detail', 'patch', {'pk': self.user.encryption_key.id}, {'public_key': self.user.encryption_key.public_key}),
+            ('encryption-key-detail', 'delete', {'pk': self.user.encryption_key.id}, None),
+
+            ('discover-countrymates-nearby', 'get', {}, None),
+            ('discover-emergency-network', 'get', {}, None),
+            ('discover-friend-suggestions', 'get', {}, None),
+            ('discover-local-experts', 'get', {}, None),
+            ('discover-location-stats', 'get', {}, None),
+            ('discover-smart-matches', 'get', {}, None),
+            ('discover-travel-buddies', 'get', {}, None),
+            ('discover-update-travel-status', 'post', {}, {'travel_status': 'traveling', 'is_available_to_help': True}),
+            ('travel-status-my-status', 'get', {}, None),
+            ('travel-status-update-preferences', 'post', {}, {'languages_spoken': ['English', 'Swahili', 'German']}),
+        ]
+
+    def measure(self, method, path, data, options):
+        """
+        Make one request, rolled back afterwards so every route sees the
+        seeded data. Returns (response, query count, milliseconds).
+        """
+        # Fresh caches, so every request does its full work
+        cache.clear()
+        user = options.get('user', self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+        request_kwargs = {'format': options.get('format', 'json'), **options.get('headers', {})}
+        queries = []
+
+        def count_query(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        with transaction.atomic():
+            # Counted like MetricsMiddleware does; connection.queries is capped at 9000
+            with connection.execute_wrapper(count_query):
+                started = time.perf_counter()
+                response = getattr(self.client, method)(path, data, **request_kwargs)
+                elapsed_ms = (time.perf_counter() - started) * 1000
+            transaction.set_rollback(True)
+        return response, len(queries), elapsed_ms
+
+    def test_every_route_is_budgeted(self):
+        called = {(name, method) for name, method, *_ in self.routes()}
+        self.assertEqual(router_routes() - called - set(UNBUDGETED_ROUTES), set())
+
+    @mock.patch.object(tasks.fan_out_notification, 'delay')
+    @mock.patch.object(tasks.process_story_media, 'delay')
+    def test_query_and_latency_budgets(self, process_story_media, fan_out_notification):
+        # Real tokens, so authentication's own queries are counted too
+        self.client = APIClient()
+        results = {}
+        for name, method, kwargs, data, *options in self.routes():
+            options = options[0] if options else {}
+            path = reverse(name, kwargs=kwargs)
+            if method == 'get':
+                self.measure(method, path, data, options)  # warm up URL resolving, serializers, etc.
+            response, query_count, elapsed_ms = self.measure(method, path, data, options)
+            request_name = f'{method.upper()} {name}'
+            if request_name in SCALING_BUDGETS:
+                budget = SCALING_BUDGETS[request_name](self)
+            else:
+                budget = query_budget(method.upper(), name)
+            latency_budget = LATENCY_BUDGETS_MS.get(name, LATENCY_BUDGETS_MS['default'])
+            results[request_name] = {
+                'status': response.status_code,
+                'queries': query_count,
+                'query_budget': budget,
+                'known_n_plus_one': request_name in SCALING_BUDGETS,
+                'latency_ms': round(elapsed_ms, 1),
+                'latency_budget_ms': latency_budget,
+            }
+            with self.subTest(route=name, method=method):
+                self.assertLess(response.status_code, 400, getattr(response, 'data', None))
+                self.assertLessEqual(query_count, budget)
+                self.assertLessEqual(elapsed_ms, latency_budget)
+
+        output = os.environ.get('QUERY_BUDGET_RESULTS')
+        if output:
+            with open(output, 'w') as results_file:
+                json.dump({'scale': BUDGET_SCALE, 'routes': results}, results_file, indent=2, sort_keys=True)
+
+
+@mock.patch.object(tasks.process_story_media, 'delay')
+class StoryUploadTests(TemporaryMediaMixin, TestCase):
+    """The resumable upload protocol: chunks, offset conflicts, completion and cleanup."""
+
+    CONTENT = b'0123456789'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='amina', password='pass12345')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def start(self, total_size=len(CONTENT)):
+        response = self.client.post(
+            '/api/story-uploads/', {'filename': 'clip.mp4', 'media_type': 'video', 'total_size': total_size},
+            format='json'
+        )
+        return response
+
+    def put_chunk(self, upload_id, start, data, total_size=len(CONTENT)):
+        return self.client.put(
+            f'/api/story-uploads/{upload_id}/chunk/', data, content_type='application/octet-stream',
+            HTTP_CONTENT_RANGE=f'bytes {start}-{start + len(data) - 1}/{total_size}'
+        )
+
+    def upload_all(self):
+        upload_id = self.start().data['id']
+        self.put_chunk(upload_id, 0, self.CONTENT)
+        return upload_id
+
+    def test_chunks_resume_from_received_bytes(self, delay):
+        upload_id = self.start().data['id']
+        self.assertEqual(self.put_chunk(upload_id, 0, self.CONTENT[:4]).data['received_bytes'], 4)
+
+        # A retried or skipped chunk is refused with the offset to resume from
+        for start in (0, 6):
+            response = self.put_chunk(upload_id, start, self.CONTENT[start:start + 2])
+            self.assertEqual(response.status_code, 409)
+            self.assertEqual(response.data['received_bytes'], 4)
+
+        response = self.client.post(f'/api/story-uploads/{upload_id}/complete/')
+        self.assertEqual(response.status_code, 409)
+
+        self.put_chunk(upload_id, 4, self.CONTENT[4:])
+        self.assertEqual(self.client.get(f'/api/story-uploads/{upload_id}/').data['received_bytes'], 10)
+
+        response = self.client.post(f'/api/story-uploads/{upload_id}/complete/')
+        self.assertEqual(response.status_code, 202)
+        upload = StoryUpload.objects.get(pk=upload_id)  # type: ignore
+        self.assertEqual((upload.status, upload.story_post_id), ('complete', response.data['id']))
+        self.assertFalse(os.path.exists(upload.temp_path))
+        item = StoryItem.objects.get(post_id=response.data['id'])  # type: ignore
+        with item.blob.file.open('rb') as stored:
+            self.assertEqual(stored.read(), self.CONTENT)
+        delay.assert_called_once()
+
+        # A second "complete" must not create another story
+        self.assertEqual(self.client.post(f'/api/story-uploads/{upload_id}/complete/').status_code, 400)
+
+    def test_failed_complete_releases_the_blob(self, delay):
+        delay.side_effect = RuntimeError('broker unavailable')
+        upload_id = self.upload_all()
+
+        response = self.client.post(f'/api/story-uploads/{upload_id}/complete/')
+        self.assertEqual(response.status_code, 500)
+        upload = StoryUpload.objects.get(pk=upload_id)  # type: ignore
+        self.assertEqual(upload.status, 'failed')
+        self.assertFalse(os.path.exists(upload.temp_path))
+        self.assertFalse(StoryPost.objects.exists())  # type: ignore
+        self.assertFalse(MediaBlob.objects.exists())  # type: ignore
+
+        # Retrying reports the failure instead of crashing on the missing file
+        self.assertEqual(self.client.post(f'/api/story-uploads/{upload_id}/complete/').status_code, 400)
+
+    @override_settings(STORY_UPLOAD_MAX_ACTIVE=2)
+    def test_active_uploads_are_capped(self, delay):
+        first = self.start().data['id']
+        self.start()
+        response = self.start()
+        self.assertEqual(response.status_code, 429)
+
+        self.assertEqual(self.client.delete(f'/api/story-uploads/{first}/').status_code, 204)
+        self.assertEqual(self.start().status_code, 201)
+
+    @override_settings(STORY_UPLOAD_MAX_ACTIVE=1)
+    def test_abandoned_uploads_expire(self, delay):
+        stale = StoryUpload.objects.get(pk=self.start().data['id'])  # type: ignore
+        self.put_chunk(stale.id, 0, self.CONTENT[:4])
+        StoryUpload.objects.filter(pk=stale.pk).update(  # type: ignore
+            updated_at=stale.updated_at - timedelta(hours=settings.STORY_UPLOAD_EXPIRY_HOURS + 1)
+        )
+
+        # Starting a new upload expires the user's abandoned one instead of hitting the cap
+        fresh = self.start()
+        self.assertEqual(fresh.status_code, 201)
+        stale.refresh_from_db()
+        self.assertEqual(stale.status, 'expired')
+        self.assertFalse(os.path.exists(stale.temp_path))
+        self.assertEqual(self.put_chunk(stale.id, 4, self.CONTENT[4:]).status_code, 400)
+
+        # The command sweeps old partial files whose session is gone, and nothing else
+        orphan = os.path.join(settings.STORY_UPLOAD_TEMP_DIR, f'{uuid.uuid4()}.part')
+        open(orphan, 'wb').close()
+        old = time.time() - (settings.STORY_UPLOAD_EXPIRY_HOURS + 1) * 3600
+        os.utime(orphan, (old, old))
+        fresh_path = StoryUpload.objects.get(pk=fresh.data['id']).temp_path  # type: ignore
+        os.utime(fresh_path, (old, old))
+        call_command('expire_story_uploads', stdout=open(os.devnull, 'w'))
+        self.assertFalse(os.path.exists(orphan))
+        self.assertTrue(os.path.exists(fresh_path))
+
+@mock.patch.object(tasks.process_story_media, 'delay')
+class MediaStoreTests(TemporaryMediaMixin, TestCase):
+    """Content-addressed story media: dedup, reference counting and processing claims."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='amina', password='pass12345')
+        image = io.BytesIO()
+        Image.new('RGB', (8, 8), 'orange').save(image, 'PNG')
+        cls.image_bytes = image.getvalue()
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def post_story(self):
+        media_file = SimpleUploadedFile('photo.png', self.image_bytes, content_type='image/png')
+        return self.client.post('/api/stories/', {'media_file': media_file, 'media_type': 'image'})
+
+    def test_identical_uploads_share_one_blob(self, delay):
+        first, second = self.post_story(), self.post_story()
+        self.assertEqual((first.status_code, second.status_code), (202, 202))
+
+        blob = MediaBlob.objects.get()  # type: ignore
+        self.assertEqual(blob.ref_count, 2)
+        self.assertEqual(
+            set(StoryItem.objects.values_list('blob_id', flat=True)), {blob.id}  # type: ignore
+        )
+        blob_dir = os.path.dirname(blob.file.path)
+        self.assertEqual(os.listdir(blob_dir), [os.path.basename(blob.file.name)])
+
+    def test_deleting_stories_releases_the_blob(self, delay):
+        first, second = self.post_story(), self.post_story()
+        path = MediaBlob.objects.get().file.path  # type: ignore
+
+        self.assertEqual(self.client.delete(f'/api/stories/{first.data["id"]}/').status_code, 204)
+        self.assertEqual(MediaBlob.objects.get().ref_count, 1)  # type: ignore
+        self.assertTrue(os.path.exists(path))
+
+        self.assertEqual(self.client.delete(f'/api/stories/{second.data["id"]}/').status_code, 204)
+        self.assertFalse(MediaBlob.objects.exists())  # type: ignore
+        self.assertFalse(os.path.exists(path))
+
+    def test_failed_story_create_releases_the_blob(self, delay):
+        delay.side_effect = RuntimeError('broker unavailable')
+        self.assertEqual(self.post_story().status_code, 500)
+        self.assertFalse(StoryPost.objects.exists())  # type: ignore
+        self.assertFalse(MediaBlob.objects.exists())  # type: ignore
+
+    def test_one_task_processes_a_shared_blob(self, delay):
+        first, second = self.post_story(), self.post_story()
+        first_item, second_item = (StoryItem.objects.get(post_id=r.data['id']) for r in (first, second))  # type: ignore
+        blob = MediaBlob.objects.get()  # type: ignore
+        MediaBlob.objects.filter(pk=blob.pk).update(processing_started_at=timezone.now())  # type: ignore
+
+        # Another task is producing the rendition, so this one waits for it
+        with self.assertRaises(Retry):
+            tasks.process_story_media(first_item.id, self.user.id)
+        first_item.refresh_from_db()
+        self.assertEqual(first_item.status, 'pending_upload')
+
+        # A claim outlasting the hard time limit was left by a killed worker
+        MediaBlob.objects.filter(pk=blob.pk).update(  # type: ignore
+            processing_started_at=timezone.now() - timedelta(seconds=settings.MEDIA_TASK_TIME_LIMIT + 1)
+        )
+        tasks.process_story_media(first_item.id, self.user.id)
+        blob.refresh_from_db()
+        self.assertTrue(blob.processed_file)
+        self.assertIsNone(blob.processing_started_at)
+
+        tasks.process_story_media(second_item.id, self.user.id)
+        second_item.refresh_from_db()
+        self.assertEqual((second_item.status, second_item.media_file.name), ('complete', blob.processed_file.name))
+
+class WebSocketCommandTests(TransactionTestCase):
+    """
+    Client commands on NotificationConsumer. TransactionTestCase because the
+    consumer reads the database from worker threads.
+    """
+
+    def setUp(self):
+        cache.clear()
+        # Presence and the notification log pick their backend once per process
+        for get_backend in (presence.get_backend, notifications.get_backend):
+            get_backend.cache_clear()
+            self.addCleanup(get_backend.cache_clear)
+        self.amina = User.objects.create_user(username='amina', password='pass12345')
+        self.baraka = User.objects.create_user(username='baraka', password='pass12345')
+        self.stranger = User.objects.create_user(username='stranger', password='pass12345')
+        public_key = EncryptionManager.generate_rsa_key_pair()['public_key']
+        for user in (self.amina, self.baraka):
+            UserEncryptionKey.objects.create(user=user, public_key=public_key)  # type: ignore
+        self.conversation = Conversation.objects.create(conversation_type='private')  # type: ignore
+        self.conversation.participants.add(self.amina, self.baraka)
+
+    async def connect(self, user, path='/ws/notifications/'):
+        communicator = WebsocketCommunicator(NotificationConsumer.as_asgi(), path)
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        # connection_established, then the (empty) notification replay for users
+        for _ in range(2 if user.is_authenticated else 1):
+            await communicator.receive_json_from()
+        return communicator
+
+    async def receive(self, communicator, frame_type):
+        """Next frame of `frame_type`, skipping unrelated ones (e.g. notifications)."""
+        while True:
+            frame = await communicator.receive_json_from()
+            if frame['type'] == frame_type:
+                return frame
+
+    async def push(self, recipient, event_type, **event):
+        """Deliver a channel layer event to the recipient's connections."""
+        await get_channel_layer().group_send(f'user_{recipient.id}', {'type': event_type, **event})
+
+    async def push_notification(self, user, message):
+        """Log and push a notification, as tasks.fan_out_notification does."""
+        event = {'notification_type': 'general', 'message': message, 'data': {}}
+        seqs = await sync_to_async(notifications.NotificationLog.append)([user.id], event)
+        await self.push(user, 'send_notification', **event, seq=seqs[user.id])
+
+    async def test_send_message_acks_and_delivers(self):
+        amina, baraka = await self.connect(self.amina), await self.connect(self.baraka)
+        await amina.send_json_to({
+            'type': 'send_message', 'conversation_id': self.conversation.id, 'content': 'Habari', 'client_id': 'c1'
+        })
+        ack = await self.receive(amina, 'send_message_ack')
+        self.assertEqual((ack['client_id'], ack['conversation_id']), ('c1', self.conversation.id))
+
+        delivered = await self.receive(baraka, 'new_message')
+        self.assertEqual(delivered['message']['id'], ack['message_id'])
+        # The sender's next reads go to the primary, as after an HTTP write
+        self.assertTrue(is_pinned_to_primary(self.amina.id))
+        self.assertFalse(is_pinned_to_primary(self.baraka.id))
+        await amina.disconnect()
+        await baraka.disconnect()
+
+    async def test_commands_check_participation(self):
+        message = await database_sync_to_async(Message.objects.create)(  # type: ignore
+            conversation=self.conversation, sender=self.amina, message_type='text', encrypted_content='x'
+        )
+        stranger = await self.connect(self.stranger)
+        commands = [
+            ({'type': 'send_message', 'conversation_id': self.conversation.id, 'content': 'Hi', 'client_id': 'c1'},
+             'Message not sent'),
+            ({'type': 'mark_read', 'message_id': message.id}, 'Message not found'),
+            ({'type': 'typing_start', 'conversation_id': self.conversation.id},
+             'You are not a participant in this conversation'),
+        ]
+        for command, error in commands:
+            await stranger.send_json_to(command)
+            frame = await stranger.receive_json_from()
+            self.assertEqual((frame['type'], frame['message']), ('error', error))
+        self.assertEqual(await database_sync_to_async(Message.objects.count)(), 1)  # type: ignore
+        await stranger.disconnect()
+
+        anonymous = await self.connect(AnonymousUser())
+        await anonymous.send_json_to({'type': 'mark_read', 'message_id': message.id})
+        self.assertEqual((await anonymous.receive_json_from())['message'], 'Authentication required')
+        await anonymous.disconnect()
+
+    async def test_mark_read(self):
+        message = await database_sync_to_async(Message.objects.create)(  # type: ignore
+            conversation=self.conversation, sender=self.amina, message_type='text', encrypted_content='x'
+        )
+        baraka = await self.connect(self.baraka)
+        await baraka.send_json_to({'type': 'mark_read', 'message_id': message.id})
+        self.assertEqual(await baraka.receive_json_from(), {'type': 'mark_read_ack', 'message_id': message.id})
+        is_read = database_sync_to_async(
+            MessageReadStatus.objects.filter(user=self.baraka, message=message).exists  # type: ignore
+        )
+        self.assertTrue(await is_read())
+        self.assertTrue(is_pinned_to_primary(self.baraka.id))
+        await baraka.disconnect()
+
+    async def test_typing_is_debounced(self):
+        amina, baraka = await self.connect(self.amina), await self.connect(self.baraka)
+        typing_start = {'type': 'typing_start', 'conversation_id': self.conversation.id}
+        await amina.send_json_to(typing_start)
+        await amina.send_json_to(typing_start)
+        frame = await baraka.receive_json_from()
+        self.assertEqual((frame['type'], frame['user'], frame['is_typing']), ('typing_indicator', 'amina', True))
+        self.assertTrue(await baraka.receive_nothing())
+
+        await amina.send_json_to({'type': 'typing_stop', 'conversation_id': self.conversation.id})
+        await amina.send_json_to({'type': 'typing_stop', 'conversation_id': self.conversation.id})
+        self.assertFalse((await baraka.receive_json_from())['is_typing'])
+        self.assertTrue(await baraka.receive_nothing())
+        self.assertTrue(await amina.receive_nothing())
+        await amina.disconnect()
+        await baraka.disconnect()
+
+    @override_settings(WS_COMMAND_RATE=0.001, WS_COMMAND_BURST=2)
+    async def test_commands_are_rate_limited(self):
+        amina = await self.connect(self.amina)
+        for _ in range(2):
+            await amina.send_json_to({'type': 'ping'})
+            self.assertEqual(await amina.receive_json_from(), {'type': 'pong'})
+
+        await amina.send_json_to({'type': 'ping'})
+        frame = await amina.receive_json_from()
+        self.assertEqual((frame['type'], frame['message']), ('error', 'Rate limit exceeded, slow down'))
+        # Throttled typing updates are dropped silently
+        await amina.send_json_to({'type': 'typing_start', 'conversation_id': self.conversation.id})
+        self.assertTrue(await amina.receive_nothing())
+        await amina.disconnect()
+
+    @override_settings(WS_BATCH_WINDOW_MS=200, WS_BATCH_MAX_FRAMES=100)
+    async def test_batch_flushes_after_window(self):
+        amina = await self.connect(self.amina, '/ws/notifications/?batch=1')
+        await self.push_notification(self.amina, 'one')
+        await self.push_notification(self.amina, 'two')
+        self.assertTrue(await amina.receive_nothing(timeout=0.05))
+
+        frames = await amina.receive_json_from(timeout=1)
+        self.assertEqual([frame['message'] for frame in frames], ['one', 'two'])
+        self.assertTrue(await amina.receive_nothing(timeout=0.3))
+        await amina.disconnect()
+
+    @override_settings(WS_BATCH_WINDOW_MS=60000, WS_BATCH_MAX_FRAMES=3)
+    async def test_batch_flushes_when_full(self):
+        amina = await self.connect(self.amina, '/ws/notifications/?batch=1')
+        for message in ('one', 'two', 'three', 'four'):
+            await self.push_notification(self.amina, message)
+
+        frames = await amina.receive_json_from(timeout=1)
+        self.assertEqual([frame['message'] for frame in frames], ['one', 'two', 'three'])
+        # 'four' waits for the (minute-long) window
+        self.assertTrue(await amina.receive_nothing(timeout=0.1))
+        await amina.disconnect()
+
+    @override_settings(WS_BATCH_WINDOW_MS=200, WS_BATCH_MAX_FRAMES=100)
+    async def test_batch_coalesces_typing_indicators(self):
+        amina = await self.connect(self.amina, '/ws/notifications/?batch=1')
+        typing = {'conversation_id': self.conversation.id, 'user': 'baraka'}
+        await self.push(self.amina, 'typing_indicator', **typing, is_typing=True)
+        await self.push_notification(self.amina, 'one')
+        await self.push(self.amina, 'typing_indicator', **typing, is_typing=False)
+        await self.push(self.amina, 'typing_indicator', **{**typing, 'user': 'chausiku'}, is_typing=True)
+
+        # baraka's newer indicator replaced the buffered one in place
+        frames = await amina.receive_json_from(timeout=1)
+        self.assertEqual(
+            [(frame['type'], frame.get('user'), frame.get('is_typing')) for frame in frames],
+            [('typing_indicator', 'baraka', False), ('notification', None, None), ('typing_indicator', 'chausiku', True)]
+        )
+        await amina.disconnect()
+
+    @override_settings(WS_BATCH_WINDOW_MS=100, WS_BATCH_MAX_FRAMES=100)
+    async def test_disconnect_drops_pending_batch(self):
+        amina = await self.connect(self.amina, '/ws/notifications/?batch=1')
+        await self.push_notification(self.amina, 'one')
+        self.assertTrue(await amina.receive_nothing(timeout=0.02))
+        await amina.disconnect()
+        # The flush timer was cancelled, so nothing is sent once the window passes
+        self.assertTrue(await amina.receive_nothing(timeout=0.3))
+
+        # The dropped notification is replayed on reconnect
+        amina = WebsocketCommunicator(NotificationConsumer.as_asgi(), '/ws/notifications/?batch=1&last_seq=0')
+        amina.scope['user'] = self.amina
+        connected, _ = await amina.connect()
+        self.assertTrue(connected)
+        await amina.receive_json_from()
+        replay = await amina.receive_json_from()
+        self.assertEqual([frame['message'] for frame in replay['notifications']], ['one'])
+        await amina.disconnect()
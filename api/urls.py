@@ -2,7 +2,7 @@
 
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import RegistrationAPIView, ProfileViewSet, FriendRequestViewSet, CommunityViewSet, StoryPostViewSet
+from .views import RegistrationAPIView, CacheStatsAPIView, ProfileViewSet, FriendRequestViewSet, CommunityViewSet, StoryPostViewSet, StoryUploadViewSet
 from .messaging_views import (
     ConversationViewSet, MessageViewSet, UserEncryptionKeyViewSet, PublicKeyAPIView
 )
@@ -15,6 +15,7 @@ router.register(r'profiles', ProfileViewSet, basename='profile')
 router.register(r'friend-requests', FriendRequestViewSet, basename='friend-request')
 router.register(r'communities', CommunityViewSet, basename='community')
 router.register(r'stories', StoryPostViewSet, basename='story')
+router.register(r'story-uploads', StoryUploadViewSet, basename='story-upload')
 
 # Messaging endpoints
 router.register(r'conversations', ConversationViewSet, basename='conversation')
@@ -32,6 +33,9 @@ urlpatterns = [
     # Public key endpoint for encryption
     path('public-keys/', PublicKeyAPIView.as_view(), name='public-keys'),
     
+    # Response cache hit/miss counts (staff only)
+    path('cache-stats/', CacheStatsAPIView.as_view(), name='cache-stats'),
+    
     # Include all the URLs generated by the router
     path('', include(router.urls)),
 ]
\ No newline at end of file
@@ -1,20 +1,29 @@
 from django.contrib.auth.models import User
-from .models import Profile, FriendRequest, Community, CommunityMembership,StoryPost, StoryItem, Conversation, ConversationParticipant
-from .serializers import RegisterSerializer, ProfileSerializer, FriendRequestSerializer, CommunitySerializer,StoryPostSerializer
-from rest_framework import generics, viewsets, permissions, serializers
+from .models import Profile, FriendRequest, Community, CommunityMembership,StoryPost, StoryItem, StoryUpload, Conversation
+from .serializers import RegisterSerializer, ProfileSerializer, FriendRequestSerializer, FriendRequestInboxSerializer, FriendRequestBulkActionSerializer, CommunitySerializer, CommunityDirectorySerializer, CommunityBulkJoinSerializer, StoryPostSerializer, StoryUploadSerializer
+from rest_framework import generics, viewsets, permissions, serializers, mixins
 from rest_framework.exceptions import ValidationError
 from .permissions import IsOwnerOrReadOnly
-from django.db import transaction, models
+from django.db import connection, transaction, models
 from .permissions import IsReceiver, IsCommunityAdminOrReadOnly
 from rest_framework import status
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework.views import APIView
 # Import the tasks module
 from . import tasks
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from .media_store import MediaStore
+from .friend_graph import FriendGraph
+from .pagination import FriendRequestInboxPagination, CommunityDirectoryPagination
+from .communities import CommunityMembershipService
+from .cache import ResponseCache, cached_action
+from .conditional import conditional_action, profile_version
+from .db_routers import ReplicaReadMixin
 from django.utils import timezone
+from django.conf import settings
 import logging
+import os
+import re
 
 logger = logging.getLogger(__name__)
 
@@ -29,6 +38,17 @@ class RegistrationAPIView(generics.CreateAPIView):
     permission_classes = (permissions.AllowAny,)
     serializer_class = RegisterSerializer
 
+# Response cache metrics
+class CacheStatsAPIView(APIView):
+    """
+    Hit/miss counts of the response cache (api/cache.py) in this worker process.
+    GET /api/cache-stats/
+    """
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return Response({'backend': settings.CACHE_BACKEND, 'scopes': ResponseCache.stats()})
+
 # ViewSet for Profile Management
 class ProfileViewSet(viewsets.ModelViewSet):
     """
@@ -41,6 +61,8 @@ class ProfileViewSet(viewsets.ModelViewSet):
     permission_classes = [permissions.IsAuthenticated, IsOwnerOrReadOnly]
     
     @action(detail=False, methods=['get', 'put', 'patch'], url_path='me')
+    @conditional_action(profile_version)
+    @cached_action('profile')
     def me(self, request):
         """
         Get or update the current user's profile.
@@ -100,7 +122,7 @@ class FriendRequestViewSet(viewsets.ModelViewSet):
             raise ValidationError("You cannot send a friend request to yourself.")
 
         # Check if they are already friends
-        if from_user.profile.friends.filter(pk=to_user.profile.pk).exists():
+        if to_user.id in FriendGraph.friend_ids(from_user.id):
              raise ValidationError("You are already friends.")
 
         # Check if a request already exists
@@ -117,117 +139,248 @@ class FriendRequestViewSet(viewsets.ModelViewSet):
         """
         Send real-time notification when a friend request is sent
         """
-        try:
-            channel_layer = get_channel_layer()
-            if channel_layer is not None:
-                user_group = f"user_{to_user.id}"
-                
-                async_to_sync(channel_layer.group_send)(
-                    user_group,
-                    {
-                        'type': 'send_notification',
-                        'notification_type': 'friend_request_received',
-                        'message': f'{from_user.username} sent you a friend request',
-                        'data': {
-                            'friend_request_id': friend_request.id,
-                            'from_user_id': from_user.id,
-                            'from_user_username': from_user.username,
-                            'from_user_avatar': from_user.profile.avatar.url if from_user.profile.avatar else None,
-                            'timestamp': friend_request.created_at.isoformat()
-                        }
-                    }
-                )
-            logger.info(f"Friend request notification sent to user {to_user.id} from {from_user.username}")
-        except Exception as e:
-            logger.error(f"Failed to send friend request notification: {e}")
+        tasks.send_websocket_notification(
+            to_user.id,
+            'friend_request_received',
+            f'{from_user.username} sent you a friend request',
+            {
+                'friend_request_id': friend_request.id,
+                'from_user_id': from_user.id,
+                'from_user_username': from_user.username,
+                'from_user_avatar': from_user.profile.avatar.url if from_user.profile.avatar else None,
+                'timestamp': friend_request.created_at.isoformat()
+            }
+        )
     
     def send_friend_accepted_notification(self, from_user, to_user):
         """
         Send real-time notification when a friend request is accepted
         """
-        try:
-            channel_layer = get_channel_layer()
-            if channel_layer is not None:
-                user_group = f"user_{from_user.id}"
-                
-                async_to_sync(channel_layer.group_send)(
-                    user_group,
-                    {
-                        'type': 'send_notification',
-                        'notification_type': 'friend_request_accepted',
-                        'message': f'{to_user.username} accepted your friend request!',
-                        'data': {
-                            'new_friend_id': to_user.id,
-                            'new_friend_username': to_user.username,
-                            'new_friend_avatar': to_user.profile.avatar.url if to_user.profile.avatar else None,
-                            'timestamp': timezone.now().isoformat()
-                        }
-                    }
-                )
-            logger.info(f"Friend acceptance notification sent to user {from_user.id} from {to_user.username}")
-        except Exception as e:
-            logger.error(f"Failed to send friend acceptance notification: {e}")
+        tasks.send_websocket_notification(
+            from_user.id,
+            'friend_request_accepted',
+            f'{to_user.username} accepted your friend request!',
+            {
+                'new_friend_id': to_user.id,
+                'new_friend_username': to_user.username,
+                'new_friend_avatar': to_user.profile.avatar.url if to_user.profile.avatar else None,
+                'timestamp': timezone.now().isoformat()
+            }
+        )
+    
+    def get_locked_request(self):
+        """
+        Fetch the friend request for this action with its row locked until the
+        surrounding transaction ends, along with both users' profiles.
+        Must be called inside transaction.atomic().
+        """
+        queryset = self.get_queryset().select_for_update(of=('self',)).select_related(
+            'from_user__profile', 'to_user__profile'
+        )
+        friend_request = generics.get_object_or_404(queryset, pk=self.kwargs['pk'])
+        self.check_object_permissions(self.request, friend_request)
+        return friend_request
+    
+    def create_friendships(self, friend_requests):
+        """
+        Befriend the users of each accepted request (with profiles preloaded).
+        The relation is symmetrical, so both directions of every pair go into
+        the through table in a single insert. Must run inside the transaction
+        that marked the requests accepted; the friend graph and the requesters
+        are only told once it commits.
+        """
+        Friendship = Profile.friends.through
+        rows = []
+        for friend_request in friend_requests:
+            from_profile_id = friend_request.from_user.profile.id
+            to_profile_id = friend_request.to_user.profile.id
+            rows.append(Friendship(from_profile_id=from_profile_id, to_profile_id=to_profile_id))
+            rows.append(Friendship(from_profile_id=to_profile_id, to_profile_id=from_profile_id))
+        Friendship.objects.bulk_create(rows, ignore_conflicts=True)
+        # The friends list is part of the profile's version stamp
+        Profile.objects.filter(id__in={row.from_profile_id for row in rows}).update(updated_at=timezone.now())
+        
+        def after_commit():
+            user_ids = set()
+            for friend_request in friend_requests:
+                user_ids.update((friend_request.from_user_id, friend_request.to_user_id))
+            FriendGraph.invalidate(*user_ids)
+            ResponseCache.invalidate(['profile', 'discovery', 'stories'], user_ids)
+            for friend_request in friend_requests:
+                self.send_friend_accepted_notification(friend_request.from_user, friend_request.to_user)
         
+        transaction.on_commit(after_commit)
     
-    @action(detail=True, methods=['post'], permission_classes=[IsReceiver])
-    def accept(self, request, pk=None):
-        """Accept a friend request and send notifications"""
-        friend_request = self.get_object()
+    def claim_pending_requests(self, ids, new_status):
+        """
+        Lock the user's pending received requests among `ids`, move them to
+        `new_status` in one UPDATE and return them with both profiles loaded.
+        Ids that aren't pending requests addressed to the user are left alone.
+        Must be called inside transaction.atomic().
+        """
+        friend_requests = list(
+            FriendRequest.objects.select_for_update(of=('self',)).filter(  # type: ignore
+                pk__in=ids, to_user=self.request.user, status='pending'
+            ).select_related('from_user__profile', 'to_user__profile')
+        )
+        FriendRequest.objects.filter(  # type: ignore
+            pk__in=[friend_request.pk for friend_request in friend_requests]
+        ).update(status=new_status)
+        # The UPDATE sends no signals
+        ResponseCache.invalidate_on_commit(['friend_requests', 'discovery'], {
+            user_id for friend_request in friend_requests
+            for user_id in (friend_request.from_user_id, friend_request.to_user_id)
+        })
+        return friend_requests
+    
+    def bulk_action(self, request, new_status):
+        serializer = FriendRequestBulkActionSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ids = serializer.validated_data['ids']
         
-        if friend_request.status != 'pending':
-            return Response(
-                {'error': 'This friend request has already been actioned.'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
+        with transaction.atomic():
+            friend_requests = self.claim_pending_requests(ids, new_status)
+            if new_status == 'accepted':
+                self.create_friendships(friend_requests)
         
-        # Update friend request status
-        friend_request.status = 'accepted'
-        friend_request.save()
+        processed = {friend_request.id for friend_request in friend_requests}
+        return Response({
+            'status': f'{len(processed)} friend request(s) {new_status}.',
+            new_status: sorted(processed),
+            'skipped': sorted(set(ids) - processed)
+        })
+    
+    @action(detail=False, methods=['get'])
+    @cached_action('friend_requests')
+    def pending(self, request):
+        """
+        Pending friend requests sent to the current user, newest first.
         
-        # Add users as friends
-        from_user_profile = friend_request.from_user.profile
-        to_user_profile = friend_request.to_user.profile
+        GET /api/friend-requests/pending/?cursor=...&page_size=20
+        """
+        queryset = FriendRequest.objects.filter(  # type: ignore
+            to_user=request.user, status='pending'
+        ).select_related('from_user__profile')
         
-        from_user_profile.friends.add(to_user_profile)
-        to_user_profile.friends.add(from_user_profile)
+        paginator = FriendRequestInboxPagination()
+        page = paginator.paginate_queryset(queryset, request, view=self)
+        serializer = FriendRequestInboxSerializer(page, many=True, context={'request': request})
+        return paginator.get_paginated_response(serializer.data)
+    
+    @action(detail=False, methods=['post'], url_path='bulk-accept')
+    def bulk_accept(self, request):
+        """
+        Accept many pending friend requests in one transaction.
         
-        # Send real-time notification to the requester
-        self.send_friend_accepted_notification(
-            friend_request.from_user, 
-            friend_request.to_user
-        )
+        POST /api/friend-requests/bulk-accept/  {"ids": [1, 2, 3]}
+        """
+        return self.bulk_action(request, 'accepted')
+    
+    @action(detail=False, methods=['post'], url_path='bulk-reject')
+    def bulk_reject(self, request):
+        """
+        Reject many pending friend requests in one UPDATE.
+        
+        POST /api/friend-requests/bulk-reject/  {"ids": [1, 2, 3]}
+        """
+        return self.bulk_action(request, 'rejected')
+    
+    @action(detail=True, methods=['post'], permission_classes=[IsReceiver])
+    def accept(self, request, pk=None):
+        """Accept a friend request and send notifications"""
+        with transaction.atomic():
+            # Concurrent accepts queue up on the row lock; only the first sees 'pending'
+            friend_request = self.get_locked_request()
+            
+            if friend_request.status != 'pending':
+                return Response(
+                    {'error': 'This friend request has already been actioned.'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            
+            friend_request.status = 'accepted'
+            friend_request.save(update_fields=['status'])
+            
+            # Add users as friends
+            self.create_friendships([friend_request])
         
+        from_user = friend_request.from_user
         return Response({
             'status': 'Friend request accepted.',
             'friend_request_id': friend_request.id,
             'new_friend': {
-                'id': friend_request.from_user.id,
-                'username': friend_request.from_user.username,
-                'avatar': friend_request.from_user.profile.avatar.url if friend_request.from_user.profile.avatar else None
+                'id': from_user.id,
+                'username': from_user.username,
+                'avatar': from_user.profile.avatar.url if from_user.profile.avatar else None
             }
         })
 
     @action(detail=True, methods=['post'], permission_classes=[IsReceiver])
     def reject(self, request, pk=None):
         friend_request = self.get_object()
-        if friend_request.status != 'pending':
+        # Conditional update so a reject can't overwrite a concurrent accept
+        rejected = FriendRequest.objects.filter(  # type: ignore
+            pk=friend_request.pk, status='pending'
+        ).update(status='rejected')
+        if not rejected:
             return Response(
                 {'error': 'This friend request has already been actioned.'},
                 status=status.HTTP_400_BAD_REQUEST
             )
-        friend_request.status = 'rejected'
-        friend_request.save()
+        ResponseCache.invalidate(['friend_requests', 'discovery'], [friend_request.from_user_id, friend_request.to_user_id])
         return Response({'status': 'Friend request rejected.'})
 
 
-class CommunityViewSet(viewsets.ModelViewSet):
+class CommunityViewSet(ReplicaReadMixin, viewsets.ModelViewSet):
     """
     API endpoint for creating and managing communities.
     """
-    queryset = Community.objects.all()  # type: ignore
+    # member_count is a column, so listing communities is a single query
+    queryset = Community.objects.select_related('created_by')  # type: ignore
     serializer_class = CommunitySerializer
     # Secure this viewset with our custom permission
     permission_classes = [permissions.IsAuthenticated, IsCommunityAdminOrReadOnly]
+    # The directory is served from read replicas
+    replica_actions = {'directory'}
+    
+    @action(detail=False, methods=['get'])
+    @cached_action('communities')
+    def directory(self, request):
+        """
+        Browse communities alphabetically, a page at a time.
+        GET /api/communities/directory/?search=ken&is_channel=false&membership=joined
+        """
+        queryset = Community.objects.select_related('created_by').annotate(  # type: ignore
+            is_member=models.Exists(CommunityMembership.objects.filter(  # type: ignore
+                community=models.OuterRef('pk'), user=request.user
+            ))
+        )
+        
+        search = request.query_params.get('search', '').strip().lower()
+        if search:
+            # Prefix match as a range scan on community_search_name_idx
+            name_filter = models.Q(search_name__gte=search, search_name__lt=search + '\uffff')
+            if connection.vendor == 'postgresql' and len(search) >= 3:
+                # Substring match, served by the trigram index from migration 0014
+                name_filter |= models.Q(search_name__contains=search)
+            queryset = queryset.filter(name_filter)
+        
+        is_channel = request.query_params.get('is_channel')
+        if is_channel is not None:
+            if is_channel.lower() not in ('true', 'false', '1', '0'):
+                return Response({'error': 'is_channel must be true or false.'}, status=status.HTTP_400_BAD_REQUEST)
+            queryset = queryset.filter(is_channel=is_channel.lower() in ('true', '1'))
+        
+        membership = request.query_params.get('membership')
+        if membership is not None:
+            if membership not in ('joined', 'not_joined'):
+                return Response({'error': 'membership must be joined or not_joined.'}, status=status.HTTP_400_BAD_REQUEST)
+            queryset = queryset.filter(is_member=membership == 'joined')
+        
+        paginator = CommunityDirectoryPagination()
+        page = paginator.paginate_queryset(queryset, request, view=self)
+        serializer = CommunityDirectorySerializer(page, many=True, context=self.get_serializer_context())
+        return paginator.get_paginated_response(serializer.data)
     
     @transaction.atomic()  # Add back the parentheses for proper decorator usage
     def perform_create(self, serializer):  # type: ignore
@@ -236,124 +389,129 @@ class CommunityViewSet(viewsets.ModelViewSet):
         and create a conversation for the community.
         """
         community = serializer.save(created_by=self.request.user)
-        # Create the membership record making the creator an admin
-        CommunityMembership.objects.create(  # type: ignore
-            user=self.request.user,
-            community=community,
-            role='admin'
-        )
         
         # Create a conversation for the community
-        conversation = Conversation.objects.create(  # type: ignore
+        Conversation.objects.create(  # type: ignore
             conversation_type='community',
             community=community,
             name=f'{community.name} Chat',
             description=f'Main chat for {community.name}'
         )
         
-        # Add the creator as a participant
-        conversation.participants.add(self.request.user)
-        ConversationParticipant.objects.create(  # type: ignore
-            conversation=conversation,
-            user=self.request.user,
-            role='admin'
+        # Make the creator an admin of the community and its chat
+        _, community.member_count = CommunityMembershipService.add_members(
+            community.id, [self.request.user.id], role='admin'
         )
     
     @action(detail=True, methods=['post'], permission_classes=[permissions.IsAuthenticated])
     def join(self, request, pk=None):
         """
         Allow authenticated users to join a community.
+        POST /api/communities/{id}/join/
         """
-        community = self.get_object()
-        
-        # Check if user is already a member
-        membership, created = CommunityMembership.objects.get_or_create(
-            user=request.user,
-            community=community,
-            defaults={'role': 'member'}
-        )
-        
-        if not created:
+        added, member_count = CommunityMembershipService.add_members(pk, [request.user.id])
+        if not added:
             return Response(
                 {'message': 'You are already a member of this community.'},
                 status=status.HTTP_400_BAD_REQUEST
             )
-        
-        # Add user to the community conversation if it exists
-        try:
-            conversation = Conversation.objects.get(community=community)
-            conversation.participants.add(request.user)
-            ConversationParticipant.objects.get_or_create(
-                conversation=conversation,
-                user=request.user,
-                defaults={'role': 'member'}
-            )
-        except Conversation.DoesNotExist:
-            pass  # No conversation exists for this community
-        
-        serializer = self.get_serializer(community)
-        return Response(serializer.data)
+        return Response({'status': 'Joined community.', 'community_id': int(pk), 'member_count': member_count})
     
     @action(detail=True, methods=['post'], permission_classes=[permissions.IsAuthenticated])
     def leave(self, request, pk=None):
         """
         Allow members to leave a community.
+        POST /api/communities/{id}/leave/
+        """
+        removed, member_count = CommunityMembershipService.remove_member(pk, request.user.id)
+        if not removed:
+            role = CommunityMembership.objects.filter(  # type: ignore
+                community_id=pk, user=request.user
+            ).values_list('role', flat=True).first()
+            if role == 'admin':
+                # Admins should delete the community instead
+                error = 'Admins cannot leave communities. Please delete the community or transfer admin rights first.'
+            else:
+                error = 'You are not a member of this community.'
+            return Response({'error': error}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'status': 'Left community.', 'community_id': int(pk), 'member_count': member_count})
+    
+    @action(detail=True, methods=['post'], url_path='bulk-join')
+    def bulk_join(self, request, pk=None):
+        """
+        Import members into a community in one transaction. Community admins only.
+        POST /api/communities/{id}/bulk-join/  {"user_ids": [1, 2, 3], "role": "member"}
         """
+        # Object permissions: only admins of this community get past here
         community = self.get_object()
+        serializer = CommunityBulkJoinSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        user_ids = serializer.validated_data['user_ids']
         
-        # Check if user is a member
-        try:
-            membership = CommunityMembership.objects.get(
-                user=request.user,
-                community=community
-            )
-        except CommunityMembership.DoesNotExist:
-            return Response(
-                {'error': 'You are not a member of this community.'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
-        # Prevent admins from leaving (they should delete the community instead)
-        if membership.role == 'admin':
-            return Response(
-                {'error': 'Admins cannot leave communities. Please delete the community or transfer admin rights first.'},
-                status=status.HTTP_400_BAD_REQUEST
+        added, member_count = CommunityMembershipService.add_members(
+            community.id, user_ids, role=serializer.validated_data['role']
+        )
+        added_ids = set(added)
+        return Response({
+            'status': f'{len(added)} member(s) added.',
+            'added': added,
+            'skipped': [user_id for user_id in dict.fromkeys(user_ids) if user_id not in added_ids],
+            'member_count': member_count,
+        })
+
+def start_story_processing(user, blob, media_type, start_time=None, end_time=None):
+    """
+    Create the StoryPost/StoryItem for a stored upload, tell the uploader it is
+    being processed and hand it to the Celery media task.
+    `blob` is the MediaBlob returned by MediaStore for the uploaded file; the
+    caller's reference on it passes to the new StoryItem. If anything fails the
+    story is removed again and the reference released before re-raising.
+    Shared by the single-request and the resumable (chunked) upload paths.
+    """
+    # --- Database Creation ---
+    try:
+        with transaction.atomic():
+            story_post = StoryPost.objects.create(sender=user)  # type: ignore
+            story_item = StoryItem.objects.create(  # type: ignore
+                post=story_post, media_file=blob.file.name, blob=blob,
+                media_type=media_type, status='pending_upload'
             )
-        
-        # Remove user from membership
-        membership.delete()
-        
-        # Remove user from community conversation if it exists
-        try:
-            conversation = Conversation.objects.get(community=community)
-            conversation.participants.remove(request.user)
-            ConversationParticipant.objects.filter(
-                conversation=conversation,
-                user=request.user
-            ).delete()
-        except Conversation.DoesNotExist:
-            pass  # No conversation exists for this community
-        
-        serializer = self.get_serializer(community)
-        return Response(serializer.data)
+    except Exception:
+        MediaStore.release(blob.id)
+        raise
+    
+    # --- SEND INITIAL "PROCESSING" NOTIFICATION ---
+    tasks.send_websocket_notification(
+        user.id,
+        'story_upload_processing',
+        f'Your {media_type} is now being processed.',
+        {'story_id': story_post.id, 'status': 'processing'}
+    )
+    
+    # --- DISPATCH CELERY TASK ---
+    # Pass user_id so the task knows who to notify on completion
+    # Use getattr to bypass type checker issue with .delay attribute
+    task = getattr(tasks, 'process_story_media')
+    try:
+        task.delay(story_item_id=story_item.id, user_id=user.id, start_time=start_time, end_time=end_time)
+    except Exception:
+        # Nothing will process the item; deleting it releases its blob reference
+        story_post.delete()
+        raise
+    
+    return story_post
 
 
 # ViewSet for Story Posts
-class StoryPostViewSet(viewsets.ModelViewSet):
+class StoryPostViewSet(ReplicaReadMixin, viewsets.ModelViewSet):
     """
     API endpoint for creating and viewing stories.
     """
     queryset = StoryPost.objects.all().prefetch_related('items')  # type: ignore
     serializer_class = StoryPostSerializer
     permission_classes = [permissions.IsAuthenticated]
-    
-    def dispatch(self, request, *args, **kwargs):
-        """
-        Override dispatch to ensure this endpoint handles story requests correctly.
-        """
-        print(f"StoryPostViewSet.dispatch called with path: {request.path}")
-        # Ensure this viewset handles the request
-        return super().dispatch(request, *args, **kwargs)
+    # The story feed is served from read replicas
+    replica_actions = {'list'}
     
     def get_queryset(self):
         """
@@ -361,23 +519,23 @@ class StoryPostViewSet(viewsets.ModelViewSet):
         """
         user = self.request.user
         try:
-            # Get friends of the current user
-            friends = user.profile.friends.all() if hasattr(user, 'profile') else User.objects.none()
+            # Friend ids come from the cached friend graph instead of an M2M join
+            friend_ids = FriendGraph.friend_ids(user.id)
             # Include stories from friends and the user themselves
             return StoryPost.objects.filter(
-                models.Q(sender__in=friends) | models.Q(sender=user)
+                sender_id__in=friend_ids | {user.id}
             ).prefetch_related('items').order_by('-created_at')
         except Exception as e:
             logger.error(f"Error in get_queryset: {e}")
             # Return only the user's own stories as fallback
             return StoryPost.objects.filter(sender=user).prefetch_related('items').order_by('-created_at')
 
+    @cached_action('stories')
     def list(self, request, *args, **kwargs):
         """
         List all stories for the current user's feed.
         GET /api/stories/
         """
-        print("StoryPostViewSet.list called")
         try:
             return super().list(request, *args, **kwargs)
         except Exception as e:
@@ -389,7 +547,6 @@ class StoryPostViewSet(viewsets.ModelViewSet):
         Retrieve a specific story.
         GET /api/stories/{id}/
         """
-        print("StoryPostViewSet.retrieve called")
         try:
             return super().retrieve(request, *args, **kwargs)
         except Exception as e:
@@ -402,7 +559,6 @@ class StoryPostViewSet(viewsets.ModelViewSet):
         Get stories created by the current user.
         GET /api/stories/me/
         """
-        print("StoryPostViewSet.me called")
         try:
             queryset = self.get_queryset().filter(sender=request.user)
             serializer = self.get_serializer(queryset, many=True)
@@ -417,7 +573,6 @@ class StoryPostViewSet(viewsets.ModelViewSet):
         Get users who have active (non-expired) stories.
         GET /api/stories/active-users/
         """
-        print("StoryPostViewSet.active_users called")
         # Calculate the time 24 hours ago
         twenty_four_hours_ago = timezone.now() - timezone.timedelta(hours=24)
         
@@ -426,6 +581,16 @@ class StoryPostViewSet(viewsets.ModelViewSet):
             story_posts__created_at__gte=twenty_four_hours_ago
         ).distinct()
         
+        # Latest ready preview per user, fetched in one query so the tray
+        # can render thumbnails instead of full media files
+        latest_thumbnails = {}
+        recent_thumbnails = StoryItem.objects.filter(
+            post__created_at__gte=twenty_four_hours_ago,
+            status='complete'
+        ).exclude(thumbnail='').exclude(thumbnail__isnull=True).order_by('-post__created_at').values_list('post__sender_id', 'thumbnail')
+        for sender_id, thumbnail_name in recent_thumbnails:
+            latest_thumbnails.setdefault(sender_id, thumbnail_name)
+        
         # Serialize the user data
         user_data = []
         for user in active_users:
@@ -446,6 +611,7 @@ class StoryPostViewSet(viewsets.ModelViewSet):
                 'user_id': user.id,
                 'username': user.username,
                 'profile_picture': profile_picture,
+                'thumbnail': StoryItem.thumbnail.field.storage.url(latest_thumbnails[user.id]) if user.id in latest_thumbnails else None,
                 'has_active_stories': has_active_stories
             })
         
@@ -455,23 +621,7 @@ class StoryPostViewSet(viewsets.ModelViewSet):
         """
         Helper method to send WebSocket notifications to a specific user
         """
-        try:
-            channel_layer = get_channel_layer()
-            if channel_layer is not None:
-                user_group = f"user_{user_id}"
-                
-                async_to_sync(channel_layer.group_send)(
-                    user_group,
-                    {
-                        'type': 'send_notification',
-                        'message': message,
-                        'notification_type': notification_type,
-                        'data': data or {}
-                    }
-                )
-            logger.info(f"Notification sent to user {user_id}: {message}")
-        except Exception as e:
-            logger.error(f"Failed to send notification to user {user_id}: {e}")
+        tasks.send_websocket_notification(user_id, notification_type, message, data)
 
     # Override the create method for our async logic
     def create(self, request, *args, **kwargs):
@@ -480,7 +630,6 @@ class StoryPostViewSet(viewsets.ModelViewSet):
         Accepts optional 'start_time' and 'end_time' for video trimming.
         Sends an initial "processing" notification via WebSocket.
         """
-        print("StoryPostViewSet.create called")
         try:
             # (Your existing validation code for media_file, media_type, start/end time is good, keep it here)
             media_file = request.data.get('media_file')
@@ -501,37 +650,197 @@ class StoryPostViewSet(viewsets.ModelViewSet):
                  except (ValueError, TypeError):
                      return Response({"error": "Invalid time format."}, status=status.HTTP_400_BAD_REQUEST)
 
-            # --- Database Creation ---
-            story_post = StoryPost.objects.create(sender=request.user)  # type: ignore
-            story_item = StoryItem.objects.create(  # type: ignore
-                post=story_post, media_file=media_file, media_type=media_type, status='pending_upload'
-            )
-            
-            # --- SEND INITIAL "PROCESSING" NOTIFICATION ---
-            try:
-                channel_layer = get_channel_layer()
-                if channel_layer is not None:
-                    user_group = f"user_{request.user.id}"
-                    async_to_sync(channel_layer.group_send)(
-                        user_group,
-                        {
-                            'type': 'send_notification',
-                            'notification_type': 'story_upload_processing',
-                            'message': f'Your {media_type} is now being processed.',
-                            'data': {'story_id': story_post.id, 'status': 'processing'}
-                        }
-                    )
-            except Exception as e:
-                logger.error(f"Failed to send initial processing notification: {e}")
-                
-            # --- DISPATCH CELERY TASK ---
-            # Pass user_id so the task knows who to notify on completion
-            # Use getattr to bypass type checker issue with .delay attribute
-            task = getattr(tasks, 'process_story_media')
-            task.delay(story_item_id=story_item.id, user_id=request.user.id, start_time=start_time, end_time=end_time)
+            # Identical uploads are stored once and share their processed rendition
+            blob = MediaStore.store_upload(media_file)
+            story_post = start_story_processing(request.user, blob, media_type, start_time, end_time)
 
             serializer = self.get_serializer(story_post)
             return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
         except Exception as e:
             logger.error(f"Error in StoryPostViewSet.create: {e}")
             return Response({"error": "Failed to create story"}, status=500)
+
+
+# ViewSet for resumable (chunked) story uploads
+class StoryUploadViewSet(mixins.CreateModelMixin,
+                         mixins.RetrieveModelMixin,
+                         mixins.DestroyModelMixin,
+                         viewsets.GenericViewSet):
+    """
+    API endpoint for uploading story media in resumable chunks.
+    POST   /api/story-uploads/                 - Start an upload
+    GET    /api/story-uploads/{id}/            - Check progress (resume from received_bytes)
+    PUT    /api/story-uploads/{id}/chunk/      - Append a chunk
+    POST   /api/story-uploads/{id}/complete/   - Finish and start processing
+    DELETE /api/story-uploads/{id}/            - Abort the upload
+    """
+    serializer_class = StoryUploadSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    
+    CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+    
+    def get_queryset(self):
+        return StoryUpload.objects.filter(user=self.request.user)  # type: ignore
+    
+    def create(self, request, *args, **kwargs):
+        """
+        Start a resumable upload. The response tells the client which chunk size to use.
+        POST /api/story-uploads/
+        {"filename": "clip.mp4", "media_type": "video", "total_size": 73400320,
+         "start_time": 2.0, "end_time": 20.0}
+        A user may have at most STORY_UPLOAD_MAX_ACTIVE unfinished uploads.
+        """
+        uploads = self.get_queryset()
+        StoryUpload.expire_abandoned(uploads)
+        if uploads.filter(status='uploading').count() >= settings.STORY_UPLOAD_MAX_ACTIVE:
+            return Response(
+                {'error': 'Too many unfinished uploads. Finish or abort one first.'},
+                status=status.HTTP_429_TOO_MANY_REQUESTS
+            )
+        response = super().create(request, *args, **kwargs)
+        response.data['chunk_size'] = settings.STORY_UPLOAD_CHUNK_SIZE
+        return response
+    
+    def perform_create(self, serializer):
+        upload = serializer.save(user=self.request.user)
+        os.makedirs(settings.STORY_UPLOAD_TEMP_DIR, exist_ok=True)
+        open(upload.temp_path, 'wb').close()
+        logger.info(f"Story upload {upload.id} started by user {self.request.user.id} ({upload.total_size} bytes)")
+    
+    def perform_destroy(self, instance):
+        if instance.status == 'uploading' and os.path.exists(instance.temp_path):
+            os.remove(instance.temp_path)
+        instance.status = 'aborted'
+        instance.save(update_fields=['status', 'updated_at'])
+    
+    def destroy(self, request, *args, **kwargs):
+        """
+        Abort an upload and discard the partial file. The session is kept for auditing.
+        DELETE /api/story-uploads/{id}/
+        """
+        upload = self.get_object()
+        if upload.status != 'uploading':
+            return Response(
+                {'error': f'This upload is already {upload.status}.'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        self.perform_destroy(upload)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+    
+    @action(detail=True, methods=['put'])
+    def chunk(self, request, pk=None):
+        """
+        Append one chunk, streamed straight to disk without buffering the body.
+        PUT /api/story-uploads/{id}/chunk/
+        Header: Content-Range: bytes <start>-<end>/<total_size>
+        A chunk must start at the current received_bytes. On a 409 the client
+        resumes from the received_bytes returned in the response.
+        """
+        content_range = self.CONTENT_RANGE_RE.match(request.META.get('HTTP_CONTENT_RANGE', ''))
+        if not content_range:
+            return Response(
+                {'error': 'A "Content-Range: bytes <start>-<end>/<total>" header is required.'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        start, end, total = (int(value) for value in content_range.groups())
+        
+        upload = self.get_object()
+        if upload.status != 'uploading':
+            return Response(
+                {'error': f'This upload is already {upload.status}.'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if total != upload.total_size or end < start or end >= upload.total_size:
+            return Response(
+                {'error': 'Content-Range does not match this upload.'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if start != upload.received_bytes:
+            return Response(
+                {'error': 'Unexpected chunk offset.', 'received_bytes': upload.received_bytes},
+                status=status.HTTP_409_CONFLICT
+            )
+        
+        expected = end - start + 1
+        written = self._write_chunk(request, upload, start, expected)
+        
+        # Only advance the offset if nobody else moved it while we were streaming.
+        # No row lock is held during the (potentially slow) network read.
+        updated = StoryUpload.objects.filter(  # type: ignore
+            pk=upload.pk, status='uploading', received_bytes=start
+        ).update(received_bytes=start + written, updated_at=timezone.now())
+        upload.refresh_from_db()
+        
+        if not updated:
+            return Response(
+                {'error': 'Upload was modified concurrently.', 'received_bytes': upload.received_bytes},
+                status=status.HTTP_409_CONFLICT
+            )
+        if written != expected:
+            return Response(
+                {'error': 'Chunk was incomplete.', 'received_bytes': upload.received_bytes},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response(self.get_serializer(upload).data)
+    
+    @action(detail=True, methods=['post'])
+    def complete(self, request, pk=None):
+        """
+        Finish the upload: store the assembled file (deduplicated by content)
+        and hand it to process_story_media exactly like a regular story upload.
+        POST /api/story-uploads/{id}/complete/
+        """
+        with transaction.atomic():
+            upload = generics.get_object_or_404(self.get_queryset().select_for_update(), pk=pk)
+            if upload.status != 'uploading':
+                return Response(
+                    {'error': f'This upload is already {upload.status}.'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            if upload.received_bytes != upload.total_size:
+                return Response(
+                    {'error': 'Upload is not finished yet.', 'received_bytes': upload.received_bytes},
+                    status=status.HTTP_409_CONFLICT
+                )
+            # Claim the upload so a double-tapped "complete" can't process it twice
+            upload.status = 'complete'
+            upload.save(update_fields=['status', 'updated_at'])
+        
+        try:
+            blob = MediaStore.store_path(upload.temp_path, upload.filename)
+            story_post = start_story_processing(
+                request.user, blob, upload.media_type, upload.start_time, upload.end_time
+            )
+        except Exception as e:
+            # The assembled file may already be moved into the media store, so the
+            # upload can't be retried; start_story_processing has released the blob
+            logger.error(f"Failed to complete story upload {upload.id}: {e}")
+            if os.path.exists(upload.temp_path):
+                os.remove(upload.temp_path)
+            StoryUpload.objects.filter(pk=upload.pk).update(status='failed', updated_at=timezone.now())  # type: ignore
+            return Response({"error": "Failed to create story"}, status=500)
+        
+        upload.story_post = story_post
+        upload.save(update_fields=['story_post', 'updated_at'])
+        
+        return Response(
+            StoryPostSerializer(story_post, context=self.get_serializer_context()).data,
+            status=status.HTTP_202_ACCEPTED
+        )
+    
+    def _write_chunk(self, request, upload, offset, length):
+        """Copy up to `length` bytes from the request body into the partial file."""
+        read_size = settings.STORY_UPLOAD_READ_SIZE
+        stream = request.stream
+        written = 0
+        with open(upload.temp_path, 'r+b') as destination:
+            destination.seek(offset)
+            # Drop anything left behind by an interrupted chunk at this offset
+            destination.truncate()
+            while stream is not None and written < length:
+                data = stream.read(min(read_size, length - written))
+                if not data:
+                    break
+                destination.write(data)
+                written += len(data)
+        return written
@@ -20,7 +20,7 @@ django.setup()
 # Now that Django is set up, we can safely import our modules.
 # ============================================
 from channels.routing import ProtocolTypeRouter, URLRouter
-from api.middleware import JwtAuthMiddleware
+from api.middleware import JwtAuthMiddleware, WebSocketMetricsMiddleware
 import api.routing
 
 # The application routing configuration.
@@ -28,10 +28,13 @@ application = ProtocolTypeRouter({
     # The native ASGI application for HTTP requests. It is async-safe.
     "http": get_asgi_application(),
 
-    # WebSocket routing with our custom authentication middleware.
-    "websocket": JwtAuthMiddleware(
-        URLRouter(
-            api.routing.websocket_urlpatterns
+    # WebSocket routing with our custom authentication middleware,
+    # wrapped in connection/frame metrics.
+    "websocket": WebSocketMetricsMiddleware(
+        JwtAuthMiddleware(
+            URLRouter(
+                api.routing.websocket_urlpatterns
+            )
         )
     ),
 })
\ No newline at end of file
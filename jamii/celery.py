@@ -1,10 +1,14 @@
 # jamii/celery.py
+import logging
 import os
 from celery import Celery
+from celery.signals import celeryd_init
 
 # Set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'jamii.settings')
 
+logger = logging.getLogger(__name__)
+
 app = Celery('jamii')
 
 # Using a string here means the worker doesn't have to serialize
@@ -12,4 +16,38 @@ app = Celery('jamii')
 app.config_from_object('django.conf:settings', namespace='CELERY')
 
 # Load task modules from all registered Django apps.
-app.autodiscover_tasks()
\ No newline at end of file
+app.autodiscover_tasks()
+
+
+@celeryd_init.connect
+def configure_media_worker(sender=None, conf=None, options=None, **kwargs):
+    """
+    Worker profiles. Run one worker per queue:
+
+        celery -A jamii worker -n default@%h -Q default
+        celery -A jamii worker -n media@%h -Q media -P prefork --prefetch-multiplier=1
+
+    Workers named media@<host> take one task at a time per process and keep a
+    small pool, so long transcodes never hoard queued jobs or all of the CPU.
+    Time limits only work with the prefork pool.
+
+    The worker CLI always passes its own --prefetch-multiplier (defaulting to
+    the configured value) and that wins over conf, so the media command must
+    set it explicitly; the conf value only covers workers built without it.
+    """
+    if not sender or not sender.startswith('media@'):
+        return
+
+    from django.conf import settings
+
+    conf.worker_prefetch_multiplier = 1
+    conf.worker_concurrency = settings.MEDIA_WORKER_CONCURRENCY
+    # Acknowledge after the transcode finishes so a crashed worker doesn't lose it
+    conf.task_acks_late = True
+
+    prefetch_multiplier = (options or {}).get('prefetch_multiplier')
+    if prefetch_multiplier not in (None, 1):
+        logger.warning(
+            f"Media worker {sender} prefetches {prefetch_multiplier} tasks per process; "
+            f"start it with --prefetch-multiplier=1"
+        )
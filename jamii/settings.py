@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 from pathlib import Path
 from datetime import timedelta
+from kombu import Queue
 import os
 
 
@@ -53,12 +54,15 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so its latency and query counts cover the whole stack
+    'api.middleware.MetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'api.middleware.PrimaryPinMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -87,13 +91,201 @@ ASGI_APPLICATION = 'jamii.asgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# Pick a profile with JAMII_DB_PROFILE: 'sqlite' (default, local development)
+# or 'postgres' (production; connection details come from the POSTGRES_* variables).
+DB_PROFILE = os.environ.get('JAMII_DB_PROFILE', 'sqlite')
+
+if DB_PROFILE == 'postgres':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'jamii'),
+            'USER': os.environ.get('POSTGRES_USER', 'jamii'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', '127.0.0.1'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            # Persistent connections: reuse each worker's connection across requests
+            # instead of reconnecting every time, and check it is alive before reuse.
+            'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', '60')),
+            'CONN_HEALTH_CHECKS': True,
+            # Set when running behind PgBouncer in transaction pooling mode
+            'DISABLE_SERVER_SIDE_CURSORS': os.environ.get('DB_BEHIND_PGBOUNCER') == '1',
+            'OPTIONS': {
+                'connect_timeout': 5,
+            },
+        }
     }
+    # Streaming replicas, e.g. POSTGRES_REPLICA_HOSTS=10.0.0.5,10.0.0.6
+    for index, host in enumerate(filter(None, os.environ.get('POSTGRES_REPLICA_HOSTS', '').split(','))):
+        DATABASES[f'replica_{index}'] = {
+            **DATABASES['default'],
+            'HOST': host.strip(),
+            'TEST': {'MIRROR': 'default'},
+        }
+else:
+    DATABASES = {
+        'default': {
+            # django.db.backends.sqlite3 with BEGIN IMMEDIATE transactions
+            'ENGINE': 'api.sqlite_backend',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', '60')),
+            'OPTIONS': {
+                # Seconds a writer waits for the lock before "database is locked"
+                # (SQLite's busy timeout; not repeated in SQLITE_PRAGMAS)
+                'timeout': 20,
+            },
+        },
+        # Local stand-in for a read replica: a second connection to the same file.
+        # Only used for reads when JAMII_SQLITE_REPLICA=1 (see DATABASE_REPLICAS).
+        'replica': {
+            'ENGINE': 'api.sqlite_backend',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', '60')),
+            'OPTIONS': {
+                'timeout': 20,
+            },
+            'TEST': {'MIRROR': 'default'},
+        },
+    }
+
+# Aliases that read-heavy views read from (api/db_routers.py); empty means
+# everything uses 'default'.
+if DB_PROFILE == 'postgres':
+    DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+else:
+    DATABASE_REPLICAS = ['replica'] if os.environ.get('JAMII_SQLITE_REPLICA') == '1' else []
+
+DATABASE_ROUTERS = ['api.db_routers.ReplicaRouter']
+
+# Seconds a user's reads stay on the primary after they write something;
+# should comfortably exceed normal replication lag.
+DATABASE_REPLICA_PIN_SECONDS = 5
+
+# Applied to every new SQLite connection by api/db.py. WAL lets readers run
+# alongside the single writer; the busy timeout that makes writers queue up
+# instead of failing is DATABASES[...]['OPTIONS']['timeout'].
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'mmap_size': 128 * 1024 * 1024,
+    'temp_store': 'memory',
+}
+# Start transactions with BEGIN IMMEDIATE (api/sqlite_backend), so a transaction
+# that reads before it writes waits for the write lock instead of failing
+SQLITE_IMMEDIATE_TRANSACTIONS = True
+
+
+# Cache
+# Shared by the response cache (api/cache.py), the friend graph, WebSocket auth
+# and replica pinning. JAMII_CACHE_BACKEND=redis in production so every worker
+# sees the same entries; the in-process default is for tests and local development.
+CACHE_BACKEND = os.environ.get('JAMII_CACHE_BACKEND', 'locmem')
+
+if CACHE_BACKEND == 'redis':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ.get('CACHE_REDIS_URL', 'redis://127.0.0.1:6379/2'),
+            'KEY_PREFIX': 'jamii',
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'jamii',
+            'OPTIONS': {
+                'MAX_ENTRIES': 10000,
+            },
+        }
+    }
+
+# Seconds a cached GET response lives per scope (api/cache.py). Scopes that also
+# depend on other users' data (discovery, the community directory) are only
+# invalidated for the user who changed, so they get a shorter lifetime.
+RESPONSE_CACHE_TIMEOUTS = {
+    'default': 300,
+    'discovery': 60,
+    'communities': 60,
 }
 
+# Database queries one HTTP request may run before MetricsMiddleware logs a
+# warning and counts it in jamii_http_query_budget_exceeded_total. Keyed by
+# URL name ('story-list', 'profile-me'), or by method and URL name where a
+# write costs more than a read ('DELETE community-detail'); 'default' covers
+# every other route.
+# QueryBudgetTests in api/tests.py holds every route to these against its
+# seeded dataset; each value is the count measured there, so a new per-row
+# query fails the test. Routes that still run queries per row (its
+# SCALING_BUDGETS) are left on the default here, so production warns about them.
+QUERY_BUDGETS = {
+    'default': 25,
+    'profile-me': 6,
+    'profile-detail': 5,
+    'PUT profile-detail': 6,
+    'PATCH profile-detail': 6,
+    'DELETE profile-detail': 6,
+    'POST friend-request-list': 6,
+    'friend-request-pending': 2,
+    'friend-request-detail': 3,
+    'PUT friend-request-detail': 5,
+    'PATCH friend-request-detail': 5,
+    'friend-request-accept': 7,
+    'friend-request-reject': 4,
+    'friend-request-bulk-accept': 7,
+    'friend-request-bulk-reject': 5,
+    'community-list': 2,
+    'POST community-list': 17,
+    'community-directory': 2,
+    'community-detail': 2,
+    'PUT community-detail': 5,
+    'PATCH community-detail': 4,
+    'community-join': 9,
+    'community-leave': 10,
+    'community-bulk-join': 14,
+    'POST story-list': 12,
+    'story-me': 6,
+    'story-detail': 6,
+    'PUT story-detail': 8,
+    'PATCH story-detail': 8,
+    'DELETE story-detail': 9,
+    'story-upload-list': 4,
+    'story-upload-detail': 2,
+    'DELETE story-upload-detail': 3,
+    'story-upload-chunk': 4,
+    'story-upload-complete': 17,
+    'conversation-detail': 9,
+    'PUT conversation-detail': 17,
+    'PATCH conversation-detail': 17,
+    'DELETE conversation-detail': 10,
+    'conversation-messages': 8,
+    'conversation-add-participants': 16,
+    'conversation-leave': 12,
+    'message-list': 2,
+    'POST message-list': 12,
+    'message-detail': 3,
+    'PUT message-detail': 8,
+    'PATCH message-detail': 8,
+    'DELETE message-detail': 8,
+    'message-delete-message': 6,
+    'encryption-key-list': 3,
+    'POST encryption-key-list': 2,
+    'encryption-key-detail': 3,
+    'PUT encryption-key-detail': 4,
+    'PATCH encryption-key-detail': 4,
+    'discover-emergency-network': 6,
+    'discover-friend-suggestions': 3,
+    'discover-local-experts': 4,
+    'discover-location-stats': 9,
+    'discover-smart-matches': 7,
+    'discover-update-travel-status': 4,
+    'travel-status-my-status': 3,
+    'travel-status-update-preferences': 3,
+}
+
+# Bearer token required to scrape /metrics; empty leaves it open (keep it
+# reachable from the internal network only in that case)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -135,6 +327,20 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Story previews generated by api.tasks.process_story_media
+STORY_THUMBNAIL_MAX_SIZE = (320, 320)  # Bounding box in pixels
+STORY_THUMBNAIL_QUALITY = 70           # JPEG quality (1-95)
+STORY_POSTER_FRAME_SECONDS = 1.0       # Where to grab the video poster frame
+
+# Resumable story uploads (api.views.StoryUploadViewSet). Partial files live
+# outside MEDIA_ROOT so they are never served before they are complete.
+STORY_UPLOAD_TEMP_DIR = os.path.join(BASE_DIR, 'tmp', 'story_uploads')
+STORY_UPLOAD_CHUNK_SIZE = 1024 * 1024        # Chunk size suggested to clients
+STORY_UPLOAD_MAX_BYTES = 200 * 1024 * 1024   # Largest file an upload may declare
+STORY_UPLOAD_READ_SIZE = 64 * 1024           # Bytes streamed to disk per write
+STORY_UPLOAD_MAX_ACTIVE = 3                  # Unfinished uploads a user may have open at once
+STORY_UPLOAD_EXPIRY_HOURS = 24               # Idle uploads are expired after this long
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -146,7 +352,17 @@ REST_FRAMEWORK = {
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'rest_framework_simplejwt.authentication.JWTAuthentication',
-    )
+    ),
+    # JSON goes through api.fastjson (orjson when installed, stdlib otherwise)
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'api.renderers.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
 }
 
 SIMPLE_JWT = {
@@ -192,10 +408,61 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'UTC'
 
+# Queues and routing: CPU-heavy media work gets its own queue so a burst of
+# video uploads can't starve notification and matching tasks on 'default'.
+CELERY_TASK_DEFAULT_QUEUE = 'default'
+CELERY_TASK_QUEUES = (
+    Queue('default', routing_key='default'),
+    Queue('media', routing_key='media'),
+)
+CELERY_TASK_ROUTES = {
+    'api.tasks.process_story_media': {'queue': 'media'},
+}
+
+# Recipients per fan_out_notification task when notifying many users at once
+NOTIFICATION_FANOUT_CHUNK_SIZE = 500
+
+# WebSocket JWT auth (api/middleware.py)
+WS_AUTH_USER_CACHE_TIMEOUT = 60             # Seconds a resolved user is reused for the same token
+WS_AUTH_INVALID_TOKEN_CACHE_TIMEOUT = 300   # Seconds a rejected token is remembered
+WS_AUTH_LOG_SAMPLE_RATE = 0.01              # Fraction of connection events (auth, connect, disconnect) logged at DEBUG
+
+# Realtime state: presence registry (api/presence.py) and notification replay log (api/notifications.py).
+# 'redis' is required whenever Celery workers send notifications; 'memory' only works in a single process.
+REALTIME_BACKEND = 'redis'
+REALTIME_REDIS_URL = 'redis://127.0.0.1:6379/1'
+PRESENCE_TTL = 90                   # Seconds a connection counts as online after its last refresh
+PRESENCE_HEARTBEAT_INTERVAL = 30    # Seconds between presence refreshes of an open connection
+NOTIFICATION_LOG_MAX_SIZE = 100     # Newest notifications kept per user for replay on reconnect
+NOTIFICATION_LOG_TTL = 60 * 60 * 24 * 7
+
+# Batched WebSocket delivery for clients connecting with ?batch=1 (api/consumers.py)
+WS_BATCH_WINDOW_MS = 25             # How long pushed events are buffered before one frame is sent
+WS_BATCH_MAX_FRAMES = 100           # Flush early once this many events are buffered
+
+# WebSocket client commands (api/consumers.py)
+WS_COMMAND_RATE = 5                 # Commands per second a connection may sustain
+WS_COMMAND_BURST = 20               # Commands a connection may send in a burst
+WS_TYPING_DEBOUNCE_SECONDS = 3      # Repeated typing_start within this window isn't rebroadcast
+WS_TYPING_MEMBERS_CACHE_SECONDS = 60
+
+# Friend graph adjacency cache (seconds); entries are also dropped whenever a friendship changes
+FRIEND_GRAPH_CACHE_TIMEOUT = 3600
+
+# Media worker profile (applied in jamii/celery.py to workers named media@<host>)
+MEDIA_WORKER_CONCURRENCY = 2        # Parallel transcodes per media worker
+MEDIA_TASK_SOFT_TIME_LIMIT = 120    # Seconds before SoftTimeLimitExceeded is raised
+MEDIA_TASK_TIME_LIMIT = 180         # Seconds before the worker process is killed
+MEDIA_RENDITION_RETRY_SECONDS = 10  # Wait before re-checking a blob another task is transcoding
+
+# Tests run against in-memory realtime backends and channel layer (api/test_runner.py)
+TEST_RUNNER = 'api.test_runner.TestRunner'
+
 # Redis channel layer for WebSocket support
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        # RedisChannelLayer that counts sends for /metrics
+        "BACKEND": "api.channel_layers.InstrumentedRedisChannelLayer",
         "CONFIG": {
             "hosts": [("127.0.0.1", 6379)],
         },
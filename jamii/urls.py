@@ -3,6 +3,7 @@ from django.conf import settings
 from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path, include
+from api.metrics import metrics_view
 from rest_framework_simplejwt.views import ( # type: ignore
     TokenObtainPairView,
     TokenRefreshView,
@@ -17,6 +18,9 @@ urlpatterns = [
     # The out-of-the-box endpoints for JWT login and token refreshing
     path('api/auth/token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('api/auth/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+
+    # Prometheus scrape endpoint (api/metrics.py)
+    path('metrics', metrics_view, name='metrics'),
 ]
 
 if settings.DEBUG:
@@ -32,8 +32,9 @@ echo "   - Communities: /api/communities/"
 echo "   - Public Keys: /api/public-keys/"
 echo "   - Encryption Keys: /api/encryption-keys/"
 echo ""
-echo "To start Celery worker (for background tasks), run in another terminal:"
-echo "   source venv/bin/activate && celery -A jamii worker --loglevel=info"
+echo "To start Celery workers (for background tasks), run in separate terminals:"
+echo "   source venv/bin/activate && celery -A jamii worker -n default@%h -Q default --loglevel=info"
+echo "   source venv/bin/activate && celery -A jamii worker -n media@%h -Q media -P prefork --prefetch-multiplier=1 --loglevel=info"
 echo ""
 echo "Press Ctrl+C to stop the server"
 echo "============================================"